@@ -0,0 +1,113 @@
+# Import libraries
+import argparse
+import os
+import sys
+
+"""
+Single command line entry point for the pipelines.
+
+    python cli.py preprocess [CSV_PATH] [--async]
+    python cli.py compare-table [--async]
+    python cli.py compare-sectioned [--async]
+    python cli.py compare-gpt [--async]
+    python cli.py render-reports [--pipeline NAME] [--pdf] [--workers N] [--force]
+    python cli.py --profile [--profile-python {cprofile,sampling}] <command> ...
+
+A pipeline module is only imported once its command has been parsed, and the pipelines create
+their model and MongoDB clients on first use, so `--help` and argument errors return without
+loading any client library or touching the network. `startup_benchmark.py` checks that this
+stays fast.
+
+With `--profile`, the run records a Chrome trace of its stages, model calls and MongoDB
+commands and prints the slowest patients and calls at the end (see comparing/profiling.py).
+"""
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# The pipeline scripts import their siblings, so both folders go first on the path
+sys.path[:0] = [os.path.join(ROOT_DIR, 'pre_processing'), os.path.join(ROOT_DIR, 'comparing')]
+
+# Pipeline module of each comparison command, and its key in async_comparison.PIPELINES
+COMPARISON_COMMANDS = {
+    "compare-table": ("comparison_gemini_table", "table"),
+    "compare-sectioned": ("comparison_gemini_sectioned", "sectioned"),
+    "compare-gpt": ("comparison_gpt_table", "gpt"),
+}
+
+
+def run_preprocess(args):
+    if args.use_async:
+        import async_pre_processing
+        async_pre_processing.main(args.csv_path)
+    else:
+        import pre_processing
+        pre_processing.main(args.csv_path)
+
+
+def run_comparison(args):
+    module_name, async_pipeline = COMPARISON_COMMANDS[args.command]
+    if args.use_async:
+        import asyncio
+        import async_comparison
+        asyncio.run(async_comparison.run_async_comparisons(async_pipeline))
+    else:
+        import importlib
+        importlib.import_module(module_name).main()
+
+
+def run_render_reports(args):
+    import comparison_report
+    comparison_report.main(args.render_args)
+
+
+def build_parser():
+    """
+    Build the argument parser of the command line.
+    """
+    parser = argparse.ArgumentParser(description="Pre-process and compare radiology reports.")
+    parser.add_argument("--profile", action="store_true",
+                        help="Record a Chrome trace of the run and print the slowest patients and calls.")
+    parser.add_argument("--profile-dir", default="profiles", help="Directory of the profiling outputs.")
+    parser.add_argument("--profile-python", choices=["cprofile", "sampling"],
+                        help="Also profile the Python hot paths, with cProfile or a sampling profiler.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    preprocess = commands.add_parser("preprocess", help="Summarise raw reports and store them in MongoDB.")
+    preprocess.add_argument("csv_path", nargs="?", default="Chest Scans_deidentified_test.csv",
+                            help="Raw CSV file of radiology reports.")
+    preprocess.add_argument("--async", dest="use_async", action="store_true",
+                            help="Use the asynchronous pipeline.")
+    preprocess.set_defaults(run=run_preprocess)
+
+    for command, (module_name, _) in COMPARISON_COMMANDS.items():
+        comparison = commands.add_parser(command, help=f"Compare each patient's reports with {module_name}.py.")
+        comparison.add_argument("--async", dest="use_async", action="store_true",
+                                help="Use the asynchronous pipeline.")
+        comparison.set_defaults(run=run_comparison)
+
+    # The options of render-reports are parsed by comparison_report.py itself, see main()
+    render = commands.add_parser("render-reports", add_help=False,
+                                 help="Pre-render the HTML/PDF comparison report of every patient.")
+    render.set_defaults(run=run_render_reports)
+
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args, args.render_args = parser.parse_known_args(argv)
+    if args.render_args and args.command != "render-reports":
+        parser.error(f"unrecognized arguments: {' '.join(args.render_args)}")
+    if not args.profile:
+        args.run(args)
+        return
+
+    from profiling import profiler
+    profiler.enable(args.profile_dir, args.profile_python)
+    try:
+        args.run(args)
+    finally:
+        profiler.finish(args.command)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,370 @@
+# Import libraries
+import argparse
+import asyncio
+import importlib
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError
+from async_support import AsyncRateLimiter, batch_writer, call_with_quota_retries
+from clients import async_mongo_client, close_async_mongo_client
+from comparison_records import (
+    ComparisonRecord,
+    build_comparison_document,
+    build_single_report_document,
+    ensure_indexes,
+    latest_compared_date,
+    idempotent_filter,
+    parse_comparison_table,
+    with_comparison_hash,
+)
+from comparison_pipeline import DATE_FORMAT, MAX_REPORTS
+from comparison_scheduler import schedule_patients
+from model_router import section_entry_count
+from profiling import span
+from request_packing import ComparisonUnit, pack_units, packed_request, packed_results
+from sharding import shard_assignment_from_env
+from text_storage import TextStorage
+
+"""
+Asynchronous mode of the comparison pipelines.
+
+The stages run concurrently and are connected by bounded queues, so a slow stage applies
+backpressure to the ones before it:
+
+    schedule (report index) -> compare (packed model calls) -> write (batched upserts)
+
+The prompts, model router, collections and report index of the selected pipeline module are
+reused, as in the batch mode (see comparison_pipeline.py): patients are queued in the priority
+order of `comparison_scheduler`, their full reports are only fetched when they are compared,
+and their sections are packed into as few requests as `request_packing.PACKING_CONFIG` allows.
+"""
+
+# Asynchronous pipeline configuration
+"""
+IMPORTANT: Keep `requests_per_minute` within your API quota.
+    - `max_in_flight`: model calls awaiting a response at the same time.
+    - `workers`: patients compared at the same time.
+    - `patient_queue_size` / `write_queue_size`: bounds of the queues between stages.
+    - `write_batch_size`: documents per MongoDB bulk write.
+"""
+ASYNC_CONFIG = {
+    "max_in_flight": 200,
+    "requests_per_minute": 1000,
+    "workers": 50,
+    "patient_queue_size": 100,
+    "write_queue_size": 100,
+    "write_batch_size": 50,
+}
+
+PIPELINES = {
+    "table": "comparison_gemini_table",
+    "sectioned": "comparison_gemini_sectioned",
+    "gpt": "comparison_gpt_table",
+}
+
+
+async def read_patients(pipeline, patient_queue, shard=None):
+    """
+    Queue the patients in priority order, see comparison_scheduler.PRIORITY_CONFIG.
+
+    The report index is built with the synchronous client off the event loop, see
+    comparison_pipeline.ComparisonPipeline.get_reports_by_patient.
+
+    Args:
+        pipeline (module): Comparison pipeline providing `get_reports_by_patient`.
+        patient_queue (asyncio.Queue): Queue receiving (patient ID, PatientReports) tuples.
+        shard (ShardAssignment, optional): Shards of this worker; only their patients are read.
+    """
+    with span("load_reports"):
+        reports_by_patient = await asyncio.to_thread(
+            pipeline.get_reports_by_patient, shard.query() if shard is not None else None
+        )
+
+    for patient_id, reports in schedule_patients(reports_by_patient):
+        if shard is not None:
+            # Renew leases with the synchronous client off the event loop, and skip patients
+            # of shards lost or not yet backfilled
+            if shard.renewal_due():
+                await asyncio.to_thread(shard.keep_alive)
+            if not shard.owns_patient(patient_id):
+                continue
+        await patient_queue.put((patient_id, reports))
+
+
+def build_units(pipeline, reports):
+    """
+    Fetch a patient's reports and build the comparison units of the newest report against each older one.
+
+    Fetching the reports and reading their sections (which decodes compressed fields and
+    fetches referenced contents) use the synchronous client, so this runs in a worker thread.
+
+    Args:
+        pipeline (module): Comparison pipeline providing `format_radiology_report`.
+        reports (PatientReports): The patient's reports to compare, oldest first.
+
+    Returns:
+        tuple: The (datetime, report dict) tuples still stored, oldest first, and their
+               ComparisonUnit objects, without those whose sections are both empty.
+    """
+    reports = reports.load()
+    if len(reports) < 2:
+        return reports, []
+
+    base_report = reports[-1]
+    _, base_sections = pipeline.format_radiology_report(base_report[1])
+    units = []
+    for report in reversed(reports[:-1]):
+        _, report_sections = pipeline.format_radiology_report(report[1])
+        for section_name in base_sections.keys():
+            units.append(ComparisonUnit(
+                section_name, base_report, report, base_sections[section_name], report_sections[section_name]
+            ))
+    return reports, [unit for unit in units if not unit.is_empty]
+
+
+async def compare_unit_async(pipeline, unit, limiter, semaphore):
+    """
+    Compare one section of one report pair.
+
+    Args:
+        pipeline (module): Comparison pipeline providing `generate_comparison_prompt` and `get_router`.
+        unit (ComparisonUnit): Section and report pair to compare.
+        limiter (AsyncRateLimiter): Shared request rate limiter.
+        semaphore (asyncio.Semaphore): Shared bound on model calls in flight.
+
+    Returns:
+        list: Parsed (category, new content, old content, explanation) rows.
+    """
+    prompt = pipeline.generate_comparison_prompt(
+        unit.section_name,
+        unit.content1,
+        unit.content2,
+        unit.new_report[0].strftime(DATE_FORMAT),
+        unit.old_report[0].strftime(DATE_FORMAT)
+    )
+    entry_count = section_entry_count(unit.content1, unit.content2)
+
+    comparison_output = await call_with_quota_retries(
+        lambda: pipeline.get_router().agenerate(prompt, entry_count),
+        f"comparison for section '{unit.section_name}'",
+        limiter=limiter,
+        semaphore=semaphore
+    )
+    return parse_comparison_table(comparison_output) if comparison_output else []
+
+
+async def compare_batch_async(pipeline, batch, limiter, semaphore):
+    """
+    Compare a batch of units in one packed request, see request_packing.pack_units.
+
+    Units missing from the packed response, or whose output fails validation, are compared alone.
+
+    Returns:
+        list: (unit, rows) tuples in batch order.
+    """
+    if len(batch) == 1:
+        return [(batch[0], await compare_unit_async(pipeline, batch[0], limiter, semaphore))]
+
+    prompt, entry_count, validate = packed_request(batch, pipeline.generate_comparison_prompt)
+    response_text = await call_with_quota_retries(
+        lambda: pipeline.get_router().agenerate(prompt, entry_count, validate=validate, task_count=len(batch)),
+        f"packed comparison of {len(batch)} sections",
+        limiter=limiter,
+        semaphore=semaphore
+    )
+    return [
+        (unit, rows if rows is not None else await compare_unit_async(pipeline, unit, limiter, semaphore))
+        for unit, rows in packed_results(batch, response_text)
+    ]
+
+
+async def compare_units_async(pipeline, units, limiter, semaphore):
+    """
+    Compare units with as few requests as the token budgets allow, sending the requests concurrently.
+
+    Asynchronous counterpart of request_packing.compare_units_packed.
+
+    Args:
+        pipeline (module): Comparison pipeline providing `generate_comparison_prompt`, `get_router` and `PIPELINE`.
+        units (list): ComparisonUnit objects.
+        limiter (AsyncRateLimiter): Shared request rate limiter.
+        semaphore (asyncio.Semaphore): Shared bound on model calls in flight.
+
+    Returns:
+        list: (unit, rows) tuples in the order of the units.
+    """
+    batches = pack_units(units, pipeline.generate_comparison_prompt, pipeline.PIPELINE.get_packing_backend())
+    results = await asyncio.gather(*(compare_batch_async(pipeline, batch, limiter, semaphore) for batch in batches))
+    return [result for batch_results in results for result in batch_results]
+
+
+async def compare_patient_async(pipeline, patient_id, reports, comparison_collection, limiter, semaphore):
+    """
+    Compare the latest reports of a patient, sending the packed requests of all sections concurrently.
+
+    Args:
+        pipeline (module): Comparison pipeline module.
+        patient_id (str): ID of the patient.
+        reports (PatientReports): The patient's reports, sorted by performed date time in ascending order.
+        comparison_collection (AsyncCollection): Collection of stored comparisons.
+        limiter (AsyncRateLimiter): Shared request rate limiter.
+        semaphore (asyncio.Semaphore): Shared bound on model calls in flight.
+
+    Returns:
+        dict | None: The comparison document to store, or None if there is nothing to store.
+    """
+    if len(reports) == 1:
+        print(f"Only one report available for PatientID {patient_id}. No comparison will be generated.")
+        return build_single_report_document(patient_id, reports.latest_date())
+
+    # If there are more than 5 reports, only keep the latest 5
+    reports = reports.latest(MAX_REPORTS)
+
+    existing_comparison = await comparison_collection.find_one({"PatientID": patient_id})
+    if existing_comparison:
+        latest_existing_date = latest_compared_date(existing_comparison)
+        if latest_existing_date and latest_existing_date >= reports.latest_date():
+            print(f"No new reports for PatientID {patient_id}. Skipping comparison.")
+            return None
+
+    # Fetch the full reports only now that a comparison is needed; some may have been deleted since
+    reports, units = await asyncio.to_thread(build_units, pipeline, reports)
+    if not reports:
+        print(f"Reports of PatientID {patient_id} were deleted. Skipping comparison.")
+        return None
+    if len(reports) == 1:
+        print(f"Only one report available for PatientID {patient_id}. No comparison will be generated.")
+        return build_single_report_document(patient_id, reports[0][0])
+
+    records = [
+        ComparisonRecord.from_reports(unit.section_name, row, unit.new_report, unit.old_report)
+        for unit, rows in await compare_units_async(pipeline, units, limiter, semaphore)
+        for row in rows
+    ]
+    return build_comparison_document(patient_id, [report[0] for report in reports], records)
+
+
+async def comparison_worker(pipeline, patient_queue, write_queue, comparison_collection, limiter, semaphore):
+    """
+    Take patients from the patient queue and put their comparison documents on the write queue.
+    """
+    while True:
+        item = await patient_queue.get()
+        if item is None:
+            patient_queue.task_done()
+            return
+        patient_id, reports = item
+        try:
+            with span("patient", patient_id=patient_id, reports=len(reports)):
+                document = await compare_patient_async(
+                    pipeline, patient_id, reports, comparison_collection, limiter, semaphore
+                )
+            if document is not None:
+                await write_queue.put(document)
+        except Exception as e:
+            print(f"Error comparing reports for PatientID {patient_id}: {e}")
+        finally:
+            patient_queue.task_done()
+
+
+async def run_async_comparisons(pipeline_name="table", config=ASYNC_CONFIG):
+    """
+    Run a comparison pipeline in asynchronous mode.
+
+    Args:
+        pipeline_name (str): Key of `PIPELINES`.
+        config (dict): Asynchronous pipeline configuration, see `ASYNC_CONFIG`.
+
+    Returns:
+        int: Number of comparison documents written.
+    """
+    pipeline = importlib.import_module(PIPELINES[pipeline_name])
+
+    # Comparisons are read and written with the asynchronous client; the reports, leases,
+    # dictionaries and shared contents with the pipeline's synchronous client, off the event loop
+    comparison_collection = async_mongo_client(pipeline.uri)[pipeline.DATABASE_NAME][pipeline.COMPARISON_COLLECTION_NAME]
+
+    # The idempotent upserts rely on the unique PatientID index, see comparison_records.ensure_indexes
+    await asyncio.to_thread(ensure_indexes, pipeline.get_comparison_collection())
+
+    # Only process this worker's shards of the patients when SHARD_COUNT is set, see sharding.py
+    shard = await asyncio.to_thread(shard_assignment_from_env, pipeline.get_db())
+
+    storage = TextStorage.for_database(pipeline.get_db())
+
+    limiter = AsyncRateLimiter(config["requests_per_minute"])
+    semaphore = asyncio.Semaphore(config["max_in_flight"])
+    patient_queue = asyncio.Queue(maxsize=config["patient_queue_size"])
+    write_queue = asyncio.Queue(maxsize=config["write_queue_size"])
+
+    async def write_documents(documents):
+        try:
+            # Large contents are stored once in the shared content collection when enabled, see text_storage.py
+            stored_documents = await asyncio.to_thread(
+                lambda: [storage.externalize_contents(with_comparison_hash(document)) for document in documents]
+            )
+            await comparison_collection.bulk_write(
+                [
+                    ReplaceOne(idempotent_filter(document), stored_document, upsert=True)
+                    for document, stored_document in zip(documents, stored_documents)
+                ],
+                ordered=False
+            )
+            print(f"Saved comparisons for {len(documents)} patients.")
+            return len(documents)
+        except BulkWriteError as e:
+            # Duplicate keys are patients whose stored comparison covers newer reports
+            saved = len(documents) - len(e.details["writeErrors"])
+            skipped = sum(1 for error in e.details["writeErrors"] if error["code"] == 11000)
+            print(f"Saved comparisons for {saved} patients, {skipped} skipped as a newer comparison is stored.")
+            if skipped < len(e.details["writeErrors"]):
+                print(f"Error saving comparisons to MongoDB: {e}")
+            return saved
+        except Exception as e:
+            print(f"Error saving comparisons to MongoDB: {e}")
+            return 0
+
+    try:
+        writer = asyncio.create_task(batch_writer(write_queue, write_documents, config["write_batch_size"]))
+        workers = [
+            asyncio.create_task(comparison_worker(
+                pipeline, patient_queue, write_queue, comparison_collection, limiter, semaphore
+            ))
+            for _ in range(config["workers"])
+        ]
+
+        # Without sharding, every patient is compared in a single round
+        while shard is None or await asyncio.to_thread(shard.claim):
+            await read_patients(pipeline, patient_queue, shard)
+            if shard is None:
+                break
+            # The held shards are only done once their patients are compared and saved
+            await patient_queue.join()
+            await write_queue.join()
+            await asyncio.to_thread(shard.mark_done)
+
+        for _ in range(config["workers"]):
+            await patient_queue.put(None)
+        await asyncio.gather(*workers)
+        await write_queue.put(None)
+        written = await writer
+    finally:
+        if shard is not None:
+            await asyncio.to_thread(shard.release)
+        await close_async_mongo_client(pipeline.uri)
+
+    # Report calls per model and the escalation rate of the run
+    pipeline.get_router().print_stats()
+    return written
+
+
+def main():
+    """
+    Run the asynchronous comparison pipeline from the command line.
+    """
+    parser = argparse.ArgumentParser(description="Compare radiology reports asynchronously.")
+    parser.add_argument("pipeline", nargs="?", default="table", choices=PIPELINES.keys())
+    args = parser.parse_args()
+    asyncio.run(run_async_comparisons(args.pipeline))
+
+if __name__ == "__main__":
+    main()
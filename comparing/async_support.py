@@ -0,0 +1,94 @@
+# Import libraries
+import asyncio
+import time
+from profiling import span
+
+
+class AsyncRateLimiter:
+    """
+    Limits how many requests are started per minute, shared by all tasks of a pipeline.
+
+    Requests are spaced evenly (one every 60 / `requests_per_minute` seconds), so a burst of
+    tasks cannot exceed the API quota even when many of them are waiting at once.
+    """
+
+    def __init__(self, requests_per_minute):
+        self.interval = 60.0 / requests_per_minute
+        self._next_start = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        """
+        Wait until the next request may start.
+        """
+        async with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_start)
+            self._next_start = start + self.interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+
+async def call_with_quota_retries(make_call, description, retries=3, retry_delay=30, limiter=None, semaphore=None):
+    """
+    Run an asynchronous model call, retrying when the API quota is exceeded.
+
+    Mirrors the retry behaviour of the synchronous pipelines: errors containing "429" are
+    retried after `retry_delay` seconds, other errors are logged and give up.
+
+    Args:
+        make_call (callable): Function returning a new awaitable for each attempt.
+        description (str): Description of the call used in log messages.
+        retries (int): Number of attempts.
+        retry_delay (int): Seconds to wait after a quota error.
+        limiter (AsyncRateLimiter, optional): Rate limiter awaited before each attempt.
+        semaphore (asyncio.Semaphore, optional): Bounds the number of calls in flight.
+
+    Returns:
+        object | None: The result of the call, or None if every attempt failed.
+    """
+    for attempt in range(retries):
+        try:
+            if limiter is not None:
+                await limiter.wait()
+            if semaphore is None:
+                return await make_call()
+            async with semaphore:
+                return await make_call()
+        except Exception as e:
+            if "429" in str(e):
+                print(f"API quota exceeded. Retrying in {retry_delay} seconds... (Attempt {attempt + 1}/{retries})")
+                with span("retry_wait", "retry", call=description):
+                    await asyncio.sleep(retry_delay)
+            else:
+                print(f"Error generating {description}: {e}")
+                return None
+    return None
+
+
+async def batch_writer(queue, write_batch, batch_size):
+    """
+    Consume items from a queue and write them in batches until a None sentinel is received.
+
+    Args:
+        queue (asyncio.Queue): Queue of items to write; None marks the end of the stream.
+        write_batch (callable): Coroutine function writing a list of items and returning how
+                                many of them were actually written.
+        batch_size (int): Maximum number of items per write.
+
+    Returns:
+        int: Number of written items.
+    """
+    batch = []
+    written = 0
+    while True:
+        item = await queue.get()
+        if item is not None:
+            batch.append(item)
+        # Flush when the batch is full, at the end of the stream, or when no more items are waiting
+        if batch and (item is None or len(batch) >= batch_size or queue.empty()):
+            written += await write_batch(batch)
+            batch = []
+        queue.task_done()
+        if item is None:
+            return written
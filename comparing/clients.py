@@ -0,0 +1,154 @@
+# Import libraries
+import os
+import threading
+
+"""
+Lazily created, shared clients for every pipeline.
+
+Importing a pipeline script no longer connects to anything: the Gemini models, MongoDB
+clients and Azure OpenAI chat models are created on first use and cached, so a dry run, an
+import in a test or `cli.py --help` pays no connection setup and works without a network.
+The heavy client libraries (google.generativeai, pymongo, langchain, dotenv) are imported
+inside the functions below for the same reason.
+
+Clients are cached per configuration and shared by every pipeline of the process; a
+MongoClient is itself a connection pool, so one client per URI is all a process needs.
+"""
+
+_lock = threading.Lock()
+_clients = {}
+
+
+def _cached(key, create):
+    """
+    Return the client cached under `key`, creating it once if needed.
+    """
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _clients[key] = create()
+    return client
+
+
+def mongo_client(uri):
+    """
+    Get the shared MongoClient of a URI.
+
+    Args:
+        uri (str): MongoDB connection URI.
+
+    Returns:
+        MongoClient: Client pooling the connections to the server.
+    """
+    def create():
+        from pymongo import MongoClient
+        from pymongo.server_api import ServerApi
+        return MongoClient(uri, server_api=ServerApi('1'))
+    return _cached(("mongo", uri), create)
+
+
+def async_mongo_client(uri):
+    """
+    Get the shared AsyncMongoClient of a URI for the running event loop.
+
+    An AsyncMongoClient is bound to the event loop it is used on, so one client is cached per
+    loop; close it with `close_async_mongo_client` before the loop ends.
+
+    Args:
+        uri (str): MongoDB connection URI.
+
+    Returns:
+        AsyncMongoClient: Client pooling the connections to the server.
+    """
+    import asyncio
+
+    def create():
+        from pymongo import AsyncMongoClient
+        from pymongo.server_api import ServerApi
+        return AsyncMongoClient(uri, server_api=ServerApi('1'))
+    return _cached(("async_mongo", uri, id(asyncio.get_running_loop())), create)
+
+
+async def close_async_mongo_client(uri):
+    """
+    Close the AsyncMongoClient of a URI for the running event loop, see `async_mongo_client`.
+    """
+    import asyncio
+
+    with _lock:
+        client = _clients.pop(("async_mongo", uri, id(asyncio.get_running_loop())), None)
+    if client is not None:
+        await client.close()
+
+
+def mongo_collection(uri, database_name, collection_name):
+    """
+    Get a collection through the shared MongoClient of a URI.
+    """
+    return mongo_client(uri)[database_name][collection_name]
+
+
+def gemini_model(api_key, model_name):
+    """
+    Get a shared Gemini `GenerativeModel`.
+
+    Args:
+        api_key (str): Gemini API key.
+        model_name (str): Name of the model, e.g. 'gemini-1.5-flash'.
+
+    Returns:
+        GenerativeModel: The Gemini model.
+    """
+    def create():
+        import google.generativeai as genai
+        genai.configure(api_key=api_key)
+        return genai.GenerativeModel(model_name)
+    return _cached(("gemini", api_key, model_name), create)
+
+
+def load_environment(path='.env'):
+    """
+    Load an environment file once per process.
+
+    Args:
+        path (str): Path of the environment file.
+
+    Returns:
+        None
+    """
+    def create():
+        from dotenv import load_dotenv
+        load_dotenv(path)
+        return True
+    _cached(("dotenv", path), create)
+
+
+def azure_chat_model(deployment_name, model_name=None, api_version="2023-05-15", temperature=0.0):
+    """
+    Get a shared Azure OpenAI chat model, configured from `OPENAI_API_KEY` and `OPENAI_API_BASE`.
+
+    Args:
+        deployment_name (str): Azure deployment of the model.
+        model_name (str, optional): Name of the underlying model, e.g. 'gpt-4o'.
+        api_version (str): Azure OpenAI API version.
+        temperature (float): Sampling temperature.
+
+    Returns:
+        AzureChatOpenAI: The LangChain chat model.
+    """
+    def create():
+        from langchain.chat_models import AzureChatOpenAI
+        options = {"model_name": model_name} if model_name else {}
+        return AzureChatOpenAI(
+            default_headers={"Ocp-Apim-Subscription-Key": os.environ["OPENAI_API_KEY"]}, # latest version of langchain
+            openai_api_base=os.environ["OPENAI_API_BASE"],
+            openai_api_key=os.environ["OPENAI_API_KEY"],
+            deployment_name=deployment_name,
+            openai_api_version=api_version,
+            temperature=temperature,
+            verbose=True,
+            **options
+        )
+    return _cached(("azure", deployment_name, model_name, api_version, temperature), create)
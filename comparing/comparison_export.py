@@ -0,0 +1,265 @@
+# Import libraries
+import glob
+import os
+import shutil
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+from clients import mongo_client
+from comparison_records import PIPELINE_COLLECTIONS, records_from_document
+from text_storage import TextStorage
+
+# Fixed schema of the exported dataset. Low-cardinality columns are dictionary encoded.
+_DICT_STRING = pa.dictionary(pa.int32(), pa.string())
+COMPARISON_SCHEMA = pa.schema([
+    ("pipeline", _DICT_STRING),
+    ("patient_id", pa.string()),
+    ("section", _DICT_STRING),
+    ("category", _DICT_STRING),
+    ("new_content", pa.string()),
+    ("old_content", pa.string()),
+    ("explanation", pa.string()),
+    ("new_report_date", pa.timestamp("s")),
+    ("old_report_date", pa.timestamp("s")),
+    ("new_order_id", pa.string()),
+    ("old_order_id", pa.string()),
+    ("new_order_name", _DICT_STRING),
+    ("old_order_name", _DICT_STRING),
+    ("month", pa.string()),
+])
+
+# Directory layout of the dataset: pipeline=<name>/month=<YYYY-MM>/<part>.parquet
+PARTITION_SCHEMA = pa.schema([("pipeline", pa.string()), ("month", pa.string())])
+
+
+def flatten_comparison_document(document, pipeline):
+    """
+    Flatten one stored comparison document into fixed-schema rows.
+
+    Documents in the canonical schema and legacy documents awaiting migration are both
+    supported, see `comparison_records.records_from_document`.
+
+    Args:
+        document (dict): Comparison document as stored in MongoDB.
+        pipeline (str): Name of the pipeline that produced the document.
+
+    Returns:
+        list: A list of row dictionaries following `COMPARISON_SCHEMA`.
+    """
+    patient_id = document.get("PatientID")
+    return [
+        {
+            "pipeline": pipeline,
+            "patient_id": patient_id,
+            "section": record.section,
+            "category": record.category,
+            "new_content": record.new_content,
+            "old_content": record.old_content,
+            "explanation": record.explanation,
+            "new_report_date": record.new_report_date,
+            "old_report_date": record.old_report_date,
+            "new_order_id": record.new_order_id,
+            "old_order_id": record.old_order_id,
+            "new_order_name": record.new_order_name,
+            "old_order_name": record.old_order_name,
+            "month": record.new_report_date.strftime("%Y-%m") if record.new_report_date else "unknown",
+        }
+        for record in records_from_document(document)
+    ]
+
+
+def comparisons_to_table(rows):
+    """
+    Convert flattened comparison rows into a dictionary-encoded Arrow table.
+
+    Args:
+        rows (list): Row dictionaries produced by `flatten_comparison_document`.
+
+    Returns:
+        pyarrow.Table: Table following `COMPARISON_SCHEMA`.
+    """
+    columns = {name: [row[name] for row in rows] for name in COMPARISON_SCHEMA.names}
+    return pa.Table.from_pydict(columns, schema=COMPARISON_SCHEMA)
+
+
+def _replace_directory(source, target):
+    """
+    Move `source` to `target`, replacing any previous `target` directory.
+    """
+    previous = f"{target}.old"
+    shutil.rmtree(previous, ignore_errors=True)
+    if os.path.exists(target):
+        os.rename(target, previous)
+    os.rename(source, target)
+    shutil.rmtree(previous, ignore_errors=True)
+
+
+def export_comparisons(db, output_dir, pipelines=None, batch_size=5000):
+    """
+    Export stored comparisons into a Parquet dataset partitioned by pipeline and month.
+
+    Documents are streamed from MongoDB in batches so the whole collection is never held
+    in memory. Each exported pipeline is written to a staging directory, which then
+    replaces every previously exported month of that pipeline, so rows of comparisons
+    re-upserted with different report dates do not linger in their old months.
+
+    Args:
+        db (Database): MongoDB database holding the comparison collections.
+        output_dir (str): Directory of the Parquet dataset.
+        pipelines (list, optional): Pipelines to export. Defaults to all of `PIPELINE_COLLECTIONS`.
+        batch_size (int): Number of rows converted to Arrow at a time.
+
+    Returns:
+        int: Number of exported rows.
+    """
+    pipelines = pipelines or list(PIPELINE_COLLECTIONS.keys())
+    storage = TextStorage.for_database(db)
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Exports written before the pipeline partition were partitioned by month only
+    for legacy_partition in glob.glob(os.path.join(output_dir, "month=*")):
+        shutil.rmtree(legacy_partition)
+
+    exported = 0
+
+    def iter_batches(pipeline):
+        nonlocal exported
+        rows = []
+        for document in db[PIPELINE_COLLECTIONS[pipeline]].find({}, {"_id": 0}):
+            document = storage.resolve_contents(document)
+            rows.extend(flatten_comparison_document(document, pipeline))
+            if len(rows) >= batch_size:
+                exported += len(rows)
+                yield from comparisons_to_table(rows).to_batches()
+                rows = []
+        if rows:
+            exported += len(rows)
+            yield from comparisons_to_table(rows).to_batches()
+
+    for pipeline in pipelines:
+        # Staging directories start with "." so readers of the dataset ignore them
+        staging_dir = os.path.join(output_dir, f".staging-{pipeline}")
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        ds.write_dataset(
+            iter_batches(pipeline),
+            staging_dir,
+            schema=COMPARISON_SCHEMA,
+            format="parquet",
+            partitioning=ds.partitioning(PARTITION_SCHEMA, flavor="hive"),
+        )
+        partition_dir = os.path.join(output_dir, f"pipeline={pipeline}")
+        staged_partition_dir = os.path.join(staging_dir, f"pipeline={pipeline}")
+        if os.path.exists(staged_partition_dir):
+            _replace_directory(staged_partition_dir, partition_dir)
+        else:
+            # No comparison left for this pipeline
+            shutil.rmtree(partition_dir, ignore_errors=True)
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+    print(f"Exported {exported} comparison rows to {output_dir}.")
+    return exported
+
+
+# Query API over the exported dataset
+def load_dataset(dataset_dir):
+    """
+    Open an exported comparison dataset without reading it into memory.
+
+    Args:
+        dataset_dir (str): Directory of the Parquet dataset.
+
+    Returns:
+        pyarrow.dataset.Dataset: Dataset partitioned by `pipeline` and `month`.
+    """
+    return ds.dataset(dataset_dir, format="parquet", partitioning=ds.partitioning(PARTITION_SCHEMA, flavor="hive"))
+
+
+def _build_filter(months=None, contains=None, **equals):
+    """
+    Build a dataset filter expression.
+
+    Args:
+        months (list, optional): Months ("YYYY-MM") to restrict to; prunes partitions.
+        contains (str, optional): Case-insensitive text searched in the content and explanation columns.
+        **equals: Column values to match exactly, e.g. section="Organs Mentioned".
+
+    Returns:
+        pyarrow.compute.Expression | None: Filter expression, or None if there is nothing to filter.
+    """
+    expression = None
+
+    def combine(condition):
+        nonlocal expression
+        expression = condition if expression is None else expression & condition
+
+    if months:
+        combine(ds.field("month").isin(list(months)))
+    for column, value in equals.items():
+        if value is not None:
+            combine(ds.field(column) == value)
+    if contains:
+        combine(
+            pc.match_substring(ds.field("new_content"), contains, ignore_case=True)
+            | pc.match_substring(ds.field("old_content"), contains, ignore_case=True)
+            | pc.match_substring(ds.field("explanation"), contains, ignore_case=True)
+        )
+    return expression
+
+
+def query_comparisons(dataset_dir, columns=None, months=None, contains=None, **equals):
+    """
+    Read the comparison rows that match the given filters.
+
+    Args:
+        dataset_dir (str): Directory of the Parquet dataset.
+        columns (list, optional): Columns to read. Defaults to all columns.
+        months (list, optional): Months ("YYYY-MM") to restrict to.
+        contains (str, optional): Case-insensitive text searched in contents and explanations.
+        **equals: Column values to match exactly.
+
+    Returns:
+        pyarrow.Table: Matching rows.
+    """
+    dataset = load_dataset(dataset_dir)
+    return dataset.to_table(columns=columns, filter=_build_filter(months, contains, **equals))
+
+
+def count_comparisons(dataset_dir, group_by=("section", "category"), months=None, contains=None, **equals):
+    """
+    Count comparison rows per group.
+
+    Example:
+        count_comparisons(path, group_by=["category"], months=["2024-11"],
+                          contains="lung", category="New Development")
+
+    Args:
+        dataset_dir (str): Directory of the Parquet dataset.
+        group_by (list): Columns to group by.
+        months (list, optional): Months ("YYYY-MM") to restrict to.
+        contains (str, optional): Case-insensitive text searched in contents and explanations.
+        **equals: Column values to match exactly.
+
+    Returns:
+        pyarrow.Table: One row per group with a `count` column, sorted by descending count.
+    """
+    group_by = list(group_by)
+    table = query_comparisons(dataset_dir, columns=group_by, months=months, contains=contains, **equals)
+    counts = table.group_by(group_by).aggregate([([], "count_all")])
+    counts = counts.rename_columns(["count" if name == "count_all" else name for name in counts.column_names])
+    return counts.sort_by([("count", "descending")])
+
+
+def main():
+    """
+    Export all comparison collections to a local Parquet dataset.
+    """
+    # MongoDB setup
+    """
+    IMPORTANT: Replace the MongoDB URI and the export directory with your actual setup.
+    """
+    uri = ""
+    db = mongo_client(uri)['ClinicalNotesReviewer']
+    export_comparisons(db, "comparison_dataset")
+
+if __name__ == "__main__":
+    main()
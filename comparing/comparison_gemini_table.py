@@ -1,89 +1,40 @@
 # Import libraries
-import google.generativeai as genai
-from datetime import datetime
-from pymongo import MongoClient
-from pymongo.server_api import ServerApi
-from dateutil import parser
-import time
+import sys
+from clients import gemini_model
+from comparison_pipeline import ComparisonPipeline, format_radiology_report
+from model_router import ModelRouter, gemini_backend
 
 # Connect to Gemini API
 """
 IMPORTANT: Replace `GEMINI_API_KEY` with your valid Gemini API key.
 This is required to authenticate requests to the generative AI model.
+The models are only created when the first comparison is requested, see clients.py.
 """
 GEMINI_API_KEY = ''
-genai.configure(api_key=GEMINI_API_KEY)
-model = genai.GenerativeModel('gemini-1.5-flash')
+MODEL_NAME = 'gemini-1.5-flash'
+CHEAP_MODEL_NAME = 'gemini-1.5-flash-8b'
+
+
+def create_router():
+    """
+    Create the model router of this pipeline and its Gemini models, see ComparisonPipeline.get_router.
+    """
+    # Send simple section comparisons to the cheaper model first, see model_router.ROUTING_CONFIG
+    return ModelRouter(
+        gemini_backend(CHEAP_MODEL_NAME, gemini_model(GEMINI_API_KEY, CHEAP_MODEL_NAME)),
+        gemini_backend(MODEL_NAME, gemini_model(GEMINI_API_KEY, MODEL_NAME))
+    )
 
 # MongoDB setup
 """
 IMPORTANT: Replace the MongoDB URI, database name (`ClinicalNotesReviewer`), and collection name (`ProcessedReports`) 
 with your actual setup. Ensure the collection name matches where you want the data to be stored.
+The client only connects when a collection is first used, see clients.py.
 """
 uri = ""
-client = MongoClient(uri, server_api=ServerApi('1'))
-db = client['ClinicalNotesReviewer']
-collection = db['processed_reports']
-comparison_collection = db['comparison_gemini_table_test']
-
-# Adjust the date format in get_reports_by_patient function
-def get_reports_by_patient():
-    """
-    Retrieve and group radiology reports by patient ID, parsing their performed date-time.
-
-    Returns:
-        dict: A dictionary where keys are patient IDs and values are lists of tuples containing
-              the performed date-time (datetime object) and the respective report (dict).
-
-    Notes:
-        - Reports with unparsable dates are skipped with a logged error.
-        - Date format assumed: "%d/%m/%Y %H:%M".
-    """
-    reports_by_patient = {}
-    reports = collection.find({})
-
-    for report in reports:
-        try:
-            # Parse using explicit date format to prevent issues
-            performed_date_time = datetime.strptime(report['Performed Date Time'], "%d/%m/%Y %H:%M")
-            patient_id = report['PatientID']
-
-            if patient_id not in reports_by_patient:
-                reports_by_patient[patient_id] = []
-            reports_by_patient[patient_id].append((performed_date_time, report))
-        except ValueError as e:
-            print(f"Error parsing date for report {report['_id']}: {e}")
-            continue
-
-    return reports_by_patient
-
-# Function to format radiology report
-def format_radiology_report(report):
-    """
-    Format a radiology report for display and extract summarized processed data.
-
-    Args:
-        report (dict): A single radiology report containing raw and processed data.
-
-    Returns:
-        tuple: 
-            - str: Formatted report string.
-            - dict: Processed data summary with keys "Diseases Mentioned",
-                    "Organs Mentioned", and "Symptoms/Phenomena of Concern".
-    """
-    formatted_report = (
-        f"Patient ID: {report['Raw Report']['Masked_PatientID']}, Performed Date: {report['Performed Date Time']}\n\n"
-        f"Raw Radiology Report Extracted\n"
-        f"Text: {report['Raw Report']['Text'].strip()}\n\n"
-    )
-
-    processed_data = {
-        "Diseases Mentioned": report['Processed Data']['Summary'].get('Diseases Mentioned', ""),
-        "Organs Mentioned": report['Processed Data']['Summary'].get('Organs Mentioned', ""),
-        "Symptoms/Phenomena of Concern": report['Processed Data']['Summary'].get('Symptoms/Phenomena of Concern', "")
-    }
-
-    return formatted_report, processed_data
+DATABASE_NAME = 'ClinicalNotesReviewer'
+COLLECTION_NAME = 'processed_reports'
+COMPARISON_COLLECTION_NAME = 'comparison_gemini_table_test'
 
 
 def generate_comparison_prompt(section_name, section_content_1, section_content_2, date1_str, date2_str):
@@ -171,157 +122,20 @@ def generate_comparison_prompt(section_name, section_content_1, section_content_
     )
     return prompt
 
-def compare_section(section_name, content1, content2, date1, date2):
-
-    date1_str = date1.strftime("%d/%m/%Y %H:%M:%S")
-    date2_str = date2.strftime("%d/%m/%Y %H:%M:%S")
-    prompt = generate_comparison_prompt(section_name, content1, content2, date1_str, date2_str)
-
-    retries = 3  # Number of retries for the API call
-    for attempt in range(retries):
-        try:
-            response = model.generate_content(prompt)
-            print(f"AI Response for '{section_name}': {response.text}")
-            if hasattr(response, 'text') and response.text:
-                comparison_output = response.text.strip()
-                
-                # Parse the response into structured format
-                def parse_comparison_headers(comparison_string):
-                    lines = comparison_string.strip().split("\n")
-                    headers = [header.strip() for header in lines[0].split("|")[1:-1]]
-                    comparison_list = []
-                    
-                    for line in lines[2:]:
-                        parts = line.split("|")
-                        comparison_entry = {headers[i]: parts[i+1].strip() for i in range(len(headers))}
-                        comparison_list.append(comparison_entry)
-                    
-                    print(f"comparison_list: {comparison_list}")
-                    return comparison_list
-
-                structured_comparison = parse_comparison_headers(comparison_output)
-                return structured_comparison
-            else:
-                return []
-        except Exception as e:
-            if "429" in str(e):
-                print(f"API quota exceeded. Retrying in 30 seconds... (Attempt {attempt + 1}/{retries})")
-                time.sleep(30)
-            else:
-                print(f"Error generating comparison for section '{section_name}': {e}")
-                return []
-    return []
-
-# Function to compare multiple reports
-def compare_multiple_reports(reports):
-    reports.sort(key=lambda x: x[0], reverse=True)
-    base_report = reports[0]
-    all_comparisons = []
-
-    for i in range(1, len(reports)):
-        report = reports[i]
-        base_text, base_sections = format_radiology_report(base_report[1])
-        report_text, report_sections = format_radiology_report(report[1])
-
-        # loop through comparison prompt for each section
-        for section_name in base_sections.keys():
-            # Debug prints
-            print(f"Base section ({section_name}): {base_sections.get(section_name)}")
-            print(f"Report section ({section_name}): {report_sections.get(section_name)}")
-
-            comparison_result = compare_section(
-                section_name,
-                base_sections[section_name],
-                report_sections[section_name],
-                base_report[0],
-                report[0]
-            )
-            # Add the Section attribute to each comparison result and ensure it appears first
-            for comparison in comparison_result:
-                comparison = {
-                    "Section": section_name, 
-                    **comparison,
-                    'New Report Date': base_report[0],
-                    'Old Report Date': report[0],
-                    'New Report Order ID': base_report[1]['Raw Report']['Order ID'],  
-                    'Old Report Order ID': report[1]['Raw Report']['Order ID'],       
-                    'New Report Order Name': base_report[1]['Raw Report']['Order Name'],
-                    'Old Report Order Name': report[1]['Raw Report']['Order Name'], }
-                
-                all_comparisons.append(comparison)
-
-    return all_comparisons
-
-# Save comparisons to MongoDB
-def save_comparisons(patient_id, report_dates, comparisons):
-    output = {
-        "PatientID": patient_id,
-        "ReportDates": [date.strftime("%Y-%m-%d %H:%M:%S") for date in report_dates],
-        "Comparisons": comparisons
-    }
-    comparison_collection.update_one(
-        {"PatientID": patient_id},
-        {"$set": output},
-        upsert=True
-    )
-    print(f"Saved comparisons for PatientID {patient_id}.")
-
-
-def main():
-    reports_by_patient = get_reports_by_patient()
-
-    for patient_id, reports in reports_by_patient.items():
-        # Sort reports by performed date time in ascending order
-        reports.sort(key=lambda x: x[0])  # Sort by datetime
-
-        # Consider cases whereby there is only 1 report for the patient
-        if len(reports) == 1:
-            print(f"Only one report available for PatientID {patient_id}. No comparison will be generated.")
-
-            # Create a simple JSON output for patients with only one report
-            single_report_output = {
-                "PatientID": patient_id,
-                "ComparisonResults": "No comparison available as there is only one report for this patient."
-            }
-
-            # Save to MongoDB
-            comparison_collection.update_one(
-                {"PatientID": patient_id},  
-                {"$set": single_report_output},
-                upsert=True
-            )
-            continue
-
-        # If there are more than 5 reports, only keep the latest 5
-        if len(reports) > 5:
-            reports = reports[-5:]
-
-        # Get the latest report date in the current reports list
-        latest_report_date = reports[-1][0]
-
-        # Check if there's already a comparison output for this patient
-        existing_comparison = comparison_collection.find_one({"PatientID": patient_id})
-
-        if existing_comparison:
-            # Convert dates from existing comparison to datetime objects for comparison
-            existing_dates = [parser.parse(date_str) for date_str in existing_comparison.get("ReportDates", [])]
-
-            # Find the latest date in the existing comparison output
-            latest_existing_date = max(existing_dates) if existing_dates else None
-
-            # Check if there's a new report by comparing dates
-            if latest_existing_date and latest_existing_date >= latest_report_date:
-                print(f"No new reports for PatientID {patient_id}. Skipping comparison.")
-                continue
-
-        # Perform comparison since either there’s no existing comparison or new reports are present
-        comparison_results = compare_multiple_reports(reports)
 
-        # Collect report dates for saving in the JSON output
-        report_dates = [report[0] for report in reports]
+# The comparison steps are shared by every pipeline, see comparison_pipeline.py
+PIPELINE = ComparisonPipeline(sys.modules[__name__], generate_comparison_prompt, create_router, "gemini")
 
-        # Save comparison output to MongoDB
-        save_comparisons(patient_id, report_dates, comparison_results)
+get_router = PIPELINE.get_router
+get_db = PIPELINE.get_db
+get_collection = PIPELINE.get_collection
+get_comparison_collection = PIPELINE.get_comparison_collection
+get_reports_by_patient = PIPELINE.get_reports_by_patient
+compare_section = PIPELINE.compare_section
+compare_multiple_reports = PIPELINE.compare_multiple_reports
+save_comparisons = PIPELINE.save_comparisons
+compare_patient = PIPELINE.compare_patient
+main = PIPELINE.main
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,169 @@
+# Import libraries
+import os
+import sys
+from functools import lru_cache
+from clients import azure_chat_model, load_environment
+from comparison_pipeline import ComparisonPipeline, format_radiology_report
+from model_router import ModelRouter, langchain_backend
+
+"""
+GPT version of the table comparison pipeline, also available as comparison_gpt_table.ipynb.
+
+The Azure OpenAI settings are read from the environment file `.env` (OPENAI_API_KEY,
+OPENAI_API_BASE and the optional OPENAI_CHAT_* variables). The file is only loaded and the
+chat models are only created when the first comparison is requested, see clients.py.
+"""
+ENV_FILE = '.env'
+
+
+@lru_cache(maxsize=None)
+def get_chat_settings():
+    """
+    Load the environment file and read the chat variables.
+
+    Returns:
+        dict: API version, deployment and temperature of the chat models.
+    """
+    load_environment(ENV_FILE)
+    return {
+        "api_version": os.environ.get("OPENAI_CHAT_API_VERSION", "2023-05-15"),
+        "deployment": os.environ.get("OPENAI_CHAT_DEPLOYMENT", "gpt-35-turbo"),
+        "temperature": float(os.environ.get("OPENAI_CHAT_TEMPERATURE", "0.0")),
+    }
+
+
+def create_router():
+    """
+    Create the model router of this pipeline and its chat models, see ComparisonPipeline.get_router.
+    """
+    settings = get_chat_settings()
+
+    # gpt 3.5 deployment, used for simple comparisons
+    llm = azure_chat_model(
+        settings["deployment"], api_version=settings["api_version"], temperature=settings["temperature"]
+    )
+
+    # this is the gpt 4o model
+    chat = azure_chat_model(
+        "genai-GPT4o", model_name="gpt-4o", api_version=settings["api_version"], temperature=settings["temperature"]
+    )
+
+    # Send simple section comparisons to gpt 3.5 first and escalate to gpt 4o, see model_router.ROUTING_CONFIG
+    return ModelRouter(
+        langchain_backend(settings["deployment"], llm),
+        langchain_backend("genai-GPT4o", chat)
+    )
+
+# MongoDB setup
+"""
+IMPORTANT: Replace the MongoDB URI, database name (`ClinicalNotesReviewer`), and collection name (`ProcessedReports`) 
+with your actual setup. Ensure the collection name matches where you want the data to be stored.
+The client only connects when a collection is first used, see clients.py.
+"""
+uri = ""
+DATABASE_NAME = 'ClinicalNotesReviewer'
+COLLECTION_NAME = 'processed_reports'
+COMPARISON_COLLECTION_NAME = 'comparison_gpt_table_test'
+
+template_prompt = """
+    You are comparing two radiology reports in the section '{section_name}', where the content is provided as key-value pairs.\n\n
+    
+    ### Structure of Input:\n
+    The input consists of observations represented as key-value pairs:\n
+    In this comparison, the input for the Newer Report ({date1_str}) is: {section_content_1}\n
+    and the input for the Older Report ({date2_str}) is: {section_content_2}\n\n
+
+    ### Special Cases:\n
+    1. **Both Reports Are Empty:**\n
+       - If there are no key-value pairs in both the Newer Report and Older Report, output *Both report sections are empty*.\n\n
+    2. **Newer Report is Empty, Older Report Has Key-Value Pairs:**\n
+       - If the Newer Report contains no key-value pairs, but the Older Report does:\n
+         - Categorize each key-value pair in the Older Report as **No Longer Mentioned**.\n
+         - Use 'NIL' as the content for '{date1_str} Content'.\n
+         - Use the values from the Older Report for '{date2_str} Content'.\n\n
+
+    ### Comparison Instructions:\n
+    Follow the step-by-step logic to compare the key-value pairs from the two reports:\n\n
+    1. **Comparison Flow:**\n
+       - Compare each key in the Newer Report ({date1_str}) against all keys in the Older Report ({date2_str}).\n
+       - Treat keys that are phrased **similarly** or refer to the same concept as being the **same key**.\n\n
+
+    2. **Categorization Logic:**\n
+       - **CASE 1: Difference**\n
+         - If a key in the Newer Report matches a key in the Older Report (or is phrased similarly):\n
+           - Use the value from the Newer Report as '{date1_str} Content'.\n
+           - Use the value from the Older Report as '{date2_str} Content'.\n
+           - If the value from the Newer Report is the same or similar to the value of the Older Report (e.g., both values are 'Enlarged'): Categorized as **Difference**.\n\n
+           - Else, DO NOT categorise as **Difference** and move on to the next key-value pair in Newer Report.\n\n
+       - **CASE 2: New Development**\n
+         - If the key in the Newer Report is **not present** in the Older Report (and no similar key exists):\n
+           - Use the value from the Newer Report as '{date1_str} Content'.\n
+           - Use 'NIL' for '{date2_str} Content'.\n
+           - Categorize as **New Development**.\n\n
+       - **CASE 3: No Longer Mentioned**\n
+         - After processing all keys from the Newer Report, check the Older Report for any unused key-value pairs.\n
+           - For each unused key-value pair:\n
+             - Use 'NIL' for '{date1_str} Content'.\n
+             - Use the value from the Older Report as '{date2_str} Content'.\n
+             - Categorize as **No Longer Mentioned**.\n\n
+
+    3. **Key Similarity Clarification:**\n
+       - Keys that are similar in meaning or phrasing (e.g., 'Minor atelectasis' and 'Atelectasis (lung collapse)') must be treated as the **same key**.\n
+       - These comparisons must always be categorized as **Difference** ONLY IF their values differ (e.g., both values are 'Enlarged').\n\n
+
+    4. **Output Format:**\n
+    Do not output irrelevant text like: Here's the comparison of the two radiology reports following the provided logic, output only the table.
+    f
+    Present the comparison results in the following table format:\n"
+    | Category            | {date1_str} Content                      | {date2_str} Content                      | Explanation                         |\n
+    |---------------------|------------------------------------------|------------------------------------------|-------------------------------------|\n
+    | Difference          | {{Newer Report Value}}                   | {{Older Report Value}}                   | Explanation of the difference.      |\n
+    | New Development     | {{Newer Report Value}}                   | NIL                                      | Explanation of new observation.     |\n
+    | No Longer Mentioned | NIL                                      | {{Older Report Value}}                   | Explanation of removal or absence.  |\n\n
+    
+    ### Important Rules:\n
+    1. Do **not** interpret or infer any information that is not explicitly stated in the provided key-value pairs.\n
+    2. Treat similar keys as the **same key** and strictly follow the comparison flow and categorization rules.\n
+    3. Use the exact wording from the reports for {date1_str} Content and {date2_str} Content.\n
+    4. Make sure there is no duplication of entries across categories.\n\n
+    Please proceed with the comparison following the above logic strictly.
+"""
+
+
+def generate_comparison_prompt(section_name, section_content_1, section_content_2, date1_str, date2_str):
+    """
+    Fill in `template_prompt` for one section of a report pair.
+
+    Same signature as the Gemini pipelines, so the asynchronous mode and the service can use it.
+    """
+    # Imported here so the pipeline can be imported without loading langchain
+    from langchain.prompts import PromptTemplate
+
+    prompt_t = PromptTemplate.from_template(template_prompt)
+
+    # Fill in the PromptTemplate; the router picks the model
+    return prompt_t.format(
+        section_name=section_name,
+        section_content_1=section_content_1,
+        section_content_2=section_content_2,
+        date1_str=date1_str,
+        date2_str=date2_str
+    )
+
+
+# The comparison steps are shared by every pipeline, see comparison_pipeline.py
+PIPELINE = ComparisonPipeline(sys.modules[__name__], generate_comparison_prompt, create_router, lambda: get_chat_settings()["deployment"])
+
+get_router = PIPELINE.get_router
+get_db = PIPELINE.get_db
+get_collection = PIPELINE.get_collection
+get_comparison_collection = PIPELINE.get_comparison_collection
+get_reports_by_patient = PIPELINE.get_reports_by_patient
+compare_section = PIPELINE.compare_section
+compare_multiple_reports = PIPELINE.compare_multiple_reports
+save_comparisons = PIPELINE.save_comparisons
+compare_patient = PIPELINE.compare_patient
+main = PIPELINE.main
+
+if __name__ == "__main__":
+    main()
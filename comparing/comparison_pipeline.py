@@ -0,0 +1,289 @@
+# Import libraries
+import threading
+from clients import mongo_client
+from comparison_records import (
+    ComparisonRecord,
+    build_comparison_document,
+    build_single_report_document,
+    ensure_indexes,
+    latest_compared_date,
+    parse_comparison_table,
+    save_comparison_document,
+)
+from comparison_scheduler import schedule_patients
+from model_router import call_with_quota_retries, section_entry_count
+from profiling import span, traced
+from request_packing import ComparisonUnit, compare_units_packed
+from sharding import shard_assignment_from_env
+from text_storage import TextStorage
+
+"""
+Batch comparison logic shared by comparison_gemini_table.py, comparison_gemini_sectioned.py
+and comparison_gpt_table.py.
+
+Each pipeline module only keeps what differs between them: its MongoDB settings, its prompt
+builder and its pair of models. It creates one `ComparisonPipeline` from those and exposes the
+pipeline's methods under the usual module-level names (`get_router`, `get_db`, `compare_section`,
+`main`, ...), so the notebooks, the asynchronous mode and the service keep using the module.
+
+The MongoDB settings (`uri`, `DATABASE_NAME`, `COLLECTION_NAME`, `COMPARISON_COLLECTION_NAME`)
+are read from the pipeline module on every use, so a notebook can still set `pipeline.uri`
+before calling `pipeline.main()`.
+"""
+
+DATE_FORMAT = "%d/%m/%Y %H:%M:%S"
+
+# Number of newest reports of a patient that are compared
+MAX_REPORTS = 5
+
+
+# Function to format radiology report
+def format_radiology_report(report):
+    """
+    Format a radiology report for display and extract summarized processed data.
+
+    Args:
+        report (dict): A single radiology report containing raw and processed data.
+
+    Returns:
+        tuple:
+            - str: Formatted report string.
+            - dict: Processed data summary with keys "Diseases Mentioned",
+                    "Organs Mentioned", and "Symptoms/Phenomena of Concern".
+    """
+    formatted_report = (
+        f"Patient ID: {report['Raw Report']['Masked_PatientID']}, Performed Date: {report['Performed Date Time']}\n\n"
+        f"Raw Radiology Report Extracted\n"
+        f"Text: {report['Raw Report']['Text'].strip()}\n\n"
+    )
+
+    processed_data = {
+        "Diseases Mentioned": report['Processed Data']['Summary'].get('Diseases Mentioned', ""),
+        "Organs Mentioned": report['Processed Data']['Summary'].get('Organs Mentioned', ""),
+        "Symptoms/Phenomena of Concern": report['Processed Data']['Summary'].get('Symptoms/Phenomena of Concern', "")
+    }
+
+    return formatted_report, processed_data
+
+
+class ComparisonPipeline:
+    """
+    One batch comparison pipeline: its collections, model router and comparison steps.
+
+    Args:
+        settings (module): Pipeline module holding the MongoDB settings, read on every use.
+        generate_comparison_prompt (callable): `generate_comparison_prompt(section_name, content1,
+                                               content2, date1_str, date2_str)` of the pipeline.
+        create_router (callable): Function creating the pipeline's `ModelRouter` (its cheap and
+                                  strong models), called once on first use.
+        packing_backend (str | callable): Model name used to count tokens when packing requests,
+                                          or a function returning it, see model_router.estimate_tokens.
+    """
+
+    def __init__(self, settings, generate_comparison_prompt, create_router, packing_backend="gemini"):
+        self.settings = settings
+        self.generate_comparison_prompt = generate_comparison_prompt
+        self.create_router = create_router
+        self.packing_backend = packing_backend
+        self._router = None
+        self._lock = threading.Lock()
+
+    def get_router(self):
+        """
+        Get the model router of this pipeline, creating its models on first use.
+        """
+        if self._router is None:
+            with self._lock:
+                if self._router is None:
+                    self._router = self.create_router()
+        return self._router
+
+    def get_packing_backend(self):
+        """
+        Get the model name used to count tokens when packing requests, see request_packing.pack_units.
+        """
+        return self.packing_backend() if callable(self.packing_backend) else self.packing_backend
+
+    def get_db(self):
+        return mongo_client(self.settings.uri)[self.settings.DATABASE_NAME]
+
+    def get_collection(self):
+        return self.get_db()[self.settings.COLLECTION_NAME]
+
+    def get_comparison_collection(self):
+        return self.get_db()[self.settings.COMPARISON_COLLECTION_NAME]
+
+    def get_reports_by_patient(self, query=None):
+        """
+        Index radiology reports by patient ID, parsing their performed date-time.
+
+        Args:
+            query (dict, optional): MongoDB filter restricting the reports, e.g. to this worker's shards.
+
+        Returns:
+            ReportStore: Patient IDs mapped to `PatientReports` views of their reports, sorted by date.
+                         The full reports are only fetched from MongoDB for patients being compared.
+
+        Notes:
+            - Reports with unparsable dates are skipped with a logged error.
+            - Date format assumed: "%d/%m/%Y %H:%M".
+        """
+        # NumPy is only imported once the reports are loaded, see startup_benchmark.py
+        from report_store import ReportStore
+
+        # Only decompress the fields the comparisons read, once the reports are fetched
+        return ReportStore.load(self.get_collection(), TextStorage.for_database(self.get_db()), query)
+
+    def compare_section(self, section_name, content1, content2, date1, date2):
+        """
+        Compare a specific section between two radiology reports.
+
+        Args:
+            section_name (str): Name of the section to compare.
+            content1 (dict): Content of the section in the newer report.
+            content2 (dict): Content of the section in the older report.
+            date1 (datetime): Date of the newer report.
+            date2 (datetime): Date of the older report.
+
+        Returns:
+            list: Structured comparison results as a list of (category, new content, old content,
+                  explanation) tuples. Empty if the comparison could not be generated.
+        """
+        prompt = self.generate_comparison_prompt(
+            section_name, content1, content2, date1.strftime(DATE_FORMAT), date2.strftime(DATE_FORMAT)
+        )
+        comparison_output = call_with_quota_retries(
+            lambda: self.get_router().generate(prompt, section_entry_count(content1, content2)),
+            f"comparison for section '{section_name}'"
+        )
+        if not comparison_output:
+            return []
+
+        # Parse the response into positional (category, new, old, explanation) rows
+        return parse_comparison_table(comparison_output)
+
+    @traced("compare_multiple_reports")
+    def compare_multiple_reports(self, reports):
+        """
+        Compare the newest report of a patient with each older one, section by section.
+
+        Args:
+            reports (list): A list of tuples, each containing a datetime object and a report dictionary.
+
+        Returns:
+            list: ComparisonRecord objects across all sections for all report pairs.
+        """
+        reports.sort(key=lambda x: x[0], reverse=True)
+        base_report = reports[0]
+        _, base_sections = format_radiology_report(base_report[1])
+
+        # Collect one comparison unit per section of each report pair
+        units = []
+        for report in reports[1:]:
+            _, report_sections = format_radiology_report(report[1])
+            for section_name in base_sections.keys():
+                units.append(ComparisonUnit(
+                    section_name, base_report, report, base_sections[section_name], report_sections[section_name]
+                ))
+
+        # Pack the units into as few requests as the token budget allows, see request_packing.PACKING_CONFIG
+        all_comparisons = []
+        for unit, comparison_result in compare_units_packed(
+            units, self.get_router(), self.compare_section, self.generate_comparison_prompt,
+            backend=self.get_packing_backend()
+        ):
+            # Build a canonical record for each row, tagged with its section and both reports
+            for row in comparison_result:
+                all_comparisons.append(ComparisonRecord.from_reports(unit.section_name, row, unit.new_report, unit.old_report))
+
+        return all_comparisons
+
+    # Save comparisons to MongoDB
+    @traced("save_comparisons")
+    def save_comparisons(self, patient_id, report_dates, comparisons):
+        output = build_comparison_document(patient_id, report_dates, comparisons)
+        if save_comparison_document(self.get_comparison_collection(), output):
+            print(f"Saved comparisons for PatientID {patient_id}.")
+
+    def compare_patient(self, patient_id, reports, comparison_collection):
+        """
+        Compare the latest reports of one patient and save the result, unless it is up to date.
+
+        Args:
+            patient_id (str): ID of the patient.
+            reports (PatientReports): The patient's reports, sorted by performed date time in ascending order.
+            comparison_collection (Collection): Collection of stored comparisons.
+        """
+        # Consider cases whereby there is only 1 report for the patient
+        if len(reports) == 1:
+            print(f"Only one report available for PatientID {patient_id}. No comparison will be generated.")
+            save_comparison_document(comparison_collection, build_single_report_document(patient_id, reports.latest_date()))
+            return
+
+        # If there are more than 5 reports, only keep the latest 5
+        reports = reports.latest(MAX_REPORTS)
+
+        # Skip the patient if the stored comparison already covers the newest report
+        existing_comparison = comparison_collection.find_one({"PatientID": patient_id})
+        if existing_comparison:
+            latest_existing_date = latest_compared_date(existing_comparison)
+            if latest_existing_date and latest_existing_date >= reports.latest_date():
+                print(f"No new reports for PatientID {patient_id}. Skipping comparison.")
+                return
+
+        # Fetch the full reports only now that a comparison is needed; some may have been deleted since
+        reports = reports.load()
+        if not reports:
+            print(f"Reports of PatientID {patient_id} were deleted. Skipping comparison.")
+            return
+        if len(reports) == 1:
+            print(f"Only one report available for PatientID {patient_id}. No comparison will be generated.")
+            save_comparison_document(comparison_collection, build_single_report_document(patient_id, reports[0][0]))
+            return
+
+        comparison_results = self.compare_multiple_reports(reports)
+        self.save_comparisons(patient_id, [report[0] for report in reports], comparison_results)
+
+    def main(self):
+        """
+        Compare the reports of every patient and save the results to MongoDB.
+
+        Workflow:
+            - Claim this worker's next shards when SHARD_COUNT is set, see sharding.py.
+            - Index the reports by patient.
+            - Compare urgent and recent patients first, see comparison_scheduler.PRIORITY_CONFIG.
+            - Save each patient's comparisons to MongoDB.
+            - Mark the shards done and claim more, until no unfinished shard is left.
+        """
+        # Only process this worker's shards of the patients when SHARD_COUNT is set, see sharding.py
+        shard = shard_assignment_from_env(self.get_db())
+        comparison_collection = self.get_comparison_collection()
+
+        # The idempotent saves rely on the unique PatientID index, see comparison_records.ensure_indexes
+        ensure_indexes(comparison_collection)
+
+        try:
+            # Without sharding, every patient is compared in a single round
+            while shard is None or shard.claim():
+                with span("load_reports"):
+                    reports_by_patient = self.get_reports_by_patient(shard.query() if shard is not None else None)
+
+                for patient_id, reports in schedule_patients(reports_by_patient):
+                    if shard is not None:
+                        # Renew leases, and skip patients of shards lost or not yet backfilled
+                        shard.keep_alive()
+                        if not shard.owns_patient(patient_id):
+                            continue
+
+                    with span("patient", patient_id=patient_id, reports=len(reports)):
+                        self.compare_patient(patient_id, reports, comparison_collection)
+
+                if shard is None:
+                    break
+                shard.mark_done()
+        finally:
+            if shard is not None:
+                shard.release()
+
+        # Report calls per model and the escalation rate of the run
+        self.get_router().print_stats()
@@ -0,0 +1,584 @@
+# Import libraries
+import hashlib
+import json
+import re
+from dataclasses import dataclass
+from datetime import datetime
+from profiling import traced
+from text_storage import TextStorage
+
+"""
+Canonical comparison record shared by comparison_gemini_table.py, comparison_gemini_sectioned.py
+and comparison_gpt_table.ipynb.
+
+Every pipeline stores a patient's comparisons as one document of fixed shape:
+
+    {
+        "PatientID": "Patient123",
+        "SchemaVersion": 2,
+        "ReportDates": [datetime, ...],
+        "LatestReportDate": datetime,
+        "ComparisonHash": "<sha256>",
+        "Comparisons": [
+            {"Section": ..., "Category": ..., "NewContent": ..., "OldContent": ..., "Explanation": ...,
+             "New Report Date": datetime, "Old Report Date": datetime,
+             "New Report Order ID": ..., "Old Report Order ID": ...,
+             "New Report Order Name": ..., "Old Report Order Name": ...},
+            ...
+        ]
+    }
+
+Patients with a single report store an empty `Comparisons` list and a `Message`.
+`ComparisonHash` is set when the document is saved, so readers can tell whether it changed
+without fetching and hashing it, see `comparison_document_hash`.
+"""
+
+SCHEMA_VERSION = 2
+DATE_FORMAT = "%d/%m/%Y %H:%M:%S"
+
+# Date formats used by documents written before the canonical schema
+LEGACY_DATE_FORMATS = ("%d/%m/%Y %H:%M:%S", "%Y-%m-%d %H:%M:%S", "%d/%m/%Y %H:%M")
+
+SECTIONS = ("Diseases Mentioned", "Organs Mentioned", "Symptoms/Phenomena of Concern")
+
+SINGLE_REPORT_MESSAGE = "No comparison available as there is only one report for this patient."
+
+# Categories of the comparison prompts, in canonical spelling
+CATEGORIES = ("Difference", "New Development", "No Longer Mentioned")
+CANONICAL_CATEGORIES = {category.lower(): category for category in CATEGORIES}
+
+# Comparison collections written by each pipeline
+"""
+IMPORTANT: Keep these collection names in sync with the `COMPARISON_COLLECTION_NAME` of
+comparison_gemini_table.py, comparison_gemini_sectioned.py and comparison_gpt_table.py.
+"""
+PIPELINE_COLLECTIONS = {
+    "gemini_table": "comparison_gemini_table_test",
+    "gemini_sectioned": "comparison_gemini_sectioned_test",
+    "gpt_table": "comparison_gpt_table_test",
+}
+
+# Mapping of record attributes to the keys stored in MongoDB
+DATE_ATTRIBUTES = ("new_report_date", "old_report_date")
+FIELD_KEYS = {
+    "section": "Section",
+    "category": "Category",
+    "new_content": "NewContent",
+    "old_content": "OldContent",
+    "explanation": "Explanation",
+    "new_report_date": "New Report Date",
+    "old_report_date": "Old Report Date",
+    "new_order_id": "New Report Order ID",
+    "old_order_id": "Old Report Order ID",
+    "new_order_name": "New Report Order Name",
+    "old_order_name": "Old Report Order Name",
+}
+
+
+def normalize_category(category):
+    """
+    Normalize a category written by the model, e.g. "**Difference**" or " difference ".
+
+    Markdown emphasis and surrounding whitespace are removed, and known categories are mapped
+    to their canonical spelling in `CATEGORIES`. Unknown categories are kept, cleaned.
+
+    Args:
+        category (str): Category as written by the model.
+
+    Returns:
+        str: The normalized category.
+    """
+    cleaned = " ".join(re.sub(r"[*_`]", "", str(category or "")).split())
+    return CANONICAL_CATEGORIES.get(cleaned.lower(), cleaned)
+
+
+@dataclass(slots=True)
+class ComparisonRecord:
+    """
+    One categorized difference between the same section of two radiology reports.
+    """
+    section: str
+    category: str
+    new_content: str
+    old_content: str
+    explanation: str
+    new_report_date: datetime
+    old_report_date: datetime
+    new_order_id: str = ""
+    old_order_id: str = ""
+    new_order_name: str = ""
+    old_order_name: str = ""
+
+    @classmethod
+    def from_reports(cls, section_name, row, new_report, old_report):
+        """
+        Build a record from a parsed table row and the two compared reports.
+
+        Args:
+            section_name (str): Name of the compared section.
+            row (tuple): (category, new content, old content, explanation) from `parse_comparison_table`.
+            new_report (tuple): (datetime, report dict) of the newer report.
+            old_report (tuple): (datetime, report dict) of the older report.
+
+        Returns:
+            ComparisonRecord: The canonical record.
+        """
+        category, new_content, old_content, explanation = row
+        return cls(
+            section=section_name,
+            category=normalize_category(category),
+            new_content=new_content,
+            old_content=old_content,
+            explanation=explanation,
+            new_report_date=new_report[0],
+            old_report_date=old_report[0],
+            new_order_id=str(new_report[1]['Raw Report'].get('Order ID', "")),
+            old_order_id=str(old_report[1]['Raw Report'].get('Order ID', "")),
+            new_order_name=new_report[1]['Raw Report'].get('Order Name', ""),
+            old_order_name=old_report[1]['Raw Report'].get('Order Name', ""),
+        )
+
+    @classmethod
+    def from_document(cls, document):
+        """
+        Build a record from a stored comparison entry. Missing dates are None, other missing
+        fields are empty strings.
+
+        Args:
+            document (dict): Comparison entry using the keys of `FIELD_KEYS`.
+
+        Returns:
+            ComparisonRecord: The canonical record.
+        """
+        record = cls(**{
+            attribute: document.get(key, None if attribute in DATE_ATTRIBUTES else "")
+            for attribute, key in FIELD_KEYS.items()
+        })
+        record.category = normalize_category(record.category)
+        return record
+
+    def to_document(self):
+        """
+        Convert the record into the dictionary stored in MongoDB.
+
+        Returns:
+            dict: Comparison entry using the keys of `FIELD_KEYS`.
+        """
+        return {key: getattr(self, attribute) for attribute, key in FIELD_KEYS.items()}
+
+
+# Function to parse the markdown table returned by the model
+@traced("parse_comparison_table", "parse")
+def parse_comparison_table(comparison_string):
+    """
+    Parse the markdown comparison table returned by the model into positional rows.
+
+    The header row (which contains the report dates) and the separator row are skipped,
+    so the rows can be read without rebuilding the dated column names. Lines that are
+    not table rows with exactly four cells (e.g. "*Both report sections are empty*")
+    are ignored.
+
+    Args:
+        comparison_string (str): Raw model output.
+
+    Returns:
+        list: A list of (category, new content, old content, explanation) tuples.
+    """
+    rows = []
+    header_seen = False
+
+    for line in comparison_string.strip().split("\n"):
+        line = line.strip()
+        if not line.startswith("|"):
+            continue
+
+        cells = [cell.strip() for cell in line.strip("|").split("|")]
+        if not header_seen:
+            header_seen = True
+            continue
+        if all(set(cell) <= set("-: ") for cell in cells):
+            continue
+        if len(cells) != 4:
+            print(f"Skipping malformed comparison row: {line}")
+            continue
+
+        rows.append(tuple(cells))
+
+    return rows
+
+
+def parse_report_date(value):
+    """
+    Parse a stored report date that may be a datetime or a string in a legacy format.
+
+    Args:
+        value (datetime | str): Stored date value.
+
+    Returns:
+        datetime | None: Parsed date, or None if it cannot be parsed.
+    """
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, str):
+        for date_format in LEGACY_DATE_FORMATS:
+            try:
+                return datetime.strptime(value, date_format)
+            except ValueError:
+                continue
+    return None
+
+
+def latest_compared_date(document):
+    """
+    Return the latest report date recorded in a stored comparison document.
+
+    Args:
+        document (dict): Stored comparison document (canonical or legacy).
+
+    Returns:
+        datetime | None: The latest report date, or None if no date is recorded.
+    """
+    dates = [parse_report_date(value) for value in document.get("ReportDates", [])]
+    dates = [date for date in dates if date is not None]
+    return max(dates) if dates else None
+
+
+def build_comparison_document(patient_id, report_dates, records):
+    """
+    Build the canonical comparison document for a patient.
+
+    Args:
+        patient_id (str): ID of the patient.
+        report_dates (list): Dates of the compared reports.
+        records (list): ComparisonRecord objects.
+
+    Returns:
+        dict: Document ready to be stored in MongoDB.
+    """
+    report_dates = list(report_dates)
+    return {
+        "PatientID": patient_id,
+        "SchemaVersion": SCHEMA_VERSION,
+        "ReportDates": report_dates,
+        "LatestReportDate": max(report_dates) if report_dates else None,
+        "Comparisons": [record.to_document() for record in records],
+    }
+
+
+def build_single_report_document(patient_id, report_date):
+    """
+    Build the canonical document for a patient with only one report.
+
+    Args:
+        patient_id (str): ID of the patient.
+        report_date (datetime): Date of the only report.
+
+    Returns:
+        dict: Document ready to be stored in MongoDB.
+    """
+    document = build_comparison_document(patient_id, [report_date], [])
+    document["Message"] = SINGLE_REPORT_MESSAGE
+    return document
+
+
+def comparison_document_hash(document):
+    """
+    Hash the contents of a comparison document.
+
+    Args:
+        document (dict): Comparison document, with its contents resolved.
+
+    Returns:
+        str: Hex SHA-256 of every field but `_id` and `ComparisonHash`.
+    """
+    payload = {key: value for key, value in document.items() if key not in ("_id", "ComparisonHash")}
+    encoded = json.dumps(payload, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+def with_comparison_hash(document):
+    """
+    Return a copy of a comparison document carrying its `ComparisonHash`, before it is saved.
+    """
+    return {**document, "ComparisonHash": comparison_document_hash(document)}
+
+
+# Migration of documents written before the canonical schema
+def _legacy_table_contents(entry, new_date, old_date):
+    """
+    Read the new and old content of a legacy table entry, whose column names embed the dates.
+    """
+    content_keys = [key for key in entry if key.endswith(" Content")]
+    new_key = f"{new_date.strftime(DATE_FORMAT)} Content" if new_date else None
+    old_key = f"{old_date.strftime(DATE_FORMAT)} Content" if old_date else None
+
+    # Fall back to column order (newer report first) when the dated keys are missing
+    if new_key not in entry:
+        new_key = content_keys[0] if content_keys else None
+    if old_key not in entry:
+        old_key = content_keys[1] if len(content_keys) > 1 else None
+
+    return entry.get(new_key, ""), entry.get(old_key, "")
+
+
+def records_from_document(document):
+    """
+    Read the comparison records of a stored document, whatever layout it was written in.
+
+    Supported layouts:
+        - Canonical: `Comparisons` is a list of entries using `FIELD_KEYS`.
+        - Legacy table: entries carry dated content columns ("<date> Content").
+        - Legacy sectioned: `Comparisons` is a list of date pairs holding `Sections`.
+
+    Args:
+        document (dict): Stored comparison document.
+
+    Returns:
+        list: ComparisonRecord objects.
+    """
+    comparisons = document.get("Comparisons")
+    if not isinstance(comparisons, list):
+        return []
+
+    if document.get("SchemaVersion") == SCHEMA_VERSION:
+        return [ComparisonRecord.from_document(entry) for entry in comparisons]
+
+    records = []
+    for entry in comparisons:
+        new_date = parse_report_date(entry.get("New Report Date"))
+        old_date = parse_report_date(entry.get("Old Report Date"))
+        pair = {
+            "new_report_date": new_date,
+            "old_report_date": old_date,
+            "new_order_id": str(entry.get("New Report Order ID", "")),
+            "old_order_id": str(entry.get("Old Report Order ID", "")),
+            "new_order_name": entry.get("New Report Order Name", ""),
+            "old_order_name": entry.get("Old Report Order Name", ""),
+        }
+
+        if "Sections" in entry:
+            for section_name, section_entries in entry["Sections"].items():
+                for section_entry in section_entries:
+                    records.append(ComparisonRecord(
+                        section=section_name,
+                        category=normalize_category(section_entry.get("Category", "")),
+                        new_content=section_entry.get("NewContent", ""),
+                        old_content=section_entry.get("OldContent", ""),
+                        explanation=section_entry.get("Explanation", ""),
+                        **pair
+                    ))
+        else:
+            new_content, old_content = _legacy_table_contents(entry, new_date, old_date)
+            records.append(ComparisonRecord(
+                section=entry.get("Section", ""),
+                category=normalize_category(entry.get("Category", "")),
+                new_content=new_content,
+                old_content=old_content,
+                explanation=entry.get("Explanation", ""),
+                **pair
+            ))
+
+    return records
+
+
+def migrate_comparison_document(document):
+    """
+    Convert a legacy comparison document into the canonical schema.
+
+    Args:
+        document (dict): Stored comparison document.
+
+    Returns:
+        dict | None: The canonical document (keeping its `_id`), or None if it is already canonical.
+    """
+    if document.get("SchemaVersion") == SCHEMA_VERSION:
+        return None
+
+    report_dates = [parse_report_date(value) for value in document.get("ReportDates", [])]
+    migrated = build_comparison_document(
+        document["PatientID"],
+        [date for date in report_dates if date is not None],
+        records_from_document(document)
+    )
+
+    # Single-report documents stored their message under different keys per pipeline
+    message = document.get("ComparisonResults") or document.get("Comparison")
+    if isinstance(message, str):
+        migrated["Message"] = message
+
+    if "_id" in document:
+        migrated["_id"] = document["_id"]
+    return migrated
+
+
+def migrate_collection(comparison_collection):
+    """
+    Rewrite every legacy document of a comparison collection into the canonical schema, and
+    normalize the categories of canonical documents saved before `normalize_category`.
+
+    Args:
+        comparison_collection (Collection): MongoDB comparison collection.
+
+    Returns:
+        int: Number of migrated documents.
+    """
+    migrated_count = 0
+    for document in comparison_collection.find({"SchemaVersion": {"$ne": SCHEMA_VERSION}}):
+        migrated = migrate_comparison_document(document)
+        if migrated is None:
+            continue
+        comparison_collection.replace_one({"_id": document["_id"]}, migrated)
+        migrated_count += 1
+
+    unnormalized = {
+        "SchemaVersion": SCHEMA_VERSION,
+        "Comparisons": {"$elemMatch": {"Category": {"$nin": list(CATEGORIES)}}},
+    }
+    for document in comparison_collection.find(unnormalized, {"Comparisons": 1}):
+        comparisons = [
+            {**entry, "Category": normalize_category(entry.get("Category"))} if isinstance(entry, dict) else entry
+            for entry in document["Comparisons"]
+        ]
+        # The stored hash no longer matches; comparison_report.py hashes the document again
+        comparison_collection.update_one(
+            {"_id": document["_id"]}, {"$set": {"Comparisons": comparisons}, "$unset": {"ComparisonHash": ""}}
+        )
+        migrated_count += 1
+
+    print(f"Migrated {migrated_count} documents in {comparison_collection.name}.")
+    return migrated_count
+
+
+def idempotent_filter(document):
+    """
+    Build the filter under which a comparison document may replace the stored one.
+
+    The stored document is only replaced when it does not cover newer reports, so workers
+    racing on the same patient cannot overwrite a newer comparison with an older one.
+    Writing the same comparison twice is harmless.
+
+    Args:
+        document (dict): Canonical comparison document.
+
+    Returns:
+        dict: MongoDB filter for `replace_one(..., upsert=True)`.
+    """
+    return {
+        "PatientID": document["PatientID"],
+        "$or": [
+            {"LatestReportDate": {"$lte": document["LatestReportDate"]}},
+            {"LatestReportDate": {"$exists": False}},
+            {"LatestReportDate": None},
+        ]
+    }
+
+
+def save_comparison_document(comparison_collection, document):
+    """
+    Idempotently upsert a comparison document.
+
+    Relies on the unique PatientID index created by `ensure_indexes`: when a newer comparison
+    is already stored the filter does not match, the upsert hits the unique index and the
+    write is skipped.
+
+    Args:
+        comparison_collection (Collection): MongoDB comparison collection.
+        document (dict): Canonical comparison document.
+
+    Returns:
+        bool: True if the document was written, False if a newer comparison is stored.
+    """
+    # Imported here so the record type can be used without a MongoDB driver
+    from pymongo.errors import DuplicateKeyError
+
+    # Large contents are stored once in the shared content collection when enabled, see text_storage.py
+    stored_document = TextStorage.for_database(comparison_collection.database).externalize_contents(
+        with_comparison_hash(document)
+    )
+    try:
+        comparison_collection.replace_one(idempotent_filter(document), stored_document, upsert=True)
+        return True
+    except DuplicateKeyError:
+        print(f"A newer comparison is already stored for PatientID {document['PatientID']}. Skipping save.")
+        return False
+
+
+def remove_duplicate_patients(comparison_collection):
+    """
+    Keep only the newest comparison of each patient stored more than once.
+
+    Collections written before the unique PatientID index may hold several documents per
+    patient, on which the index cannot be built.
+
+    Args:
+        comparison_collection (Collection): MongoDB comparison collection.
+
+    Returns:
+        int: Number of deleted documents.
+    """
+    duplicates = comparison_collection.aggregate([
+        {"$group": {"_id": "$PatientID", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+    ])
+
+    deleted_count = 0
+    for duplicate in duplicates:
+        documents = list(comparison_collection.find({"_id": {"$in": duplicate["ids"]}}, {"ReportDates": 1}))
+        newest = max(documents, key=lambda document: latest_compared_date(document) or datetime.min)
+        result = comparison_collection.delete_many(
+            {"_id": {"$in": [document["_id"] for document in documents if document["_id"] != newest["_id"]]}}
+        )
+        deleted_count += result.deleted_count
+
+    if deleted_count:
+        print(f"Deleted {deleted_count} duplicate comparisons in {comparison_collection.name}.")
+    return deleted_count
+
+
+def ensure_indexes(comparison_collection):
+    """
+    Create the indexes used by dashboard queries and idempotent writes on a comparison collection.
+
+    Every writer calls this before its first save: without the unique PatientID index,
+    `save_comparison_document` inserts a second document instead of skipping an older
+    comparison. Duplicates left by earlier writes are removed first, see `remove_duplicate_patients`.
+
+    Args:
+        comparison_collection (Collection): MongoDB comparison collection.
+
+    Returns:
+        None
+    """
+    if "patient_unique" not in comparison_collection.index_information():
+        remove_duplicate_patients(comparison_collection)
+        comparison_collection.create_index("PatientID", unique=True, name="patient_unique")
+    # Dashboard queries filter on section and category across patients, so those lead the index
+    if "patient_section_category" in comparison_collection.index_information():
+        comparison_collection.drop_index("patient_section_category")
+    comparison_collection.create_index(
+        [("Comparisons.Section", 1), ("Comparisons.Category", 1), ("PatientID", 1)],
+        name="section_category_patient"
+    )
+
+
+def main():
+    """
+    Migrate every comparison collection to the canonical schema and create its indexes.
+    """
+    # Imported here so the record type can be used without a MongoDB driver
+    from pymongo import MongoClient
+    from pymongo.server_api import ServerApi
+
+    # MongoDB setup
+    """
+    IMPORTANT: Replace the MongoDB URI with your actual setup, and the collection names in `PIPELINE_COLLECTIONS`.
+    """
+    uri = ""
+    client = MongoClient(uri, server_api=ServerApi('1'))
+    db = client['ClinicalNotesReviewer']
+    for collection_name in PIPELINE_COLLECTIONS.values():
+        migrate_collection(db[collection_name])
+        ensure_indexes(db[collection_name])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,466 @@
+# Import libraries
+import argparse
+import hashlib
+import html
+import json
+import os
+import re
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from comparison_records import (
+    DATE_FORMAT,
+    PIPELINE_COLLECTIONS,
+    SECTIONS,
+    comparison_document_hash,
+    records_from_document,
+)
+from text_storage import TextStorage
+
+"""
+Pre-rendered comparison reports, one static HTML file (and optionally PDF) per patient.
+
+    python comparison_report.py [--pipeline gemini_table] [--pdf] [--workers 8]
+
+Each stored comparison document is rendered into `<output_dir>/<pipeline>/<PatientID>-<hash>.html`,
+with a table of categories per section for every pair of compared reports. Viewing a patient is
+then a static file read, see `report_path`.
+
+A report is only rendered again when its comparison changed (or `RENDERER_VERSION` was bumped),
+or when a PDF is requested and was not written with it. Each run reads only the `ComparisonHash`
+stored on every document when it is saved and compares it with the per-pipeline manifest of
+rendered reports (`manifest.json`). It then fetches just the changed documents, and a pool of
+worker processes renders them. The manifest is saved after every rendered batch, so an
+interrupted run keeps its progress. Reports of patients whose comparison was deleted are
+removed. PDF output needs the optional `weasyprint` package.
+"""
+
+# Rendering configuration
+"""
+IMPORTANT: Point `output_dir` to the directory served to the users of the reports.
+    - `workers`: rendering processes; defaults to the number of CPUs.
+    - `pdf`: also write a PDF next to each HTML report (needs `weasyprint`).
+    - `batch_size`: stale documents handed to the workers at a time.
+"""
+RENDER_CONFIG = {
+    "output_dir": os.environ.get("COMPARISON_REPORT_DIR", "comparison_reports"),
+    "workers": int(os.environ.get("COMPARISON_REPORT_WORKERS", 0)) or os.cpu_count() or 1,
+    "pdf": os.environ.get("COMPARISON_REPORT_PDF", "0") == "1",
+    "batch_size": 256,
+}
+
+# Bump when the layout changes, so every cached report is rendered again
+RENDERER_VERSION = 1
+
+# Categories in display order; other categories follow alphabetically
+CATEGORY_ORDER = ("New Development", "Difference", "No Longer Mentioned")
+
+HASH_META = '<meta name="comparison-hash" content="{}">'
+
+# Rendered hash of each patient's report and whether it has a PDF, in each pipeline's output directory
+MANIFEST_NAME = "manifest.json"
+REPORT_EXTENSIONS = ("html", "pdf")
+
+STYLE = """
+body { font-family: Arial, Helvetica, sans-serif; margin: 2em; color: #222; }
+h1 { font-size: 1.5em; } h2 { font-size: 1.25em; margin-top: 2em; } h3 { font-size: 1.1em; }
+table { border-collapse: collapse; width: 100%; margin-bottom: 1.5em; }
+th, td { border: 1px solid #ccc; padding: 0.4em 0.6em; text-align: left; vertical-align: top; }
+th { background: #f2f2f2; }
+.category-new-development { background: #fdf1e6; }
+.category-no-longer-mentioned { background: #eef5ee; }
+.meta { color: #666; }
+"""
+
+
+def comparison_hash(document):
+    """
+    Hash a comparison document, to detect when its rendered report is out of date.
+
+    Args:
+        document (dict): Comparison document. Its stored `ComparisonHash` is used when present,
+                         otherwise the document must have its contents resolved.
+
+    Returns:
+        str: Hex SHA-256 of the comparison hash and `RENDERER_VERSION`.
+    """
+    stored_hash = document.get("ComparisonHash") or comparison_document_hash(document)
+    return hashlib.sha256(f"{RENDERER_VERSION}:{stored_hash}".encode("utf-8")).hexdigest()
+
+
+def report_path(output_dir, pipeline, patient_id, extension="html"):
+    """
+    Get the path of a patient's rendered report.
+
+    Args:
+        output_dir (str): Root directory of the rendered reports.
+        pipeline (str): Pipeline that produced the comparison, see `PIPELINE_COLLECTIONS`.
+        patient_id (str): ID of the patient.
+        extension (str): "html" or "pdf".
+
+    Returns:
+        str: Path of the report file.
+    """
+    # The sanitised ID keeps the name readable; the hash of the raw ID keeps IDs such as
+    # "123/45" and "123_45" in separate files
+    file_name = re.sub(r"[^A-Za-z0-9_.-]", "_", str(patient_id))
+    id_hash = hashlib.sha256(str(patient_id).encode("utf-8")).hexdigest()[:12]
+    return os.path.join(output_dir, pipeline, f"{file_name}-{id_hash}.{extension}")
+
+
+def load_manifest(output_dir, pipeline):
+    """
+    Read the rendered reports of a pipeline.
+
+    Returns:
+        dict: PatientID (as a string) mapped to `{"hash": ..., "pdf": ...}`: the `comparison_hash`
+              its report was rendered from, and whether a PDF was written with it.
+    """
+    try:
+        with open(os.path.join(output_dir, pipeline, MANIFEST_NAME), encoding="utf-8") as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        return {}
+
+    # Manifests written before PDFs were tracked only hold the hashes
+    return {
+        patient_id: entry if isinstance(entry, dict) else {"hash": entry, "pdf": False}
+        for patient_id, entry in manifest.items()
+    }
+
+
+def save_manifest(output_dir, pipeline, manifest):
+    """
+    Write the rendered reports of a pipeline, see `load_manifest`.
+    """
+    os.makedirs(os.path.join(output_dir, pipeline), exist_ok=True)
+    _write_atomic(os.path.join(output_dir, pipeline, MANIFEST_NAME), json.dumps(manifest, sort_keys=True))
+
+
+def remove_deleted_reports(output_dir, pipeline, patient_ids):
+    """
+    Delete the rendered reports of a pipeline that belong to none of the given patients.
+
+    Args:
+        output_dir (str): Root directory of the rendered reports.
+        pipeline (str): Pipeline that produced the comparisons.
+        patient_ids (set): IDs of every patient with a stored comparison.
+
+    Returns:
+        int: Number of deleted report files.
+    """
+    directory = os.path.join(output_dir, pipeline)
+    if not os.path.isdir(directory):
+        return 0
+
+    expected = {
+        os.path.basename(report_path(output_dir, pipeline, patient_id, extension))
+        for patient_id in patient_ids
+        for extension in REPORT_EXTENSIONS
+    }
+    removed = 0
+    for entry in os.scandir(directory):
+        if entry.name.endswith(tuple(f".{extension}" for extension in REPORT_EXTENSIONS)) and entry.name not in expected:
+            os.remove(entry.path)
+            removed += 1
+    return removed
+
+
+def _format_date(value):
+    return value.strftime(DATE_FORMAT) if isinstance(value, datetime) else str(value or "")
+
+
+def _sortable_date(value):
+    return value if isinstance(value, datetime) else datetime.min
+
+
+def _category_sort_key(category):
+    if category in CATEGORY_ORDER:
+        return (0, CATEGORY_ORDER.index(category), "")
+    return (1, 0, category)
+
+
+def _category_class(category):
+    return "category-" + re.sub(r"[^a-z0-9]+", "-", str(category).lower()).strip("-")
+
+
+def render_html(document, document_hash):
+    """
+    Render a comparison document as a standalone HTML report.
+
+    Comparisons are grouped by pair of reports (newest first), then by section, each section
+    being a table of its entries ordered by category.
+
+    Args:
+        document (dict): Comparison document, with its contents resolved.
+        document_hash (str): Hash recorded in the report, see `comparison_hash`.
+
+    Returns:
+        str: The HTML report.
+    """
+    escape = html.escape
+    patient_id = escape(str(document.get("PatientID", "")))
+    records = records_from_document(document)
+
+    # Group the records by pair of compared reports, then by section
+    pairs = defaultdict(lambda: defaultdict(list))
+    pair_details = {}
+    for record in records:
+        key = (record.new_report_date, record.old_report_date)
+        pairs[key][record.section].append(record)
+        pair_details.setdefault(key, record)
+
+    parts = [
+        "<!DOCTYPE html>",
+        "<html>",
+        "<head>",
+        '<meta charset="utf-8">',
+        HASH_META.format(document_hash),
+        f"<title>Comparison report - {patient_id}</title>",
+        f"<style>{STYLE}</style>",
+        "</head>",
+        "<body>",
+        f"<h1>Comparison report - {patient_id}</h1>",
+    ]
+
+    report_dates = sorted(
+        (date for date in document.get("ReportDates", []) if isinstance(date, datetime)), reverse=True
+    )
+    if report_dates:
+        parts.append(
+            f'<p class="meta">Reports: {escape(", ".join(_format_date(date) for date in report_dates))}</p>'
+        )
+
+    if not records:
+        parts.append(f"<p>{escape(document.get('Message', 'No comparisons recorded for this patient.'))}</p>")
+        parts.extend(["</body>", "</html>"])
+        return "\n".join(parts)
+
+    # Overview: number of entries per section and category
+    counts = Counter((record.section, record.category) for record in records)
+    categories = sorted({record.category for record in records}, key=_category_sort_key)
+    sections = [section for section in SECTIONS if any(key[0] == section for key in counts)]
+    sections += sorted({section for section, _ in counts} - set(sections))
+    parts.append("<h2>Overview</h2>")
+    parts.append("<table>")
+    parts.append("<tr><th>Section</th>" + "".join(f"<th>{escape(category)}</th>" for category in categories) + "</tr>")
+    for section in sections:
+        cells = "".join(f"<td>{counts.get((section, category), 0)}</td>" for category in categories)
+        parts.append(f"<tr><td>{escape(section)}</td>{cells}</tr>")
+    parts.append("</table>")
+
+    # One block per pair of compared reports, newest pair first
+    for key in sorted(pairs, key=lambda pair: tuple(_sortable_date(date) for date in pair), reverse=True):
+        details = pair_details[key]
+        new_label = escape(" ".join(filter(None, [_format_date(details.new_report_date), details.new_order_name])))
+        old_label = escape(" ".join(filter(None, [_format_date(details.old_report_date), details.old_order_name])))
+        parts.append(f"<h2>{new_label} compared with {old_label}</h2>")
+
+        section_names = [section for section in SECTIONS if section in pairs[key]]
+        section_names += sorted(set(pairs[key]) - set(section_names))
+        for section in section_names:
+            parts.append(f"<h3>{escape(section)}</h3>")
+            parts.append("<table>")
+            parts.append("<tr><th>Category</th><th>New report</th><th>Old report</th><th>Explanation</th></tr>")
+            for record in sorted(pairs[key][section], key=lambda record: _category_sort_key(record.category)):
+                parts.append(
+                    f'<tr class="{_category_class(record.category)}">'
+                    f"<td>{escape(record.category)}</td>"
+                    f"<td>{escape(str(record.new_content))}</td>"
+                    f"<td>{escape(str(record.old_content))}</td>"
+                    f"<td>{escape(str(record.explanation))}</td>"
+                    "</tr>"
+                )
+            parts.append("</table>")
+
+    parts.extend(["</body>", "</html>"])
+    return "\n".join(parts)
+
+
+def _weasyprint():
+    """
+    Import the optional `weasyprint` package, or return None when it is not installed.
+    """
+    try:
+        import weasyprint
+        return weasyprint
+    except ImportError:
+        return None
+
+
+def _write_atomic(path, data):
+    """
+    Write a file through a temporary file, so readers never see a partial report.
+    """
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    mode = "wb" if isinstance(data, bytes) else "w"
+    with open(temporary_path, mode, **({} if isinstance(data, bytes) else {"encoding": "utf-8"})) as output_file:
+        output_file.write(data)
+    os.replace(temporary_path, path)
+
+
+def render_report(document, document_hash, output_dir, pipeline, pdf=False):
+    """
+    Render one comparison document to its HTML report, and PDF when requested. A PDF of an
+    earlier rendering is removed when no PDF is requested, as it would be out of date.
+
+    Args:
+        document (dict): Comparison document, with its contents resolved.
+        document_hash (str): Hash of the document, see `comparison_hash`.
+        output_dir (str): Root directory of the rendered reports.
+        pipeline (str): Pipeline that produced the comparison.
+        pdf (bool): Also write a PDF report.
+
+    Returns:
+        str: Path of the HTML report.
+    """
+    html_path = report_path(output_dir, pipeline, document["PatientID"])
+    os.makedirs(os.path.dirname(html_path), exist_ok=True)
+    rendered = render_html(document, document_hash)
+
+    # Checked once per run by `render_reports`
+    pdf_path = report_path(output_dir, pipeline, document["PatientID"], "pdf")
+    if pdf:
+        _write_atomic(pdf_path, _weasyprint().HTML(string=rendered).write_pdf())
+    elif os.path.exists(pdf_path):
+        os.remove(pdf_path)
+
+    _write_atomic(html_path, rendered)
+    return html_path
+
+
+def _render_batch(batch, output_dir, pipeline, pdf):
+    """
+    Render a batch of (document, hash) pairs in a worker process.
+
+    Returns:
+        list: (PatientID, manifest entry) of the rendered reports, see `load_manifest`;
+              failures are logged and skipped.
+    """
+    rendered = []
+    for document, document_hash in batch:
+        try:
+            render_report(document, document_hash, output_dir, pipeline, pdf)
+            rendered.append((str(document["PatientID"]), {"hash": document_hash, "pdf": pdf}))
+        except Exception as e:
+            print(f"Error rendering the report of {document.get('PatientID')}: {e}")
+    return rendered
+
+
+def render_reports(db, pipelines=None, config=RENDER_CONFIG, query=None, force=False):
+    """
+    Render the reports of every stored comparison whose rendered report is missing or out of date.
+
+    Only `PatientID` and `ComparisonHash` are read for every document; the full documents are
+    fetched for the stale reports only. A report is also stale when a PDF is requested and its
+    manifest entry has none. Comparisons saved before `ComparisonHash` existed are hashed once
+    and the hash is stored on them. Without a `query`, reports of patients that no longer have
+    a comparison are deleted. Each pipeline's manifest is saved after every rendered batch.
+
+    Args:
+        db (Database): MongoDB database holding the comparison collections.
+        pipelines (list, optional): Pipelines to render. Defaults to all of `PIPELINE_COLLECTIONS`.
+        config (dict): Rendering configuration, see `RENDER_CONFIG`.
+        query (dict, optional): MongoDB filter restricting the patients.
+        force (bool): Render every report, even when it is up to date.
+
+    Returns:
+        dict: Numbers of "rendered", "up_to_date" and "removed" reports.
+    """
+    pipelines = pipelines or list(PIPELINE_COLLECTIONS.keys())
+    storage = TextStorage.for_database(db)
+    output_dir = config["output_dir"]
+    pdf = config["pdf"]
+    if pdf and _weasyprint() is None:
+        print("weasyprint is not installed; skipping the PDF reports.")
+        pdf = False
+    stats = Counter()
+
+    with ProcessPoolExecutor(max_workers=config["workers"]) as executor:
+        for pipeline in pipelines:
+            collection = db[PIPELINE_COLLECTIONS[pipeline]]
+            manifest = load_manifest(output_dir, pipeline)
+
+            # Compare the stored hashes with the rendered ones, without fetching the documents
+            patient_ids = set()
+            stale_ids = []
+            for document in collection.find(query or {}, {"PatientID": 1, "ComparisonHash": 1}):
+                if not document.get("PatientID"):
+                    continue
+                patient_id = str(document["PatientID"])
+                patient_ids.add(patient_id)
+                entry = manifest.get(patient_id)
+                if (
+                    not force and document.get("ComparisonHash") and entry is not None
+                    and entry["hash"] == comparison_hash(document) and (entry["pdf"] or not pdf)
+                ):
+                    stats["up_to_date"] += 1
+                else:
+                    stale_ids.append(document["_id"])
+
+            if query is None:
+                stats["removed"] += remove_deleted_reports(output_dir, pipeline, patient_ids)
+                for patient_id in set(manifest) - patient_ids:
+                    del manifest[patient_id]
+                save_manifest(output_dir, pipeline, manifest)
+
+            futures = []
+            for start in range(0, len(stale_ids), config["batch_size"]):
+                batch = []
+                for document in collection.find({"_id": {"$in": stale_ids[start:start + config["batch_size"]]}}):
+                    document = storage.resolve_contents(document)
+                    document_id = document.pop("_id")
+                    if not document.get("ComparisonHash"):
+                        # Store the hash, so the next run can skip this document without fetching it
+                        document["ComparisonHash"] = comparison_document_hash(document)
+                        collection.update_one(
+                            {"_id": document_id, "ComparisonHash": {"$exists": False}},
+                            {"$set": {"ComparisonHash": document["ComparisonHash"]}}
+                        )
+                    batch.append((document, comparison_hash(document)))
+                if batch:
+                    futures.append(executor.submit(_render_batch, batch, output_dir, pipeline, pdf))
+
+            # Record each batch as soon as it is rendered, so a crash only loses the batches in progress
+            for future in as_completed(futures):
+                rendered = future.result()
+                for patient_id, entry in rendered:
+                    manifest[patient_id] = entry
+                stats["rendered"] += len(rendered)
+                if rendered:
+                    save_manifest(output_dir, pipeline, manifest)
+
+    print(
+        f"Rendered {stats['rendered']} comparison reports into {output_dir}; {stats['up_to_date']} were up to date, "
+        f"{stats['removed']} files of deleted comparisons were removed."
+    )
+    return {"rendered": stats["rendered"], "up_to_date": stats["up_to_date"], "removed": stats["removed"]}
+
+
+def main(argv=None):
+    """
+    Render the comparison reports of the stored comparisons.
+    """
+    parser = argparse.ArgumentParser(description="Pre-render the comparison report of every patient.")
+    parser.add_argument("--pipeline", action="append", choices=list(PIPELINE_COLLECTIONS),
+                        help="Pipeline to render; repeat for several. Defaults to all.")
+    parser.add_argument("--output-dir", default=RENDER_CONFIG["output_dir"], help="Directory of the reports.")
+    parser.add_argument("--workers", type=int, default=RENDER_CONFIG["workers"], help="Rendering processes.")
+    parser.add_argument("--pdf", action="store_true", default=RENDER_CONFIG["pdf"], help="Also write PDF reports.")
+    parser.add_argument("--force", action="store_true", help="Render every report, even when it is up to date.")
+    args = parser.parse_args(argv)
+
+    # Imported here so the renderer can be used without a MongoDB driver
+    from clients import mongo_client
+
+    # MongoDB setup
+    """
+    IMPORTANT: Replace the MongoDB URI with your actual setup.
+    """
+    uri = ""
+    db = mongo_client(uri)['ClinicalNotesReviewer']
+    config = {**RENDER_CONFIG, "output_dir": args.output_dir, "workers": args.workers, "pdf": args.pdf}
+    render_reports(db, args.pipeline, config, force=args.force)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+# Import libraries
+import heapq
+import os
+import re
+from datetime import datetime
+from functools import lru_cache
+
+# Priority configuration
+"""
+IMPORTANT: Tune these values to your workload.
+    - `live_window_hours`: patients whose newest report is younger than this are live traffic,
+      older ones are backfill.
+    - `live_share`: fraction of the comparisons given to live traffic while both queues have work.
+      The rest is reserved for backfill so the backlog keeps moving.
+    - `recency_weight` / `recency_half_life_hours`: bonus for recent reports, halving every half-life.
+    - `order_type_weights`: bonus for order types, matched case-insensitively as whole words of the
+      report's `Order Name` ("CT" matches "CT CHEST" but not "INJECTION").
+    - `flag_weight`: bonus for explicitly flagged patients, which are always treated as live traffic.
+"""
+PRIORITY_CONFIG = {
+    "live_window_hours": 24,
+    "live_share": 0.75,
+    "recency_weight": 10.0,
+    "recency_half_life_hours": 24,
+    "order_type_weights": {
+        "CT": 3.0,
+        "MRI": 3.0,
+        "ULTRASOUND": 2.0,
+        "X-RAY": 1.0,
+        "XR": 1.0,
+    },
+    "flag_weight": 100.0,
+}
+
+
+def load_priority_patients():
+    """
+    Read explicitly flagged patients from the `PRIORITY_PATIENTS` environment variable.
+
+    Returns:
+        set: Patient IDs listed in the comma-separated variable.
+    """
+    value = os.environ.get("PRIORITY_PATIENTS", "")
+    return {patient_id.strip() for patient_id in value.split(",") if patient_id.strip()}
+
+
+@lru_cache(maxsize=None)
+def _order_type_pattern(order_type):
+    """
+    Compile the pattern matching an order type as a whole word of an upper-case order name.
+    """
+    return re.compile(rf"(?<![A-Z0-9]){re.escape(order_type.upper())}(?![A-Z0-9])")
+
+
+def priority_score(newest_report_date, order_name, flagged, now, config=PRIORITY_CONFIG):
+    """
+    Compute the priority of a patient's comparison. Higher scores are compared first.
+
+    Args:
+        newest_report_date (datetime): Date of the patient's newest report.
+        order_name (str): `Order Name` of the newest report.
+        flagged (bool): Whether the patient was explicitly flagged as urgent.
+        now (datetime): Reference time for recency.
+        config (dict): Priority configuration, see `PRIORITY_CONFIG`.
+
+    Returns:
+        float: The priority score.
+    """
+    age_hours = max((now - newest_report_date).total_seconds() / 3600, 0)
+    score = config["recency_weight"] * 0.5 ** (age_hours / config["recency_half_life_hours"])
+
+    order_name = (order_name or "").upper()
+    score += max(
+        (
+            weight for order_type, weight in config["order_type_weights"].items()
+            if _order_type_pattern(order_type).search(order_name)
+        ),
+        default=0.0
+    )
+
+    if flagged:
+        score += config["flag_weight"]
+    return score
+
+
+class ComparisonScheduler:
+    """
+    Orders patients by priority, keeping separate queues for live traffic and backfill.
+
+    Each queue is a heap ordered by `priority_score`. While both queues have work, live traffic
+    receives `live_share` of the comparisons and backfill the rest, so neither side starves.
+    """
+
+    def __init__(self, config=PRIORITY_CONFIG, priority_patients=(), now=None):
+        self.config = config
+        self.priority_patients = set(priority_patients)
+        self.now = now or datetime.now()
+        self.live_queue = []
+        self.backfill_queue = []
+        self.live_served = 0
+        self.total_served = 0
+        self._sequence = 0
+
+    def __len__(self):
+        return len(self.live_queue) + len(self.backfill_queue)
+
+    def add(self, patient_id, reports):
+        """
+        Queue a patient's reports for comparison.
+
+        Args:
+            patient_id (str): ID of the patient.
+            reports (list | PatientReports): A list of tuples, each containing a datetime object and a
+                report dictionary, or a view of a `report_store.ReportStore` giving its newest report directly.
+        """
+        if hasattr(reports, "newest"):
+            newest_date, newest_report = reports.newest()
+        else:
+            newest_date, newest_report = max(reports, key=lambda x: x[0])
+        order_name = newest_report.get('Raw Report', {}).get('Order Name', "")
+        flagged = patient_id in self.priority_patients or bool(newest_report.get('Priority'))
+
+        score = priority_score(newest_date, order_name, flagged, self.now, self.config)
+        age_hours = (self.now - newest_date).total_seconds() / 3600
+        is_live = flagged or age_hours <= self.config["live_window_hours"]
+
+        # The sequence number keeps insertion order stable between equal scores
+        queue = self.live_queue if is_live else self.backfill_queue
+        heapq.heappush(queue, (-score, self._sequence, patient_id, reports))
+        self._sequence += 1
+
+    def next_patient(self):
+        """
+        Pop the next patient to compare.
+
+        Returns:
+            tuple | None: (patient ID, reports), or None when both queues are empty.
+        """
+        if not self.live_queue and not self.backfill_queue:
+            return None
+
+        if not self.backfill_queue:
+            queue = self.live_queue
+        elif not self.live_queue:
+            queue = self.backfill_queue
+        else:
+            # Serve live traffic while it is below its quota share, backfill otherwise
+            live_quota = self.config["live_share"] * (self.total_served + 1)
+            queue = self.live_queue if self.live_served < live_quota else self.backfill_queue
+
+        _, _, patient_id, reports = heapq.heappop(queue)
+        if queue is self.live_queue:
+            self.live_served += 1
+        self.total_served += 1
+        return patient_id, reports
+
+    def __iter__(self):
+        while True:
+            item = self.next_patient()
+            if item is None:
+                return
+            yield item
+
+
+def schedule_patients(reports_by_patient, config=PRIORITY_CONFIG, priority_patients=None, now=None):
+    """
+    Order grouped reports for comparison by priority.
+
+    Args:
+        reports_by_patient (dict | ReportStore): Patient IDs mapped to lists of (datetime, report) tuples,
+            or the report store of the comparison pipelines.
+        config (dict): Priority configuration, see `PRIORITY_CONFIG`.
+        priority_patients (set, optional): Explicitly flagged patients. Defaults to `PRIORITY_PATIENTS`.
+        now (datetime, optional): Reference time for recency. Defaults to the current time.
+
+    Returns:
+        ComparisonScheduler: Iterable of (patient ID, reports) in processing order.
+    """
+    if priority_patients is None:
+        priority_patients = load_priority_patients()
+
+    scheduler = ComparisonScheduler(config, priority_patients, now)
+    for patient_id, reports in reports_by_patient.items():
+        if reports:
+            scheduler.add(patient_id, reports)
+    return scheduler
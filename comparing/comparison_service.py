@@ -0,0 +1,366 @@
+# Import libraries
+import argparse
+import json
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+from comparison_records import (
+    ComparisonRecord,
+    build_comparison_document,
+    build_single_report_document,
+    ensure_indexes,
+    latest_compared_date,
+    parse_comparison_table,
+    save_comparison_document,
+)
+from model_router import ModelBackend, ModelRouter, call_with_quota_retries, section_entry_count
+from profiling import span
+from request_packing import ComparisonUnit
+from text_storage import COMPARISON_PROJECTION, TextStorage
+
+"""
+On-demand comparison service.
+
+    GET /patients/<PatientID>/comparisons
+
+streams newline-delimited JSON events:
+    - {"type": "cached", "document": {...}} when the stored comparison is up to date;
+    - {"type": "section", ...} for each section comparison as soon as it finishes;
+    - {"type": "done", ...} once the comparison has been saved, or {"type": "error", ...}.
+
+Concurrent requests for the same patient share one in-flight computation; each request
+receives every event of that computation, including the ones emitted before it joined.
+
+A comparison with a failed section is streamed but not saved, so the next request retries it
+instead of serving an incomplete comparison as cached.
+"""
+
+DATE_FORMAT = "%d/%m/%Y %H:%M"
+
+# Number of newest reports of a patient that are compared, like the batch pipelines
+MAX_REPORTS = 5
+
+
+def to_json(event):
+    """
+    Serialize an event to a JSON line, converting datetimes and ObjectIds.
+    """
+    def default(value):
+        if isinstance(value, datetime):
+            return value.isoformat()
+        return str(value)
+    return json.dumps(event, default=default) + "\n"
+
+
+class FakeModelBackend:
+    """
+    Model backend returning a fixed comparison table after a delay, for local runs and tests.
+    """
+
+    def __init__(self, name="fake", delay_seconds=0.5):
+        self.name = name
+        self.delay_seconds = delay_seconds
+
+    def _output(self, prompt):
+        # Packed prompts (see request_packing.py) name the section of each task
+        packed_sections = re.findall(r"^Section: (.+)$", prompt, flags=re.MULTILINE)
+        if packed_sections:
+            return "\n\n".join(
+                f"### Task {number}\n{self._table(section_name)}" for number, section_name in enumerate(packed_sections, 1)
+            )
+        section = re.search(r"in the section '(.+?)'", prompt)
+        return self._table(section.group(1) if section else "Section")
+
+    def _table(self, section_name):
+        return (
+            "| Category | Newer Content | Older Content | Explanation |\n"
+            "|---|---|---|---|\n"
+            f"| New Development | Fake finding in {section_name} | NIL | Generated by the fake model backend. |"
+        )
+
+    def generate(self, prompt):
+        time.sleep(self.delay_seconds)
+        return self._output(prompt)
+
+    async def agenerate(self, prompt):
+        # Imported here as only the asynchronous mode awaits the backend
+        import asyncio
+        await asyncio.sleep(self.delay_seconds)
+        return self._output(prompt)
+
+    def as_backend(self):
+        return ModelBackend(self.name, self.generate, self.agenerate)
+
+
+class InflightComparison:
+    """
+    Events of one patient's running computation, replayed to every subscriber.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.done = False
+        self.condition = threading.Condition()
+
+    def publish(self, event, final=False):
+        with self.condition:
+            self.events.append(event)
+            self.done = self.done or final
+            self.condition.notify_all()
+
+    def subscribe(self):
+        """
+        Yield every event, from the first one, until the computation is done.
+        """
+        cursor = 0
+        while True:
+            with self.condition:
+                while cursor >= len(self.events) and not self.done:
+                    self.condition.wait()
+                pending = self.events[cursor:]
+                finished = self.done
+            for event in pending:
+                yield event
+            cursor += len(pending)
+            if finished and cursor >= len(self.events):
+                return
+
+
+class ComparisonService:
+    """
+    Computes, caches and streams patient comparisons on demand.
+
+    Args:
+        collection (Collection): Collection of processed reports.
+        comparison_collection (Collection): Collection of stored comparisons, used as the cache.
+        pipeline (module): Pipeline providing `generate_comparison_prompt` and `format_radiology_report`.
+        router (ModelRouter): Router used for the model calls.
+        max_workers (int): Section comparisons running at the same time across all patients.
+    """
+
+    def __init__(self, collection, comparison_collection, pipeline, router, max_workers=16):
+        self.collection = collection
+        self.comparison_collection = comparison_collection
+        self.pipeline = pipeline
+        self.router = router
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.storage = TextStorage.for_database(collection.database)
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+        # The idempotent saves rely on the unique PatientID index, see comparison_records.ensure_indexes
+        ensure_indexes(comparison_collection)
+
+    def report_dates(self, patient_id):
+        """
+        Read the dates of a patient's reports, without their contents.
+
+        Returns:
+            list: (datetime, report _id) tuples sorted by date. Reports with unparsable dates
+                  are skipped with a logged error.
+        """
+        dates = []
+        for report in self.collection.find({"PatientID": patient_id}, {"Performed Date Time": 1}):
+            try:
+                dates.append((datetime.strptime(report['Performed Date Time'], DATE_FORMAT), report['_id']))
+            except (KeyError, TypeError, ValueError) as e:
+                print(f"Error parsing date for report {report['_id']}: {e}")
+        dates.sort(key=lambda x: x[0])
+        return dates
+
+    def load_reports(self, report_dates):
+        """
+        Fetch the full reports listed by `report_dates`.
+
+        Returns:
+            list: (datetime, report) tuples in the same order, without reports deleted meanwhile.
+        """
+        ids = [report_id for _, report_id in report_dates]
+        reports = {
+            report['_id']: self.storage.lazy(report)
+            for report in self.collection.find({"_id": {"$in": ids}}, COMPARISON_PROJECTION)
+        }
+        return [(date, reports[report_id]) for date, report_id in report_dates if report_id in reports]
+
+    def stream(self, patient_id):
+        """
+        Yield the comparison events of a patient, joining a running computation if there is one.
+
+        Args:
+            patient_id (str): ID of the patient.
+
+        Returns:
+            generator: Event dictionaries, see the module docstring.
+        """
+        with self._lock:
+            inflight = self._inflight.get(patient_id)
+            if inflight is None:
+                inflight = InflightComparison()
+                self._inflight[patient_id] = inflight
+                threading.Thread(target=self._compute, args=(patient_id, inflight), daemon=True).start()
+            else:
+                print(f"Joining in-flight comparison for PatientID {patient_id}.")
+        return inflight.subscribe()
+
+    def _compare_unit(self, unit):
+        prompt = self.pipeline.generate_comparison_prompt(
+            unit.section_name,
+            unit.content1,
+            unit.content2,
+            unit.new_report[0].strftime("%d/%m/%Y %H:%M:%S"),
+            unit.old_report[0].strftime("%d/%m/%Y %H:%M:%S")
+        )
+        comparison_output = call_with_quota_retries(
+            lambda: self.router.generate(prompt, section_entry_count(unit.content1, unit.content2)),
+            f"comparison for section '{unit.section_name}'"
+        )
+        if comparison_output is None:
+            raise RuntimeError(f"No comparison could be generated for section '{unit.section_name}'.")
+        return [
+            ComparisonRecord.from_reports(unit.section_name, row, unit.new_report, unit.old_report)
+            for row in parse_comparison_table(comparison_output)
+        ]
+
+    def _compute(self, patient_id, inflight):
+        with span("patient", patient_id=patient_id):
+            self._compute_patient(patient_id, inflight)
+
+    def _compute_patient(self, patient_id, inflight):
+        try:
+            # Check the cache against the report dates before fetching any report contents
+            report_dates = self.report_dates(patient_id)[-MAX_REPORTS:]
+            if not report_dates:
+                inflight.publish({"type": "error", "message": f"No reports found for PatientID {patient_id}."}, final=True)
+                return
+
+            existing_comparison = self.comparison_collection.find_one({"PatientID": patient_id}, {"ReportDates": 1})
+            if existing_comparison:
+                latest_existing_date = latest_compared_date(existing_comparison)
+                if latest_existing_date and latest_existing_date >= report_dates[-1][0]:
+                    document = self.comparison_collection.find_one({"PatientID": patient_id}, {"_id": 0})
+                    inflight.publish({"type": "cached", "document": self.storage.resolve_contents(document)}, final=True)
+                    return
+
+            reports = self.load_reports(report_dates)
+            if not reports:
+                inflight.publish({"type": "error", "message": f"No reports found for PatientID {patient_id}."}, final=True)
+                return
+
+            if len(reports) == 1:
+                document = build_single_report_document(patient_id, reports[0][0])
+                save_comparison_document(self.comparison_collection, document)
+                inflight.publish({"type": "done", **document}, final=True)
+                return
+
+            base_report = reports[-1]
+            units = []
+            for report in reversed(reports[:-1]):
+                _, base_sections = self.pipeline.format_radiology_report(base_report[1])
+                _, report_sections = self.pipeline.format_radiology_report(report[1])
+                for section_name in base_sections.keys():
+                    unit = ComparisonUnit(
+                        section_name, base_report, report, base_sections[section_name], report_sections[section_name]
+                    )
+                    if not unit.is_empty:
+                        units.append(unit)
+
+            # Publish each section as soon as its comparison finishes
+            futures = {self.executor.submit(self._compare_unit, unit): index for index, unit in enumerate(units)}
+            records_by_unit = [[] for _ in units]
+            failed_sections = []
+            for future in as_completed(futures):
+                index = futures[future]
+                unit = units[index]
+                try:
+                    records_by_unit[index] = future.result()
+                except Exception as e:
+                    print(f"Error generating comparison for section '{unit.section_name}': {e}")
+                    failed_sections.append(unit.section_name)
+                inflight.publish({
+                    "type": "section",
+                    "Section": unit.section_name,
+                    "New Report Date": unit.new_report[0],
+                    "Old Report Date": unit.old_report[0],
+                    "Comparisons": [record.to_document() for record in records_by_unit[index]],
+                })
+
+            if failed_sections:
+                message = f"Comparison of {len(failed_sections)} sections failed; the comparison was not saved."
+                inflight.publish({"type": "error", "message": message, "Failed Sections": failed_sections}, final=True)
+                return
+
+            # Save in report pair and section order, like the batch pipelines
+            records = [record for unit_records in records_by_unit for record in unit_records]
+            document = build_comparison_document(patient_id, [report[0] for report in reports], records)
+            save_comparison_document(self.comparison_collection, document)
+            inflight.publish({"type": "done", "PatientID": patient_id, "ReportDates": document["ReportDates"]}, final=True)
+
+        except Exception as e:
+            print(f"Error comparing reports for PatientID {patient_id}: {e}")
+            inflight.publish({"type": "error", "message": str(e)}, final=True)
+        finally:
+            with self._lock:
+                self._inflight.pop(patient_id, None)
+
+
+def make_handler(service):
+    """
+    Build the HTTP request handler class serving a ComparisonService.
+    """
+    class ComparisonRequestHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            # Match the decoded path, ignoring any query string
+            match = re.fullmatch(r"/patients/([^/]+)/comparisons", urlsplit(self.path).path)
+            if not match:
+                self.send_error(404, "Use /patients/<PatientID>/comparisons")
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+
+            # Send every event as its own chunk so clients see it immediately
+            for event in service.stream(unquote(match.group(1))):
+                data = to_json(event).encode("utf-8")
+                self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+
+    return ComparisonRequestHandler
+
+
+def main():
+    """
+    Serve on-demand comparisons over HTTP.
+    """
+    parser = argparse.ArgumentParser(description="Serve on-demand radiology report comparisons.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-workers", type=int, default=16)
+    parser.add_argument("--fake-model", action="store_true", help="Answer with a fake model instead of Gemini.")
+    args = parser.parse_args()
+
+    import comparison_gemini_table as pipeline
+
+    if args.fake_model:
+        router = ModelRouter(FakeModelBackend("fake-cheap").as_backend(), FakeModelBackend("fake-strong").as_backend())
+    else:
+        router = pipeline.get_router()
+
+    service = ComparisonService(
+        pipeline.get_collection(), pipeline.get_comparison_collection(), pipeline, router, max_workers=args.max_workers
+    )
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+    print(f"Serving comparisons on http://{args.host}:{args.port}/patients/<PatientID>/comparisons")
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
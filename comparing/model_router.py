@@ -0,0 +1,355 @@
+# Import libraries
+import re
+import threading
+import time
+from dataclasses import dataclass
+from functools import lru_cache
+from comparison_records import CATEGORIES, normalize_category, parse_comparison_table
+from profiling import span
+
+# Routing configuration
+"""
+IMPORTANT: Tune these thresholds to your workload.
+A section comparison is sent to the cheap model first when its prompt is at most
+`max_cheap_prompt_tokens` tokens and both sections together hold at most
+`max_cheap_entries` key-value pairs. Anything larger goes straight to the strong model.
+Both limits apply per task, so a packed request (see request_packing.py) goes to the cheap
+model when each of its tasks would.
+Tokens are counted like request_packing.PACKING_CONFIG, see `estimate_tokens`.
+"""
+ROUTING_CONFIG = {
+    "max_cheap_prompt_tokens": 3000,
+    "max_cheap_entries": 8,
+}
+
+VALID_CATEGORIES = set(CATEGORIES)
+EMPTY_SECTIONS_OUTPUT = "Both report sections are empty"
+
+# Header row of a comparison table, e.g. "| Category | 01/02/2024 Content | ..."
+TABLE_HEADER_PATTERN = re.compile(r"^\s*\|\s*\**\s*Category\b", re.MULTILINE)
+
+# Characters per token used when no tokenizer is available (Gemini counts tokens remotely)
+CHARS_PER_TOKEN = 4
+
+# tiktoken encodings of the OpenAI deployments we use
+TIKTOKEN_ENCODINGS = {
+    "gpt-4o": "o200k_base",
+    "genai-GPT4o": "o200k_base",
+    "gpt-35-turbo": "cl100k_base",
+}
+
+
+@lru_cache(maxsize=None)
+def _tiktoken_encoding(encoding_name):
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    return tiktoken.get_encoding(encoding_name)
+
+
+def estimate_tokens(text, backend="gemini"):
+    """
+    Estimate the number of tokens of a text for a model backend.
+
+    OpenAI deployments are counted exactly with tiktoken when it is installed. Gemini only
+    counts tokens through an API call, so it (and any unknown backend) uses a
+    characters-per-token heuristic.
+
+    Args:
+        text (str): Text to measure.
+        backend (str): Model or deployment name, e.g. "gemini", "gpt-4o" or "gpt-35-turbo".
+
+    Returns:
+        int: Estimated token count.
+    """
+    encoding_name = TIKTOKEN_ENCODINGS.get(backend)
+    encoding = _tiktoken_encoding(encoding_name) if encoding_name else None
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+@dataclass
+class ModelBackend:
+    """
+    A named model behind a `generate(prompt) -> str` function and, optionally, its
+    asynchronous `agenerate(prompt) -> str` counterpart.
+    """
+    name: str
+    generate: object
+    agenerate: object = None
+
+
+def gemini_backend(name, model):
+    """
+    Wrap a Gemini `GenerativeModel` as a ModelBackend.
+
+    Args:
+        name (str): Model name used in the routing statistics.
+        model (GenerativeModel): The Gemini model.
+
+    Returns:
+        ModelBackend: Backend returning the stripped response text ("" if there is none).
+    """
+    def generate(prompt):
+        response = model.generate_content(prompt)
+        return response.text.strip() if hasattr(response, 'text') and response.text else ""
+
+    async def agenerate(prompt):
+        response = await model.generate_content_async(prompt)
+        return response.text.strip() if hasattr(response, 'text') and response.text else ""
+    return ModelBackend(name, generate, agenerate)
+
+
+def langchain_backend(name, chat_model):
+    """
+    Wrap a LangChain chat model (e.g. AzureChatOpenAI) as a ModelBackend.
+
+    Args:
+        name (str): Model name used in the routing statistics.
+        chat_model (BaseChatModel): The LangChain chat model.
+
+    Returns:
+        ModelBackend: Backend returning the stripped message content ("" if there is none).
+    """
+    def generate(prompt):
+        response = chat_model.invoke(prompt)
+        return response.content.strip() if isinstance(response.content, str) else ""
+
+    async def agenerate(prompt):
+        response = await chat_model.ainvoke(prompt)
+        return response.content.strip() if isinstance(response.content, str) else ""
+    return ModelBackend(name, generate, agenerate)
+
+
+def section_entry_count(*section_contents):
+    """
+    Count the key-value pairs of the compared sections, used as a complexity measure.
+
+    Args:
+        *section_contents (dict | str): Section contents; empty sections may be stored as "".
+
+    Returns:
+        int: Total number of key-value pairs.
+    """
+    return sum(len(content) for content in section_contents if isinstance(content, dict))
+
+
+def call_with_quota_retries(make_call, description, retries=3, retry_delay=30):
+    """
+    Run a model call, retrying when the API quota is exceeded.
+
+    Errors containing "429" are retried after `retry_delay` seconds, other errors are logged
+    and give up. `async_support.call_with_quota_retries` is the asynchronous counterpart.
+
+    Args:
+        make_call (callable): Function making the call, run once per attempt.
+        description (str): Description of the call used in log messages.
+        retries (int): Number of attempts.
+        retry_delay (int): Seconds to wait after a quota error.
+
+    Returns:
+        object | None: The result of the call, or None if every attempt failed.
+    """
+    for attempt in range(retries):
+        try:
+            return make_call()
+        except Exception as e:
+            if "429" in str(e):
+                print(f"API quota exceeded. Retrying in {retry_delay} seconds... (Attempt {attempt + 1}/{retries})")
+                with span("retry_wait", "retry", call=description):
+                    time.sleep(retry_delay)
+            else:
+                print(f"Error generating {description}: {e}")
+                return None
+    print(f"Max retries reached. Could not generate {description}.")
+    return None
+
+
+def is_valid_comparison_output(comparison_output):
+    """
+    Check that a model output follows the comparison table schema.
+
+    Args:
+        comparison_output (str): Raw model output.
+
+    Returns:
+        bool: True if the output reports empty sections, or is a table whose rows all have
+              four cells and a known category. A table with its header and no rows is valid:
+              the sections hold nothing to report.
+    """
+    if not comparison_output:
+        return False
+    if EMPTY_SECTIONS_OUTPUT in comparison_output:
+        return True
+
+    rows = parse_comparison_table(comparison_output)
+    if not rows:
+        return bool(TABLE_HEADER_PATTERN.search(comparison_output))
+    return all(normalize_category(row[0]) in VALID_CATEGORIES for row in rows)
+
+
+class ModelRouter:
+    """
+    Sends small comparisons to a cheap model and escalates to a strong model when needed.
+
+    A comparison is escalated when the cheap model fails or its output fails `validate`.
+    Comparisons whose prompt or sections exceed `ROUTING_CONFIG` skip the cheap model. Calls,
+    escalations and latency are recorded per role ("cheap" and "strong"), as both roles may
+    use the same model.
+    """
+
+    def __init__(self, cheap_backend, strong_backend, validate=is_valid_comparison_output, config=ROUTING_CONFIG):
+        self.cheap_backend = cheap_backend
+        self.strong_backend = strong_backend
+        self.validate = validate
+        self.config = config
+        self._lock = threading.Lock()
+        self.stats = {
+            "routed_cheap": 0,
+            "routed_strong": 0,
+            "escalations": 0,
+            "calls": {"cheap": 0, "strong": 0},
+            "latency_seconds": {"cheap": [], "strong": []},
+        }
+
+    def _backend(self, role):
+        return self.cheap_backend if role == "cheap" else self.strong_backend
+
+    def _record_call(self, role, elapsed):
+        with self._lock:
+            self.stats["calls"][role] += 1
+            self.stats["latency_seconds"][role].append(elapsed)
+
+    def _call(self, role, prompt):
+        backend = self._backend(role)
+        start = time.perf_counter()
+        try:
+            with span("model.generate", "model", model=backend.name, role=role, prompt_chars=len(prompt)):
+                return backend.generate(prompt)
+        finally:
+            self._record_call(role, time.perf_counter() - start)
+
+    async def _acall(self, role, prompt):
+        backend = self._backend(role)
+        start = time.perf_counter()
+        try:
+            with span("model.generate", "model", model=backend.name, role=role, prompt_chars=len(prompt)):
+                return await backend.agenerate(prompt)
+        finally:
+            self._record_call(role, time.perf_counter() - start)
+
+    def _cheap_output_failed(self, output, error, validate):
+        """
+        Decide whether a cheap model call must be escalated, logging why.
+        """
+        if error is not None:
+            print(f"{self.cheap_backend.name} failed: {error}. Escalating to {self.strong_backend.name}.")
+        elif validate(output):
+            return False
+        else:
+            print(f"Output of {self.cheap_backend.name} failed validation. Escalating to {self.strong_backend.name}.")
+        self._count("escalations")
+        return True
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def is_simple(self, prompt, entry_count, task_count=1):
+        """
+        Decide whether a comparison may be sent to the cheap model.
+
+        Args:
+            prompt (str): The comparison prompt.
+            entry_count (int): Number of key-value pairs in the compared sections; for a packed
+                               prompt, those of its largest task.
+            task_count (int): Number of tasks packed in the prompt.
+
+        Returns:
+            bool: True if every task of the comparison is small enough for the cheap model.
+        """
+        prompt_tokens = estimate_tokens(prompt, self.cheap_backend.name)
+        return (
+            prompt_tokens <= self.config["max_cheap_prompt_tokens"] * task_count
+            and entry_count <= self.config["max_cheap_entries"]
+        )
+
+    def generate(self, prompt, entry_count=0, validate=None, task_count=1):
+        """
+        Generate a comparison, escalating to the strong model if the cheap model fails or its
+        output is invalid.
+
+        Exceptions raised by the strong model (e.g. quota errors) propagate to the caller.
+
+        Args:
+            prompt (str): The comparison prompt.
+            entry_count (int): Number of key-value pairs in the compared sections; for a packed
+                               prompt, those of its largest task.
+            validate (callable, optional): Output check overriding the router's `validate`.
+            task_count (int): Number of tasks packed in the prompt, see `is_simple`.
+
+        Returns:
+            str: The model output.
+        """
+        validate = validate or self.validate
+        if not self.is_simple(prompt, entry_count, task_count):
+            self._count("routed_strong")
+            return self._call("strong", prompt)
+
+        self._count("routed_cheap")
+        output, error = None, None
+        try:
+            output = self._call("cheap", prompt)
+        except Exception as e:
+            error = e
+        if not self._cheap_output_failed(output, error, validate):
+            return output
+        return self._call("strong", prompt)
+
+    async def agenerate(self, prompt, entry_count=0, validate=None, task_count=1):
+        """
+        Asynchronous version of `generate`, using the backends' `agenerate`.
+
+        Args:
+            prompt (str): The comparison prompt.
+            entry_count (int): Number of key-value pairs in the compared sections; for a packed
+                               prompt, those of its largest task.
+            validate (callable, optional): Output check overriding the router's `validate`.
+            task_count (int): Number of tasks packed in the prompt, see `is_simple`.
+
+        Returns:
+            str: The model output.
+        """
+        validate = validate or self.validate
+        if not self.is_simple(prompt, entry_count, task_count):
+            self._count("routed_strong")
+            return await self._acall("strong", prompt)
+
+        self._count("routed_cheap")
+        output, error = None, None
+        try:
+            output = await self._acall("cheap", prompt)
+        except Exception as e:
+            error = e
+        if not self._cheap_output_failed(output, error, validate):
+            return output
+        return await self._acall("strong", prompt)
+
+    def print_stats(self):
+        """
+        Print calls, median latency per role and the escalation rate.
+        """
+        with self._lock:
+            for role, calls in self.stats["calls"].items():
+                latencies = sorted(self.stats["latency_seconds"][role])
+                p50 = latencies[len(latencies) // 2] if latencies else 0.0
+                print(f"{role.capitalize()} model {self._backend(role).name}: {calls} calls, p50 latency {p50:.2f}s")
+
+            routed_cheap = self.stats["routed_cheap"]
+            escalation_rate = self.stats["escalations"] / routed_cheap if routed_cheap else 0.0
+            print(
+                f"Routed to cheap model: {routed_cheap}, routed to strong model: {self.stats['routed_strong']}, "
+                f"escalations: {self.stats['escalations']} ({escalation_rate:.1%})"
+            )
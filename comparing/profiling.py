@@ -0,0 +1,348 @@
+# Import libraries
+import functools
+import inspect
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+import weakref
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+
+"""
+Opt-in profiling of the pipelines.
+
+    python cli.py --profile compare-table
+    python cli.py --profile --profile-python sampling preprocess reports.csv
+
+When enabled, the pipelines record spans for their stages (loading reports, each patient,
+each model call, retry waits, response parsing, saving) and every MongoDB command. At the
+end of the run:
+    - the spans are exported as a Chrome trace (open in chrome://tracing or ui.perfetto.dev);
+    - the slowest patients and calls, and the total time per span, are printed;
+    - optionally, the Python hot paths are profiled with cProfile (a .prof file and the top
+      functions) or with a sampling profiler (collapsed stacks for flame graph tools).
+
+When profiling is disabled, `span` and `traced` cost one attribute check.
+"""
+
+# Profiling configuration
+"""
+    - `summary_size`: number of slowest patients/reports and calls printed.
+    - `sampling_interval`: seconds between stack samples of the sampling profiler.
+"""
+PROFILING_CONFIG = {
+    "summary_size": 10,
+    "sampling_interval": 0.005,
+}
+
+# Span categories shown in the summary of slowest calls
+CALL_CATEGORIES = ("model", "mongo", "retry")
+
+# Spans covering one unit of work: a patient compared, or a report pre-processed
+UNIT_SPANS = ("patient", "report")
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+
+class Profiler:
+    """
+    Collects spans as Chrome trace "complete" events.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.output_dir = None
+        self.python_profiler = None
+        self._lock = threading.Lock()
+        # Tasks are dropped once finished, so a new task reusing the address gets its own track
+        self._task_ids = weakref.WeakKeyDictionary()
+        self._task_counter = itertools.count(1)
+        self._started = None
+        self._cprofile = None
+        self._sampler = None
+
+    def _now_us(self):
+        return time.perf_counter_ns() // 1000
+
+    def _thread_id(self):
+        """
+        Identify the running thread, or the running asyncio task so concurrent tasks get their own track.
+        """
+        # asyncio is only imported by the async pipelines, so it is looked up rather than imported
+        asyncio = sys.modules.get("asyncio")
+        try:
+            task = asyncio.current_task() if asyncio is not None else None
+        except RuntimeError:
+            task = None
+        if task is None:
+            return threading.get_ident() % 100000
+        if task not in self._task_ids:
+            self._task_ids[task] = 100000 + next(self._task_counter)
+        return self._task_ids[task]
+
+    def record(self, name, category, start_us, duration_us, args=None, tid=None):
+        """
+        Record one finished span.
+        """
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": start_us,
+            "dur": duration_us,
+            "pid": os.getpid(),
+            "tid": tid if tid is not None else self._thread_id(),
+            "args": args or {},
+        }
+        with self._lock:
+            self.events.append(event)
+
+    @contextmanager
+    def _span(self, name, category, args):
+        start = self._now_us()
+        tid = self._thread_id()
+        try:
+            yield
+        finally:
+            self.record(name, category, start, self._now_us() - start, args, tid)
+
+    def span(self, name, category="stage", **args):
+        """
+        Time a block of code as a span; does nothing when profiling is disabled.
+
+        Args:
+            name (str): Name of the span, e.g. "patient" or "model.generate".
+            category (str): Category of the span, e.g. "stage", "model", "mongo", "retry", "parse".
+            **args: Values shown with the span, e.g. patient_id.
+        """
+        if not self.enabled:
+            return _NULL_SPAN
+        return self._span(name, category, args)
+
+    # Lifecycle
+    def enable(self, output_dir="profiles", python_profiler=None):
+        """
+        Start profiling.
+
+        Args:
+            output_dir (str): Directory receiving the trace and profiler outputs.
+            python_profiler (str, optional): "cprofile" or "sampling".
+        """
+        self.enabled = True
+        self.output_dir = output_dir
+        self.python_profiler = python_profiler
+        self._started = datetime.now()
+        _register_mongo_listener(self)
+
+        if python_profiler == "cprofile":
+            import cProfile
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        elif python_profiler == "sampling":
+            self._sampler = SamplingProfiler(PROFILING_CONFIG["sampling_interval"])
+            self._sampler.start()
+
+    def finish(self, run_name="run"):
+        """
+        Stop profiling, write the outputs and print the summary.
+
+        Args:
+            run_name (str): Name used in the output file names.
+
+        Returns:
+            str | None: Path of the Chrome trace, or None if profiling was disabled.
+        """
+        if not self.enabled:
+            return None
+        self.enabled = False
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        prefix = os.path.join(self.output_dir, f"{run_name}-{self._started.strftime('%Y%m%d-%H%M%S')}")
+
+        trace_path = f"{prefix}.trace.json"
+        with open(trace_path, "w") as trace_file:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, trace_file, default=str)
+        print(f"Trace written to {trace_path} (open in chrome://tracing or https://ui.perfetto.dev).")
+
+        if self._cprofile is not None:
+            import pstats
+            self._cprofile.disable()
+            self._cprofile.dump_stats(f"{prefix}.prof")
+            print(f"cProfile output written to {prefix}.prof. Top functions by cumulative time:")
+            pstats.Stats(self._cprofile).sort_stats("cumulative").print_stats(PROFILING_CONFIG["summary_size"] * 2)
+            self._cprofile = None
+
+        if self._sampler is not None:
+            self._sampler.stop()
+            self._sampler.write_collapsed(f"{prefix}.folded")
+            print(f"Sampled stacks written to {prefix}.folded (flamegraph.pl or speedscope).")
+            self._sampler = None
+
+        self.print_summary()
+        return trace_path
+
+    # Summary
+    def print_summary(self, size=None):
+        """
+        Print the slowest patients or reports and calls, and the total time per span.
+        """
+        size = size or PROFILING_CONFIG["summary_size"]
+        events = list(self.events)
+
+        def describe(event):
+            details = ", ".join(f"{key}={value}" for key, value in event["args"].items())
+            return f"{event['dur'] / 1e6:9.3f} s  {event['name']}" + (f" ({details})" if details else "")
+
+        units = sorted((event for event in events if event["name"] in UNIT_SPANS), key=lambda e: -e["dur"])
+        if units:
+            print("\nSlowest patients/reports:")
+            for event in units[:size]:
+                print("  " + describe(event))
+
+        calls = sorted((event for event in events if event["cat"] in CALL_CATEGORIES), key=lambda e: -e["dur"])
+        if calls:
+            print("\nSlowest calls:")
+            for event in calls[:size]:
+                print("  " + describe(event))
+
+        totals = defaultdict(int)
+        counts = Counter()
+        for event in events:
+            totals[(event["cat"], event["name"])] += event["dur"]
+            counts[(event["cat"], event["name"])] += 1
+        print("\nTotal time per span:")
+        for (category, name), total in sorted(totals.items(), key=lambda item: -item[1]):
+            print(f"  {total / 1e6:9.3f} s  {counts[(category, name)]:7d} x  {category}/{name}")
+
+
+class SamplingProfiler:
+    """
+    Samples the Python stacks of every thread at a fixed interval, from a background thread.
+
+    The samples are written in the collapsed stack format ("frame;frame;frame count"), read by
+    flame graph tools such as flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self.samples[";".join(reversed(stack))] += 1
+
+    def write_collapsed(self, path):
+        with open(path, "w") as collapsed_file:
+            for stack, count in self.samples.most_common():
+                collapsed_file.write(f"{stack} {count}\n")
+
+
+def _register_mongo_listener(profiler):
+    """
+    Record every MongoDB command as a span, when pymongo is installed.
+
+    Listeners only apply to clients created afterwards, which is why the pipelines create
+    their clients lazily (see clients.py).
+    """
+    try:
+        from pymongo import monitoring
+    except ImportError:
+        return
+
+    class CommandSpanListener(monitoring.CommandListener):
+        def __init__(self):
+            self._pending = {}
+
+        def started(self, event):
+            collection = event.command.get(event.command_name)
+            self._pending[event.request_id] = {
+                "collection": collection if isinstance(collection, str) else "",
+                "database": event.database_name,
+            }
+
+        def _finish(self, event, failed):
+            args = self._pending.pop(event.request_id, {})
+            if failed:
+                args["failed"] = True
+            if profiler.enabled:
+                end = profiler._now_us()
+                profiler.record(f"mongo.{event.command_name}", "mongo", end - event.duration_micros, event.duration_micros, args)
+
+        def succeeded(self, event):
+            self._finish(event, False)
+
+        def failed(self, event):
+            self._finish(event, True)
+
+    monitoring.register(CommandSpanListener())
+
+
+profiler = Profiler()
+
+
+def span(name, category="stage", **args):
+    """
+    Time a block of code with the shared profiler, see `Profiler.span`.
+    """
+    return profiler.span(name, category, **args)
+
+
+def traced(name=None, category="stage"):
+    """
+    Decorator recording every call of a function, or coroutine function, as a span.
+
+    Args:
+        name (str, optional): Span name; defaults to the function name.
+        category (str): Span category.
+    """
+    def decorator(function):
+        span_name = name or function.__name__
+
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                if not profiler.enabled:
+                    return await function(*args, **kwargs)
+                with profiler.span(span_name, category):
+                    return await function(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return function(*args, **kwargs)
+            with profiler.span(span_name, category):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
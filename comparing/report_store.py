@@ -0,0 +1,259 @@
+# Import libraries
+from array import array
+from datetime import datetime
+
+import numpy as np
+
+from text_storage import COMPARISON_PROJECTION
+
+"""
+Columnar in-memory index of the processed reports, used by the comparison pipelines.
+
+Only the fields needed to group, order and schedule the patients are read up front, into
+compact NumPy arrays sorted once by (patient, date):
+    - `patient_codes`: integer code of each report's patient, indexing `patient_ids`;
+    - `dates`: performed date-time of each report, as datetime64 minutes;
+    - `ids`: `_id` of each report, used to fetch its full document later;
+    - `order_codes` / `priority`: `Order Name` code and `Priority` flag of each report, for the scheduler.
+
+Each patient is a contiguous run of rows between two document offsets (`starts`), so taking
+a patient's latest N reports is a slice of these arrays, not a copy. The full documents, with
+their sections, are only fetched from MongoDB for patients that are actually compared.
+"""
+
+DATE_FORMAT = "%d/%m/%Y %H:%M"
+
+# Zero-padded copy of `Performed Date Time` written by pre_processing.py, read when present
+NORMALIZED_DATE_FIELD = "Performed Date Time Normalized"
+
+# Fields read when building the index
+INDEX_PROJECTION = {
+    "PatientID": 1,
+    "Performed Date Time": 1,
+    NORMALIZED_DATE_FIELD: 1,
+    "Raw Report.Order Name": 1,
+    "Priority": 1,
+}
+
+# Layout of "dd/mm/YYYY HH:MM": digit columns and separators
+DATE_WIDTH = 16
+DIGIT_COLUMNS = [0, 1, 3, 4, 6, 7, 8, 9, 11, 12, 14, 15]
+SEPARATOR_COLUMNS = {2: "/", 5: "/", 10: " ", 13: ":"}
+
+
+def parse_report_dates(values):
+    """
+    Parse performed date-times in bulk, without creating a datetime object per report.
+
+    Values in the exact "dd/mm/YYYY HH:MM" layout are decoded from their character codes with
+    array operations. The few others (e.g. without zero padding) fall back to `datetime.strptime`.
+
+    Args:
+        values (list): Date-time strings in the format `DATE_FORMAT`.
+
+    Returns:
+        tuple: datetime64[m] array, NaT where a value could not be parsed, and a dictionary
+               mapping the positions of those values to their parsing errors.
+    """
+    text = np.asarray(values, dtype=str)
+    if text.size == 0:
+        return np.empty(0, dtype="datetime64[m]"), {}
+    if text.dtype.itemsize // 4 < DATE_WIDTH:
+        text = text.astype(f"U{DATE_WIDTH}")
+    width = text.dtype.itemsize // 4
+
+    # Unicode strings are stored as UTF-32 code points, padded with zeros
+    codes = np.ascontiguousarray(text).view(np.uint32).reshape(len(text), width)
+    valid = (codes[:, DATE_WIDTH - 1] != 0) & (codes[:, DATE_WIDTH:] == 0).all(axis=1)
+    for column, separator in SEPARATOR_COLUMNS.items():
+        valid &= codes[:, column] == ord(separator)
+
+    digits = codes[:, DIGIT_COLUMNS].astype(np.int64) - ord("0")
+    valid &= ((digits >= 0) & (digits <= 9)).all(axis=1)
+
+    day = digits[:, 0] * 10 + digits[:, 1]
+    month = digits[:, 2] * 10 + digits[:, 3]
+    year = digits[:, 4] * 1000 + digits[:, 5] * 100 + digits[:, 6] * 10 + digits[:, 7]
+    hour = digits[:, 8] * 10 + digits[:, 9]
+    minute = digits[:, 10] * 10 + digits[:, 11]
+
+    month_start = ((year - 1970) * 12 + month - 1).astype("datetime64[M]")
+    days_in_month = ((month_start + 1).astype("datetime64[D]") - month_start.astype("datetime64[D]")).astype(np.int64)
+    valid &= (month >= 1) & (month <= 12) & (day >= 1) & (day <= days_in_month) & (hour < 24) & (minute < 60)
+
+    minutes = ((day - 1) * 1440 + hour * 60 + minute).astype("timedelta64[m]")
+    dates = month_start.astype("datetime64[m]") + minutes
+    dates[~valid] = np.datetime64("NaT")
+
+    errors = {}
+    for position in np.flatnonzero(~valid):
+        try:
+            dates[position] = np.datetime64(datetime.strptime(values[position], DATE_FORMAT), "m")
+        except (TypeError, ValueError) as e:
+            errors[int(position)] = e
+    return dates, errors
+
+
+class PatientReports:
+    """
+    View of one patient's reports in a `ReportStore`, oldest first.
+
+    Dates and counts are read from the store's arrays; the full documents are only fetched by `load`.
+    """
+
+    def __init__(self, store, start, end):
+        self.store = store
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    @property
+    def dates(self):
+        """
+        datetime64[m] array of the report dates, a view on the store's array.
+        """
+        return self.store.dates[self.start:self.end]
+
+    def report_dates(self):
+        """
+        Get the report dates as datetime objects.
+        """
+        return self.dates.astype(datetime).tolist()
+
+    def latest_date(self):
+        """
+        Get the date of the newest report.
+        """
+        return self.store.dates[self.end - 1].astype(datetime)
+
+    def latest(self, count):
+        """
+        Narrow the view to the newest `count` reports.
+        """
+        return PatientReports(self.store, max(self.start, self.end - count), self.end)
+
+    def newest(self):
+        """
+        Get the newest report's date and the fields the scheduler reads, see `ComparisonScheduler.add`.
+
+        Returns:
+            tuple: The date (datetime object) and a partial report dictionary.
+        """
+        row = self.end - 1
+        return self.latest_date(), {
+            "Raw Report": {"Order Name": self.store.order_names[self.store.order_codes[row]]},
+            "Priority": bool(self.store.priority[row]),
+        }
+
+    def load(self):
+        """
+        Fetch the full documents of the reports.
+
+        Returns:
+            list: A list of tuples, each containing a datetime object and a report dictionary.
+        """
+        documents = self.store.load_documents(self.start, self.end)
+        return [(date, document) for date, document in zip(self.report_dates(), documents) if document is not None]
+
+
+class ReportStore:
+    """
+    Columnar index of the processed reports, grouped by patient and sorted by date.
+    """
+
+    def __init__(self, collection, storage, patient_ids, patient_codes, dates, ids, order_names, order_codes, priority):
+        self.collection = collection
+        self.storage = storage
+        self.patient_ids = patient_ids
+        self.order_names = order_names
+
+        # One global sort by (patient, date); lexsort sorts by its last key first
+        order = np.lexsort((dates, patient_codes))
+        self.patient_codes = patient_codes[order]
+        self.dates = dates[order]
+        self.ids = ids[order]
+        self.order_codes = order_codes[order]
+        self.priority = priority[order]
+
+        # Document offsets where each patient's run of reports starts, plus the end
+        boundaries = np.flatnonzero(np.diff(self.patient_codes)) + 1
+        ends = [len(self.patient_codes)] if len(self.patient_codes) else []
+        self.starts = np.concatenate(([0], boundaries, ends)).astype(np.int64)
+
+    @classmethod
+    def load(cls, collection, storage, query=None):
+        """
+        Build the index from the processed reports collection.
+
+        Args:
+            collection (Collection): Collection of processed reports.
+            storage (TextStorage): Storage used to decode the full documents once fetched.
+            query (dict, optional): MongoDB filter restricting the reports, e.g. to this worker's shards.
+
+        Returns:
+            ReportStore: The index. Reports with unparsable dates are skipped with a logged error.
+        """
+        patient_codes_by_id = {}
+        order_codes_by_name = {}
+        patient_codes = array("i")
+        order_codes = array("i")
+        priority = array("b")
+        date_values = []
+        ids = []
+
+        for report in collection.find(query or {}, INDEX_PROJECTION):
+            patient_codes.append(patient_codes_by_id.setdefault(report['PatientID'], len(patient_codes_by_id)))
+            order_name = (report.get('Raw Report') or {}).get('Order Name', "")
+            order_codes.append(order_codes_by_name.setdefault(order_name, len(order_codes_by_name)))
+            priority.append(bool(report.get('Priority')))
+            date_values.append(report.get(NORMALIZED_DATE_FIELD) or report.get('Performed Date Time'))
+            ids.append(report['_id'])
+
+        dates, errors = parse_report_dates(date_values)
+        for position, e in errors.items():
+            print(f"Error parsing date for report {ids[position]}: {e}")
+
+        id_array = np.empty(len(ids), dtype=object)
+        id_array[:] = ids
+        parsed = ~np.isnat(dates)
+        return cls(
+            collection,
+            storage,
+            list(patient_codes_by_id),
+            np.frombuffer(patient_codes, dtype=np.int32)[parsed],
+            dates[parsed],
+            id_array[parsed],
+            list(order_codes_by_name),
+            np.frombuffer(order_codes, dtype=np.int32)[parsed],
+            np.frombuffer(priority, dtype=np.int8)[parsed].astype(bool),
+        )
+
+    def __len__(self):
+        return len(self.starts) - 1
+
+    def items(self):
+        """
+        Iterate over the patients, like `dict.items()` on the grouped reports.
+
+        Returns:
+            generator: (patient ID, PatientReports) tuples.
+        """
+        for start, end in zip(self.starts[:-1].tolist(), self.starts[1:].tolist()):
+            yield self.patient_ids[self.patient_codes[start]], PatientReports(self, start, end)
+
+    def load_documents(self, start, end):
+        """
+        Fetch the full documents of a range of rows, in row order.
+
+        Returns:
+            list: The documents, wrapped so their compressed fields are decoded on access, or
+                  None for reports deleted since the index was built.
+        """
+        ids = self.ids[start:end].tolist()
+        documents = {
+            document['_id']: document
+            for document in self.collection.find({"_id": {"$in": ids}}, COMPARISON_PROJECTION)
+        }
+        return [self.storage.lazy(documents[report_id]) if report_id in documents else None for report_id in ids]
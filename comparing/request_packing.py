@@ -0,0 +1,272 @@
+# Import libraries
+import re
+from dataclasses import dataclass
+from comparison_records import parse_comparison_table
+from model_router import call_with_quota_retries, estimate_tokens, is_valid_comparison_output, section_entry_count
+
+# Packing configuration
+"""
+IMPORTANT: Keep `token_budget` below the context window of the smallest routed model and
+`output_token_budget` below its maximum output tokens (4096 for gpt-35-turbo, 8192 for
+gemini-1.5-flash and gpt-4o).
+`output_ratio` is the expected number of output tokens per input content token; the model
+repeats the contents in its table and adds an explanation per row.
+"""
+PACKING_CONFIG = {
+    "token_budget": 12000,
+    "output_token_budget": 4000,
+    "output_ratio": 1.5,
+}
+
+
+@dataclass
+class ComparisonUnit:
+    """
+    One section of one report pair to compare.
+    """
+    section_name: str
+    new_report: tuple
+    old_report: tuple
+    content1: object
+    content2: object
+
+    @property
+    def is_empty(self):
+        return not self.content1 and not self.content2
+
+
+DATE_FORMAT = "%d/%m/%Y %H:%M:%S"
+
+
+# Placeholders filling the pipeline's comparison prompt once per packed request; each task gives their values
+TASK_PLACEHOLDERS = {
+    "section_name": "<Section of the task>",
+    "section_content_1": "<Newer Report input of the task>",
+    "section_content_2": "<Older Report input of the task>",
+    "date1_str": "<Newer Report date of the task>",
+    "date2_str": "<Older Report date of the task>",
+}
+
+# Shared envelope of a packed prompt, followed by the pipeline's instructions and then the tasks
+PACKED_PROMPT_HEADER = (
+    "You are given several independent radiology report comparison tasks. Each task is delimited by "
+    "<task number=\"N\"> and </task> tags and gives a section name, the dates of the Newer and Older "
+    "Reports and their inputs. Apply the instructions below to each task separately, replacing the "
+    "placeholders in angle brackets with the values of that task.\n\n"
+
+    "### Output Format:\n"
+    "For every task, output its heading (e.g. ### Task 1) on its own line, followed only by the output "
+    "that task asks for: its comparison table, or *Both report sections are empty*.\n"
+    "Do not output any other text.\n\n"
+
+    "### Instructions for every task:\n"
+)
+
+
+def _format_task(task_number, unit):
+    """
+    Render the inputs of one unit inside a packed prompt, delimited.
+    """
+    date1_str = unit.new_report[0].strftime(DATE_FORMAT)
+    date2_str = unit.old_report[0].strftime(DATE_FORMAT)
+    return (
+        f'<task number="{task_number}">\n'
+        f"Section: {unit.section_name}\n"
+        f"Newer Report ({date1_str}): {unit.content1}\n"
+        f"Older Report ({date2_str}): {unit.content2}\n"
+        f"</task>\n\n"
+    )
+
+
+def packed_prompt_instructions(generate_prompt):
+    """
+    Build the part of a packed prompt shared by all of its tasks: the envelope and the pipeline's
+    comparison prompt, filled with `TASK_PLACEHOLDERS`.
+
+    Args:
+        generate_prompt (callable): `generate_comparison_prompt(section_name, content1, content2,
+                                    date1_str, date2_str)` of the calling pipeline.
+
+    Returns:
+        str: The shared instructions.
+    """
+    return f"{PACKED_PROMPT_HEADER}{generate_prompt(**TASK_PLACEHOLDERS).strip()}\n\n### Tasks:\n"
+
+
+def generate_packed_comparison_prompt(units, generate_prompt):
+    """
+    Generate one prompt comparing several (report pair, section) units.
+
+    The comparison instructions are sent once, followed by the inputs of each unit.
+
+    Args:
+        units (list): ComparisonUnit objects, numbered from 1 in the prompt.
+        generate_prompt (callable): Comparison prompt builder of the pipeline, see `packed_prompt_instructions`.
+
+    Returns:
+        str: The packed prompt.
+    """
+    return packed_prompt_instructions(generate_prompt) + "".join(_format_task(i + 1, unit) for i, unit in enumerate(units))
+
+
+def split_packed_response(response_text, task_count):
+    """
+    Split a packed response into the outputs of its tasks.
+
+    Args:
+        response_text (str): Raw model output for a packed prompt.
+        task_count (int): Number of tasks in the prompt.
+
+    Returns:
+        list: Output of each task in prompt order; "" for tasks missing from the response.
+    """
+    outputs = [""] * task_count
+    parts = re.split(r"^\s*(?:#+\s*)?\**Task\s+(\d+):?\**:?\s*$", response_text or "", flags=re.MULTILINE)
+
+    # re.split alternates text and captured task numbers: [preamble, number, body, number, body, ...]
+    for number, body in zip(parts[1::2], parts[2::2]):
+        index = int(number) - 1
+        if 0 <= index < task_count:
+            outputs[index] = body.strip()
+    return outputs
+
+
+def unit_tokens(unit, backend="gemini", config=PACKING_CONFIG):
+    """
+    Estimate the input and output tokens a unit adds to a packed request.
+
+    Args:
+        unit (ComparisonUnit): Unit to measure.
+        backend (str): Model or deployment name, see `estimate_tokens`.
+        config (dict): Packing configuration, see `PACKING_CONFIG`.
+
+    Returns:
+        tuple: (input tokens, expected output tokens).
+    """
+    input_tokens = estimate_tokens(_format_task(1, unit), backend)
+    content_tokens = estimate_tokens(f"{unit.content1 or ''}{unit.content2 or ''}", backend)
+    return input_tokens, int(content_tokens * config["output_ratio"]) + 20
+
+
+def pack_units(units, generate_prompt, backend="gemini", config=PACKING_CONFIG):
+    """
+    Greedily pack units, in order, into requests that fit the token budgets.
+
+    A unit too large to share a request is sent alone, whole: its sections are never split,
+    as the model needs both of them to match similar keys.
+
+    Args:
+        units (list): ComparisonUnit objects.
+        generate_prompt (callable): Comparison prompt builder of the pipeline, see `packed_prompt_instructions`.
+        backend (str): Model or deployment name, see `estimate_tokens`.
+        config (dict): Packing configuration, see `PACKING_CONFIG`.
+
+    Returns:
+        list: A list of batches, each a list of units sent in one request.
+    """
+    instruction_tokens = estimate_tokens(packed_prompt_instructions(generate_prompt), backend)
+    batches = []
+    batch, batch_input, batch_output = [], instruction_tokens, 0
+
+    for unit in units:
+        input_tokens, output_tokens = unit_tokens(unit, backend, config)
+        if batch and (
+            batch_input + input_tokens > config["token_budget"]
+            or batch_output + output_tokens > config["output_token_budget"]
+        ):
+            batches.append(batch)
+            batch, batch_input, batch_output = [], instruction_tokens, 0
+        batch.append(unit)
+        batch_input += input_tokens
+        batch_output += output_tokens
+
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def packed_request(batch, generate_prompt):
+    """
+    Build the model request of a batch of units, see `pack_units`.
+
+    Args:
+        batch (list): ComparisonUnit objects sent in one request.
+        generate_prompt (callable): Comparison prompt builder of the pipeline, see `packed_prompt_instructions`.
+
+    Returns:
+        tuple: (prompt, entry count of its largest task, validator of the packed output), the
+               arguments of `ModelRouter.generate`. A packed request is routed by its largest task.
+    """
+    prompt = generate_packed_comparison_prompt(batch, generate_prompt)
+    entry_count = max(section_entry_count(unit.content1, unit.content2) for unit in batch)
+
+    def validate(output):
+        return all(is_valid_comparison_output(task) for task in split_packed_response(output, len(batch)))
+    return prompt, entry_count, validate
+
+
+def packed_results(batch, response_text):
+    """
+    Parse the output of each unit of a packed request.
+
+    Args:
+        batch (list): ComparisonUnit objects sent in the request.
+        response_text (str | None): Raw model output, None if the request failed.
+
+    Returns:
+        list: (unit, rows) tuples in batch order; rows are None for units whose output is
+              missing or invalid, which must be compared alone.
+    """
+    results = []
+    for unit, task_output in zip(batch, split_packed_response(response_text, len(batch))):
+        if is_valid_comparison_output(task_output):
+            results.append((unit, parse_comparison_table(task_output)))
+        else:
+            print(f"Packed output for section '{unit.section_name}' is missing or invalid. Comparing it alone.")
+            results.append((unit, None))
+    return results
+
+
+def compare_units_packed(units, router, compare_single, generate_prompt, backend="gemini", config=PACKING_CONFIG, retries=3):
+    """
+    Compare units with as few requests as the token budgets allow.
+
+    Units whose sections are both empty are skipped. Tasks missing from a packed response,
+    or whose output fails validation, are compared again one by one with `compare_single`.
+    A packed request is routed by its largest task, see model_router.ROUTING_CONFIG.
+    `async_comparison.compare_units_async` is the asynchronous counterpart.
+
+    Args:
+        units (list): ComparisonUnit objects.
+        router (ModelRouter): Router used for the packed requests.
+        compare_single (callable): `compare_section(section_name, content1, content2, date1, date2)`
+                                   of the calling pipeline, returning parsed rows.
+        generate_prompt (callable): `generate_comparison_prompt(section_name, content1, content2,
+                                    date1_str, date2_str)` of the calling pipeline, sent once per packed request.
+        backend (str): Model or deployment name, see `estimate_tokens`.
+        config (dict): Packing configuration, see `PACKING_CONFIG`.
+        retries (int): Attempts per packed request when the API quota is exceeded.
+
+    Returns:
+        list: (unit, rows) tuples in the order of the units, rows being
+              (category, new content, old content, explanation) tuples.
+    """
+    def compare_alone(unit):
+        return compare_single(unit.section_name, unit.content1, unit.content2, unit.new_report[0], unit.old_report[0])
+
+    results = []
+    for batch in pack_units([unit for unit in units if not unit.is_empty], generate_prompt, backend, config):
+        if len(batch) == 1:
+            results.append((batch[0], compare_alone(batch[0])))
+            continue
+
+        prompt, entry_count, validate = packed_request(batch, generate_prompt)
+        response_text = call_with_quota_retries(
+            lambda: router.generate(prompt, entry_count, validate=validate, task_count=len(batch)),
+            f"packed comparison of {len(batch)} sections",
+            retries=retries
+        )
+        for unit, rows in packed_results(batch, response_text):
+            results.append((unit, rows if rows is not None else compare_alone(unit)))
+
+    return results
@@ -0,0 +1,374 @@
+# Import libraries
+import hashlib
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+"""
+Partitioned execution of the comparison pipelines across worker processes or nodes.
+
+Every PatientID hashes to one of `SHARD_BUCKETS` buckets, stored on each processed report as
+`PatientShard`. The buckets are split into `SHARD_COUNT` contiguous ranges (shards), and each
+worker only reads and compares the patients of the shards it holds. Shards are held either:
+    - statically: the worker is started with `SHARD_INDEX` (0-based) and `SHARD_COUNT`; or
+    - by lease: the worker is started with `SHARD_COUNT` only and claims free shards from the
+      `comparison_shard_leases` collection, renewing its leases while it runs. Once it has
+      compared the patients of its shards, it marks them done and claims more, until no
+      unfinished shard is left, so any number of workers covers every shard.
+
+A worker processes its shards in rounds:
+
+    while shard.claim():
+        ... compare the patients of `shard.query()` ...
+        shard.mark_done()
+    shard.release()
+
+`python sharding.py` backfills the shard buckets and clears the done markers of the previous
+run, before the workers are started.
+
+Comparison documents are written with `comparison_records.save_comparison_document`, so
+workers whose shards overlap (e.g. after a lease expired) never overwrite a newer comparison.
+"""
+
+SHARD_BUCKETS = 1024
+LEASE_COLLECTION = "comparison_shard_leases"
+
+
+def patient_shard_bucket(patient_id):
+    """
+    Hash a PatientID to its shard bucket. Stable across processes and Python versions.
+
+    Args:
+        patient_id (str): ID of the patient.
+
+    Returns:
+        int: Bucket in [0, SHARD_BUCKETS).
+    """
+    digest = hashlib.blake2b(str(patient_id).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % SHARD_BUCKETS
+
+
+def shard_bucket_range(shard_index, shard_count):
+    """
+    Return the bucket range [start, end) of a shard.
+    """
+    return shard_index * SHARD_BUCKETS // shard_count, (shard_index + 1) * SHARD_BUCKETS // shard_count
+
+
+def shard_query(shard_indices, shard_count):
+    """
+    Build the MongoDB filter selecting the reports of the given shards.
+
+    Reports written before `PatientShard` existed are also selected; they are filtered on the
+    client side with `ShardAssignment.owns_patient` until `assign_shard_buckets` backfills them.
+
+    Args:
+        shard_indices (list): Shards held by the worker.
+        shard_count (int): Total number of shards.
+
+    Returns:
+        dict: MongoDB filter.
+    """
+    ranges = [shard_bucket_range(shard_index, shard_count) for shard_index in shard_indices]
+    return {
+        "$or": [{"PatientShard": {"$gte": start, "$lt": end}} for start, end in ranges]
+               + [{"PatientShard": {"$exists": False}}]
+    }
+
+
+def assign_shard_buckets(collection):
+    """
+    Backfill `PatientShard` on processed reports that do not have it, and index it.
+
+    Args:
+        collection (Collection): Collection of processed reports.
+
+    Returns:
+        int: Number of updated reports.
+    """
+    # Imported here so shard hashing can be used without a MongoDB driver
+    from pymongo import UpdateMany
+
+    patient_ids = collection.distinct("PatientID", {"PatientShard": {"$exists": False}})
+    updated = 0
+    if patient_ids:
+        result = collection.bulk_write([
+            UpdateMany({"PatientID": patient_id}, {"$set": {"PatientShard": patient_shard_bucket(patient_id)}})
+            for patient_id in patient_ids
+        ], ordered=False)
+        updated = result.modified_count
+    collection.create_index([("PatientShard", 1), ("PatientID", 1)], name="patient_shard")
+    print(f"Assigned shard buckets to {updated} reports.")
+    return updated
+
+
+class ShardAssignment:
+    """
+    Shards held by a worker given a fixed `shard_index` out of `shard_count`.
+    """
+
+    def __init__(self, shard_indices, shard_count):
+        self.shard_indices = []
+        self.shard_count = shard_count
+        self._pending = list(shard_indices)
+
+    def claim(self):
+        """
+        Hold the next shards to process: the static shards once, then nothing.
+
+        Returns:
+            list: Indices of the held shards; empty when every shard of this worker is done.
+        """
+        self.shard_indices, self._pending = self._pending, []
+        return self.shard_indices
+
+    def mark_done(self):
+        """
+        Record that the patients of the held shards are compared, and stop holding them.
+        """
+        self.shard_indices = []
+
+    def query(self):
+        return shard_query(self.shard_indices, self.shard_count)
+
+    def owns_patient(self, patient_id):
+        """
+        Check whether a patient belongs to one of the held shards.
+        """
+        bucket = patient_shard_bucket(patient_id)
+        return any(
+            start <= bucket < end
+            for start, end in (shard_bucket_range(index, self.shard_count) for index in self.shard_indices)
+        )
+
+    def renewal_due(self):
+        """
+        Check whether `keep_alive` has leases to renew; static assignments never expire.
+        """
+        return False
+
+    def keep_alive(self):
+        """
+        Keep the held shards; static assignments never expire.
+        """
+
+    def release(self):
+        """
+        Release the held shards; static assignments hold nothing to release.
+        """
+
+
+class ShardLeaseManager(ShardAssignment):
+    """
+    Shards claimed through time-limited leases stored in MongoDB.
+
+    Each lease document is `{"_id": shard_index, "owner": worker_id, "expires_at": datetime}`,
+    plus `"done": True` once the shard's patients are compared. A shard can be claimed when it
+    is not done and has no lease, its lease expired, or it is already owned by this worker.
+    While shards are held, a background thread renews their leases, so a patient whose model
+    calls wait on quota retries cannot outlive the lease; `keep_alive` can also be called
+    between patients. Leases are released when the worker finishes.
+
+    Args:
+        lease_collection (Collection): Collection of lease documents.
+        worker_id (str): Unique ID of this worker.
+        shard_count (int): Total number of shards.
+        max_shards (int): Maximum number of shards held by this worker at a time.
+        lease_seconds (int): Lease duration; renewed once half of it has elapsed.
+    """
+
+    def __init__(self, lease_collection, worker_id, shard_count, max_shards=1, lease_seconds=300):
+        super().__init__([], shard_count)
+        self.lease_collection = lease_collection
+        self.worker_id = worker_id
+        self.max_shards = max_shards
+        self.lease_seconds = lease_seconds
+        self._renewed_at = 0.0
+        self._lock = threading.RLock()
+        self._heartbeat = None
+        self._stopped = threading.Event()
+
+    def claim(self):
+        """
+        Claim unfinished shards until `max_shards` are held.
+
+        Returns:
+            list: Indices of the held shards; empty when every shard is done or held by another worker.
+        """
+        # Imported here so shard hashing can be used without a MongoDB driver
+        from pymongo.errors import DuplicateKeyError
+
+        with self._lock:
+            now = datetime.now(timezone.utc)
+            for shard_index in range(self.shard_count):
+                if len(self.shard_indices) >= self.max_shards:
+                    break
+                if shard_index in self.shard_indices:
+                    continue
+                try:
+                    # The upsert fails with a duplicate key when the shard is done or another
+                    # worker holds a live lease
+                    self.lease_collection.find_one_and_update(
+                        {
+                            "_id": shard_index,
+                            "done": {"$ne": True},
+                            "$or": [{"expires_at": {"$lt": now}}, {"owner": self.worker_id}],
+                        },
+                        {"$set": {"owner": self.worker_id, "expires_at": now + timedelta(seconds=self.lease_seconds)}},
+                        upsert=True
+                    )
+                    self.shard_indices.append(shard_index)
+                    print(f"Worker {self.worker_id} claimed shard {shard_index}/{self.shard_count}.")
+                except DuplicateKeyError:
+                    continue
+
+            self._renewed_at = time.monotonic()
+            if self.shard_indices:
+                self._start_heartbeat()
+            return self.shard_indices
+
+    def _start_heartbeat(self):
+        if self._heartbeat is None:
+            self._stopped.clear()
+            self._heartbeat = threading.Thread(target=self._renew_until_stopped, daemon=True)
+            self._heartbeat.start()
+
+    def _renew_until_stopped(self):
+        while not self._stopped.wait(self.lease_seconds / 4):
+            try:
+                self.keep_alive()
+            except Exception as e:
+                print(f"Error renewing the leases of worker {self.worker_id}: {e}")
+
+    def renewal_due(self):
+        """
+        Check whether half of the lease duration has elapsed since the last renewal.
+        """
+        return time.monotonic() - self._renewed_at >= self.lease_seconds / 2
+
+    def keep_alive(self):
+        """
+        Renew the held leases once half of the lease duration has elapsed.
+
+        Shards whose lease was taken over by another worker are dropped.
+        """
+        with self._lock:
+            if not self.renewal_due():
+                return
+
+            now = datetime.now(timezone.utc)
+            still_held = []
+            for shard_index in self.shard_indices:
+                result = self.lease_collection.update_one(
+                    {"_id": shard_index, "owner": self.worker_id},
+                    {"$set": {"expires_at": now + timedelta(seconds=self.lease_seconds)}}
+                )
+                if result.matched_count:
+                    still_held.append(shard_index)
+                else:
+                    print(f"Worker {self.worker_id} lost its lease on shard {shard_index}.")
+            self.shard_indices = still_held
+            self._renewed_at = time.monotonic()
+
+    def mark_done(self):
+        """
+        Mark the held shards done, so no worker claims them again in this run, and release them.
+
+        Shards whose lease was taken over by another worker are left to that worker.
+        """
+        with self._lock:
+            now = datetime.now(timezone.utc)
+            self.lease_collection.update_many(
+                {"_id": {"$in": self.shard_indices}, "owner": self.worker_id},
+                {"$set": {"done": True, "expires_at": now, "done_at": now}, "$unset": {"owner": ""}}
+            )
+            self.shard_indices = []
+
+    def release(self):
+        """
+        Stop renewing and release every lease held by this worker; its shards stay unfinished.
+        """
+        self._stopped.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+            self._heartbeat = None
+        with self._lock:
+            self.lease_collection.update_many(
+                {"owner": self.worker_id},
+                {"$set": {"expires_at": datetime.now(timezone.utc)}, "$unset": {"owner": ""}}
+            )
+            self.shard_indices = []
+
+
+def reset_shard_leases(lease_collection):
+    """
+    Clear the done markers of the previous run, so the shards are compared again.
+
+    Args:
+        lease_collection (Collection): Collection of lease documents.
+
+    Returns:
+        int: Number of shards marked unfinished.
+    """
+    result = lease_collection.update_many({"done": True}, {"$unset": {"done": "", "done_at": ""}})
+    print(f"Reset {result.modified_count} finished shards.")
+    return result.modified_count
+
+
+def shard_assignment_from_env(db):
+    """
+    Build the shard assignment of this worker from environment variables.
+
+        SHARD_COUNT      Total number of shards. 1 or unset processes every patient.
+        SHARD_INDEX      0-based shard of this worker. Unset claims shards by lease.
+        SHARD_MAX        Maximum number of shards held by lease at a time (default 1).
+        SHARD_WORKER_ID  Unique worker ID for leases (default: hostname and process ID).
+
+    Args:
+        db (Database): MongoDB database holding the lease collection.
+
+    Returns:
+        ShardAssignment | None: The shards of this worker, claimed with `claim`, or None when
+                                sharding is disabled.
+    """
+    shard_count = int(os.environ.get("SHARD_COUNT", "1"))
+    if shard_count <= 1:
+        return None
+
+    if "SHARD_INDEX" in os.environ:
+        return ShardAssignment([int(os.environ["SHARD_INDEX"])], shard_count)
+
+    worker_id = os.environ.get("SHARD_WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+    return ShardLeaseManager(
+        db[LEASE_COLLECTION], worker_id, shard_count, max_shards=int(os.environ.get("SHARD_MAX", "1"))
+    )
+
+
+def main():
+    """
+    Backfill shard buckets on the processed reports, create the comparison indexes and clear
+    the done markers of the previous run, before starting sharded workers.
+    """
+    # Imported here so shard hashing can be used without a MongoDB driver
+    from pymongo import MongoClient
+    from pymongo.server_api import ServerApi
+    from comparison_records import PIPELINE_COLLECTIONS, ensure_indexes
+
+    # MongoDB setup
+    """
+    IMPORTANT: Replace the MongoDB URI, database name and collection name with your actual setup.
+    """
+    uri = ""
+    client = MongoClient(uri, server_api=ServerApi('1'))
+    db = client['ClinicalNotesReviewer']
+    assign_shard_buckets(db['processed_reports'])
+
+    # Workers racing on a patient rely on the unique PatientID index to keep the newest comparison
+    for collection_name in PIPELINE_COLLECTIONS.values():
+        ensure_indexes(db[collection_name])
+    reset_shard_leases(db[LEASE_COLLECTION])
+
+if __name__ == "__main__":
+    main()
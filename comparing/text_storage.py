@@ -0,0 +1,624 @@
+# Import libraries
+import hashlib
+import json
+import os
+import threading
+import zlib
+from datetime import datetime, timedelta
+
+"""
+Compressed storage of large text fields, and shared content references.
+
+Processed reports:
+    `Raw Report.Text`, `Processed Data.Layman Explanation` and `Processed Data.Summary` can be
+    stored compressed. A compressed field holds a small marker document:
+
+        {"_codec": "zstd", "_dict": "<dictionary ID>", "_type": "str" | "json", "_data": <bytes>}
+
+    zstd is used with a dictionary trained on the report corpus and stored in the
+    `compression_dictionaries` collection. Without the `zstandard` package, zlib is used with
+    a preset dictionary built from the same samples.
+
+Comparison documents:
+    `NewContent` and `OldContent` values can be replaced by `{"_ref": "<sha256>"}`, pointing to
+    one shared (and possibly compressed) value in the `comparison_contents` collection, so the
+    same section content is stored once instead of once per report pair. Contents no longer
+    referenced by any comparison document are removed with `python text_storage.py cleanup`.
+
+Reading is transparent and lazy: `TextStorage.lazy(document)` returns a dictionary that
+decompresses a field, or fetches a referenced content, only when that field is accessed.
+Documents written before compression was enabled are read unchanged.
+"""
+
+# Storage configuration
+"""
+IMPORTANT: Compression and content references are off unless enabled with the environment
+variables COMPRESS_TEXT=1 and CONTENT_REFS=1. Train a dictionary with
+`python text_storage.py train` once enough reports are stored. zstd requires the `zstandard`
+package (see requirements.txt); without it, zlib is used and a warning is printed.
+    - `min_chars`: shorter values are not compressed, as the marker would outweigh the saving.
+    - `min_ref_chars`: shorter NewContent / OldContent values are stored as they are. A
+      reference takes about 75 bytes, so most section contents (typically 100 to 250
+      characters) are worth sharing even though they are too short to compress.
+    - `level`: zstd / zlib compression level.
+    - `dictionary_size` / `dictionary_samples`: size of the trained dictionary and number of
+      reports it is trained on.
+    - `content_cache_size`: referenced contents kept in memory per database.
+"""
+STORAGE_CONFIG = {
+    "compress": os.environ.get("COMPRESS_TEXT", "0") == "1",
+    "content_refs": os.environ.get("CONTENT_REFS", "0") == "1",
+    "min_chars": 256,
+    "min_ref_chars": 96,
+    "level": 3,
+    "dictionary_size": 110 * 1024,
+    "dictionary_samples": 5000,
+    "content_cache_size": 100000,
+}
+
+DICTIONARY_COLLECTION = "compression_dictionaries"
+CONTENTS_COLLECTION = "comparison_contents"
+
+# Compressible fields of processed reports, as (parent field, field) pairs
+COMPRESSED_REPORT_FIELDS = [
+    ("Raw Report", "Text"),
+    ("Processed Data", "Layman Explanation"),
+    ("Processed Data", "Summary"),
+]
+CONTENT_FIELDS = ("NewContent", "OldContent")
+
+# Fields of processed reports the comparison pipelines never read
+COMPARISON_PROJECTION = {"Processed Data.Layman Explanation": 0}
+
+# zlib only uses the last 32 KB of a preset dictionary
+ZLIB_DICTIONARY_SIZE = 32 * 1024
+
+# Shared contents younger than this are never removed, as a comparison referencing them may
+# not be saved yet
+ORPHAN_GRACE_SECONDS = 24 * 60 * 60
+
+
+def _zstandard():
+    """
+    Import the optional `zstandard` package, or return None when it is not installed.
+    """
+    try:
+        import zstandard
+        return zstandard
+    except ImportError:
+        return None
+
+
+_zlib_fallback_warned = False
+
+
+def _warn_zlib_fallback():
+    """
+    Warn once per process that compression falls back to zlib.
+    """
+    global _zlib_fallback_warned
+    if not _zlib_fallback_warned:
+        _zlib_fallback_warned = True
+        print("Warning: the zstandard package is not installed. Compressing with zlib instead.")
+
+
+def is_compressed(value):
+    return isinstance(value, dict) and "_codec" in value and "_data" in value
+
+
+def is_content_ref(value):
+    return isinstance(value, dict) and set(value) == {"_ref"}
+
+
+def content_hash(value):
+    """
+    Hash a content value, used as its shared reference.
+    """
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()
+
+
+class TextCodec:
+    """
+    Compresses values with zstd (or zlib as a fallback) and one optional dictionary.
+
+    Args:
+        dictionary (bytes, optional): Trained dictionary data.
+        dictionary_id (str, optional): ID of the dictionary, stored in every marker.
+        codec (str): "zstd" or "zlib"; "zstd" requires the `zstandard` package.
+        level (int): Compression level.
+    """
+
+    def __init__(self, dictionary=None, dictionary_id=None, codec=None, level=STORAGE_CONFIG["level"]):
+        zstandard = _zstandard()
+        self.codec = codec or ("zstd" if zstandard else "zlib")
+        self.dictionary = dictionary
+        self.dictionary_id = dictionary_id
+        self.level = level
+
+        if self.codec == "zstd":
+            if zstandard is None:
+                raise ImportError("Reading zstd-compressed fields requires the zstandard package.")
+            dict_data = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+            self._compressor = zstandard.ZstdCompressor(level=level, dict_data=dict_data)
+            self._decompressor = zstandard.ZstdDecompressor(dict_data=dict_data)
+
+    def compress(self, value):
+        """
+        Compress a string, or a JSON-serialisable value such as a summary dictionary.
+
+        Returns:
+            dict: The compressed marker document.
+        """
+        value_type = "str" if isinstance(value, str) else "json"
+        raw = (value if value_type == "str" else json.dumps(value, ensure_ascii=False)).encode("utf-8")
+
+        if self.codec == "zstd":
+            data = self._compressor.compress(raw)
+        else:
+            compressor = zlib.compressobj(self.level, zdict=self.dictionary) if self.dictionary else zlib.compressobj(self.level)
+            data = compressor.compress(raw) + compressor.flush()
+
+        return {"_codec": self.codec, "_dict": self.dictionary_id, "_type": value_type, "_data": data}
+
+    def decompress(self, marker):
+        """
+        Decompress a marker document written by `compress`.
+        """
+        if self.codec == "zstd":
+            raw = self._decompressor.decompress(marker["_data"])
+        else:
+            decompressor = zlib.decompressobj(zdict=self.dictionary) if self.dictionary else zlib.decompressobj()
+            raw = decompressor.decompress(marker["_data"]) + decompressor.flush()
+
+        text = raw.decode("utf-8")
+        return text if marker.get("_type", "str") == "str" else json.loads(text)
+
+
+def train_dictionary(samples, size=STORAGE_CONFIG["dictionary_size"]):
+    """
+    Train a compression dictionary on sample texts.
+
+    Args:
+        samples (list): Sample strings, e.g. report texts.
+        size (int): Maximum dictionary size in bytes.
+
+    Returns:
+        tuple: (codec name, dictionary bytes).
+    """
+    encoded = [sample.encode("utf-8") for sample in samples if sample]
+    zstandard = _zstandard()
+    if zstandard is not None:
+        return "zstd", zstandard.train_dictionary(size, encoded).as_bytes()
+
+    # zlib preset dictionary: the most recent samples, most useful content last
+    data = b"".join(encoded)[-ZLIB_DICTIONARY_SIZE:]
+    return "zlib", data
+
+
+class LazyDocument(dict):
+    """
+    Dictionary that decompresses compressed fields and resolves content references on access.
+
+    Nested dictionaries and lists of dictionaries are wrapped the same way when accessed.
+    Iterating with `items()` or `values()` returns the stored values; use `to_dict()` to
+    decode everything.
+    """
+
+    def __init__(self, document, storage):
+        super().__init__(document)
+        self._storage = storage
+
+    def _decode(self, key, value):
+        decoded = value
+        if is_compressed(decoded) or is_content_ref(decoded):
+            decoded = self._storage.decode(decoded)
+        if isinstance(decoded, dict) and not isinstance(decoded, LazyDocument):
+            decoded = LazyDocument(decoded, self._storage)
+        elif isinstance(decoded, list) and any(isinstance(item, dict) and not isinstance(item, LazyDocument) for item in decoded):
+            decoded = [LazyDocument(item, self._storage) if isinstance(item, dict) else item for item in decoded]
+
+        # Keep the decoded value so each field is decoded at most once
+        if decoded is not value:
+            dict.__setitem__(self, key, decoded)
+        return decoded
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        return self._decode(key, value)
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        return self[key]
+
+    def to_dict(self):
+        """
+        Return a plain dictionary with every field decoded.
+        """
+        def plain(value):
+            if isinstance(value, LazyDocument):
+                return value.to_dict()
+            if isinstance(value, list):
+                return [plain(item) for item in value]
+            return value
+        return {key: plain(self[key]) for key in self}
+
+
+class TextStorage:
+    """
+    Compression and content references of one MongoDB database.
+
+    Dictionaries and referenced contents are loaded from MongoDB on first use and cached.
+
+    Args:
+        db (Database): MongoDB database holding the dictionary and content collections.
+        config (dict): Storage configuration, see `STORAGE_CONFIG`.
+    """
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, db, config=STORAGE_CONFIG):
+        self.db = db
+        self.config = config
+        self._codecs = {}
+        self._contents = {}
+        self._contents_lock = threading.Lock()
+        self._current_codec = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_database(cls, db):
+        """
+        Get the shared TextStorage of a database.
+        """
+        key = (id(db.client), db.name)
+        with cls._instances_lock:
+            if key not in cls._instances:
+                cls._instances[key] = cls(db)
+            return cls._instances[key]
+
+    # Dictionaries
+    def codec_for(self, codec_name, dictionary_id):
+        """
+        Get the codec decoding markers written with a given codec and dictionary.
+        """
+        key = (codec_name, dictionary_id)
+        with self._lock:
+            if key not in self._codecs:
+                dictionary = None
+                if dictionary_id is not None:
+                    stored = self.db[DICTIONARY_COLLECTION].find_one({"_id": dictionary_id})
+                    if stored is None:
+                        raise KeyError(f"Compression dictionary {dictionary_id} not found.")
+                    dictionary = stored["data"]
+                self._codecs[key] = TextCodec(dictionary, dictionary_id, codec=codec_name, level=self.config["level"])
+            return self._codecs[key]
+
+    def current_codec(self):
+        """
+        Get the codec used for new writes: the latest trained dictionary of an available codec.
+        """
+        if self._current_codec is None:
+            if _zstandard():
+                codecs = ["zstd", "zlib"]
+            else:
+                _warn_zlib_fallback()
+                codecs = ["zlib"]
+            latest = self.db[DICTIONARY_COLLECTION].find_one(
+                {"codec": {"$in": codecs}}, {"data": 0}, sort=[("created", -1)]
+            )
+            if latest is None:
+                self._current_codec = self.codec_for(codecs[0], None)
+            else:
+                self._current_codec = self.codec_for(latest["codec"], latest["_id"])
+        return self._current_codec
+
+    def train(self, collection, sample_count=STORAGE_CONFIG["dictionary_samples"]):
+        """
+        Train a dictionary on a sample of report texts and make it the dictionary for new writes.
+
+        Args:
+            collection (Collection): Collection of processed reports.
+            sample_count (int): Number of sampled reports.
+
+        Returns:
+            str: ID of the stored dictionary.
+        """
+        samples = []
+        for report in collection.aggregate([{"$sample": {"size": sample_count}}]):
+            report = self.lazy(report)
+            samples.append(report["Raw Report"].get("Text", ""))
+            samples.append(report.get("Processed Data", {}).get("Layman Explanation", ""))
+
+        codec_name, dictionary = train_dictionary([sample for sample in samples if isinstance(sample, str)])
+        dictionary_id = hashlib.sha256(dictionary).hexdigest()[:16]
+        self.db[DICTIONARY_COLLECTION].replace_one(
+            {"_id": dictionary_id},
+            {"_id": dictionary_id, "codec": codec_name, "data": dictionary, "created": datetime.utcnow()},
+            upsert=True
+        )
+        self._current_codec = None
+        print(f"Trained {codec_name} dictionary {dictionary_id} ({len(dictionary)} bytes) on {len(samples)} texts.")
+        return dictionary_id
+
+    # Reading
+    def decode(self, value):
+        """
+        Decode a compressed marker or a content reference; other values are returned unchanged.
+        """
+        if is_compressed(value):
+            return self.codec_for(value["_codec"], value.get("_dict")).decompress(value)
+        if is_content_ref(value):
+            return self.content(value["_ref"])
+        return value
+
+    def lazy(self, document):
+        """
+        Wrap a stored document so its fields are decoded only when accessed.
+        """
+        return LazyDocument(document, self)
+
+    def content(self, ref):
+        """
+        Get one referenced content value.
+        """
+        return self.prefetch_contents([ref])[ref]
+
+    def prefetch_contents(self, refs):
+        """
+        Load referenced contents in one query, skipping the ones already cached.
+
+        Returns:
+            dict: Every requested reference mapped to its value. The shared cache may be cleared
+                  by another thread at any time, so callers read the values from this dictionary.
+        """
+        refs = set(refs)
+        with self._contents_lock:
+            contents = {ref: self._contents[ref] for ref in refs if ref in self._contents}
+        missing = [ref for ref in refs if ref not in contents]
+        if not missing:
+            return contents
+
+        loaded = {
+            stored["_id"]: self.decode(stored["value"])
+            for stored in self.db[CONTENTS_COLLECTION].find({"_id": {"$in": missing}})
+        }
+        for ref in missing:
+            if ref not in loaded:
+                raise KeyError(f"Comparison content {ref} not found.")
+        self._cache_contents(loaded)
+        contents.update(loaded)
+        return contents
+
+    def _cache_contents(self, contents):
+        with self._contents_lock:
+            if len(self._contents) + len(contents) > self.config["content_cache_size"]:
+                self._contents.clear()
+            self._contents.update(contents)
+
+    def resolve_contents(self, document):
+        """
+        Return a copy of a comparison document with every content reference replaced by its value.
+
+        Args:
+            document (dict): Stored comparison document.
+
+        Returns:
+            dict: Comparison document with plain content values.
+        """
+        comparisons = document.get("Comparisons")
+        if not isinstance(comparisons, list):
+            return document
+
+        refs = [
+            entry[field]["_ref"]
+            for entry in comparisons if isinstance(entry, dict)
+            for field in CONTENT_FIELDS if is_content_ref(entry.get(field))
+        ]
+        if not refs:
+            return document
+        contents = self.prefetch_contents(refs)
+
+        resolved = dict(document)
+        resolved["Comparisons"] = [
+            {
+                key: contents[value["_ref"]] if key in CONTENT_FIELDS and is_content_ref(value) else value
+                for key, value in entry.items()
+            }
+            if isinstance(entry, dict) else entry
+            for entry in comparisons
+        ]
+        return resolved
+
+    # Writing
+    def compress_value(self, value):
+        """
+        Compress a value when it is large enough, otherwise return it unchanged.
+        """
+        if value is None or is_compressed(value) or is_content_ref(value):
+            return value
+        size = len(value) if isinstance(value, str) else len(json.dumps(value, ensure_ascii=False))
+        if size < self.config["min_chars"]:
+            return value
+        return self.current_codec().compress(value)
+
+    def compress_report(self, document):
+        """
+        Return a copy of a processed report with its large text fields compressed.
+
+        Args:
+            document (dict): Report document from `pre_processing.build_report_document`.
+
+        Returns:
+            dict: The document to store.
+        """
+        if not self.config["compress"]:
+            return document
+
+        compressed = dict(document)
+        for parent, field in COMPRESSED_REPORT_FIELDS:
+            if isinstance(compressed.get(parent), dict) and field in compressed[parent]:
+                compressed[parent] = dict(compressed[parent])
+                compressed[parent][field] = self.compress_value(compressed[parent][field])
+        return compressed
+
+    def externalize_contents(self, document):
+        """
+        Store the large content values of a comparison document once in the shared content
+        collection and return a copy of the document referencing them.
+
+        Args:
+            document (dict): Canonical comparison document.
+
+        Returns:
+            dict: The document to store.
+        """
+        comparisons = document.get("Comparisons")
+        if not self.config["content_refs"] or not isinstance(comparisons, list):
+            return document
+
+        # Imported here so reading stored documents does not need the MongoDB driver loaded
+        from pymongo import UpdateOne
+
+        contents = {}
+        entries = []
+        for entry in comparisons:
+            entry = dict(entry)
+            for field in CONTENT_FIELDS:
+                value = entry.get(field)
+                if isinstance(value, str) and len(value) >= self.config["min_ref_chars"]:
+                    ref = content_hash(value)
+                    contents[ref] = value
+                    entry[field] = {"_ref": ref}
+            entries.append(entry)
+
+        if contents:
+            # Every referenced content is upserted, even when cached: `remove_orphan_contents` may
+            # have removed it since. Contents are immutable, so only `last_used` is updated.
+            now = datetime.utcnow()
+            self.db[CONTENTS_COLLECTION].bulk_write([
+                UpdateOne(
+                    {"_id": ref},
+                    {
+                        "$setOnInsert": {"value": self.compress_value(value), "created": now},
+                        "$set": {"last_used": now},
+                    },
+                    upsert=True
+                )
+                for ref, value in contents.items()
+            ], ordered=False)
+            self._cache_contents(contents)
+
+        externalized = dict(document)
+        externalized["Comparisons"] = entries
+        return externalized
+
+    def remove_orphan_contents(self, comparison_collections, grace_seconds=ORPHAN_GRACE_SECONDS):
+        """
+        Remove the shared contents that no comparison document references anymore, e.g. after
+        a patient's comparison was replaced.
+
+        Contents last referenced less than `grace_seconds` ago are kept, since a pipeline may
+        have stored them for a comparison document it has not saved yet. Every save refreshes
+        `last_used`, and the deletion checks it again, so a content referenced again while the
+        comparison documents are scanned is kept.
+
+        Args:
+            comparison_collections (list): Every collection of comparison documents using the
+                                           shared contents.
+            grace_seconds (int): Minimum time since a removed content was last referenced.
+
+        Returns:
+            int: Number of removed contents.
+        """
+        referenced = set()
+        for comparison_collection in comparison_collections:
+            for entry in comparison_collection.aggregate([
+                {"$unwind": "$Comparisons"},
+                {"$project": {field: f"$Comparisons.{field}._ref" for field in CONTENT_FIELDS}},
+            ]):
+                referenced.update(entry[field] for field in CONTENT_FIELDS if isinstance(entry.get(field), str))
+
+        # Contents written before `last_used` existed only have their creation date
+        cutoff = datetime.utcnow() - timedelta(seconds=grace_seconds)
+        unused = {"$or": [
+            {"last_used": {"$lt": cutoff}},
+            {"last_used": {"$exists": False}, "created": {"$lt": cutoff}},
+            {"last_used": {"$exists": False}, "created": {"$exists": False}},
+        ]}
+        orphans = [
+            stored["_id"]
+            for stored in self.db[CONTENTS_COLLECTION].find(unused, {"_id": 1})
+            if stored["_id"] not in referenced
+        ]
+
+        removed = 0
+        for start in range(0, len(orphans), 1000):
+            removed += self.db[CONTENTS_COLLECTION].delete_many(
+                {"$and": [{"_id": {"$in": orphans[start:start + 1000]}}, unused]}
+            ).deleted_count
+        with self._contents_lock:
+            for ref in orphans:
+                self._contents.pop(ref, None)
+        print(f"Removed {removed} orphaned comparison contents.")
+        return removed
+
+
+def main():
+    """
+    Train a compression dictionary, compress the stored reports and comparison contents, or
+    remove the shared contents no comparison references anymore.
+
+        python text_storage.py train
+        python text_storage.py compress
+        python text_storage.py cleanup
+    """
+    import argparse
+    from clients import mongo_client
+    # Imported here as comparison_records imports this module
+    from comparison_records import PIPELINE_COLLECTIONS
+
+    parser = argparse.ArgumentParser(description="Manage compressed storage of report text.")
+    parser.add_argument("action", choices=["train", "compress", "cleanup"])
+    args = parser.parse_args()
+
+    # MongoDB setup
+    """
+    IMPORTANT: Replace the MongoDB URI, database name and collection names with your actual setup.
+    The comparison collections are listed in comparison_records.PIPELINE_COLLECTIONS.
+    """
+    uri = ""
+    db = mongo_client(uri)['ClinicalNotesReviewer']
+    collection = db['processed_reports']
+    comparison_collection_names = list(PIPELINE_COLLECTIONS.values())
+
+    storage = TextStorage.for_database(db)
+    if args.action == "train":
+        storage.train(collection)
+        return
+    if args.action == "cleanup":
+        storage.remove_orphan_contents([db[collection_name] for collection_name in comparison_collection_names])
+        return
+
+    from pymongo import ReplaceOne
+
+    storage.config = dict(storage.config, compress=True, content_refs=True)
+    requests = []
+    for report in collection.find({}):
+        requests.append(ReplaceOne({"_id": report["_id"]}, storage.compress_report(report)))
+        if len(requests) >= 500:
+            collection.bulk_write(requests, ordered=False)
+            requests = []
+    if requests:
+        collection.bulk_write(requests, ordered=False)
+    print("Compressed processed reports.")
+
+    for collection_name in comparison_collection_names:
+        comparison_collection = db[collection_name]
+        for document in comparison_collection.find({}):
+            comparison_collection.replace_one({"_id": document["_id"]}, storage.externalize_contents(document))
+        print(f"Referenced shared contents in {collection_name}.")
+
+if __name__ == "__main__":
+    main()
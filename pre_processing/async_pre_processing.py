@@ -0,0 +1,204 @@
+# Import libraries
+import asyncio
+from pymongo.errors import BulkWriteError
+# pre_processing puts the comparison scripts' folder on the path, see pre_processing.COMPARING_DIR
+import pre_processing
+from lexicon_extractor import LEXICON_CONFIG, get_extractor, merge_summaries
+
+# Shared asynchronous helpers live next to the comparison scripts
+from async_support import AsyncRateLimiter, batch_writer, call_with_quota_retries
+from clients import async_mongo_client, close_async_mongo_client
+from profiling import span
+from text_storage import TextStorage
+
+"""
+Asynchronous mode of pre_processing.py.
+
+Rows of the raw CSV file flow through bounded queues, so a slow stage applies backpressure
+to the ones before it:
+
+    read (report texts) -> generate (layman explanation and summary calls) -> write (batched inserts)
+
+The prompts, parsing, Gemini model and MongoDB settings of pre_processing.py are reused.
+Instead of sending one report at a time, concurrent requests are spaced by a shared rate limiter.
+"""
+
+# Asynchronous pipeline configuration
+"""
+IMPORTANT: Keep `requests_per_minute` within your API quota. Each report makes two requests.
+"""
+ASYNC_CONFIG = {
+    "max_in_flight": 200,
+    "requests_per_minute": 1000,
+    "workers": 100,
+    "row_queue_size": 200,
+    "write_queue_size": 200,
+    "write_batch_size": 100,
+}
+
+EMPTY_SUMMARY = {
+    "Diseases Mentioned": {},
+    "Organs Mentioned": {},
+    "Symptoms/Phenomena of Concern": {}
+}
+
+
+async def generate_text_async(prompt, description, limiter, semaphore):
+    """
+    Send a prompt to the Gemini model asynchronously.
+
+    Returns:
+        str | None: The stripped response text, or None if the call failed.
+    """
+    async def make_call():
+        with span("model.generate", "model", call=description):
+            response = await pre_processing.get_model().generate_content_async(prompt)
+        return response.text.strip() if hasattr(response, 'text') and response.text else ""
+
+    return await call_with_quota_retries(make_call, description, limiter=limiter, semaphore=semaphore)
+
+
+async def process_row_async(report_text, limiter, semaphore):
+    """
+    Generate the layman explanation and summary of one report concurrently.
+
+    Args:
+        report_text (str): Text of the report.
+        limiter (AsyncRateLimiter): Shared request rate limiter.
+        semaphore (asyncio.Semaphore): Shared bound on model calls in flight.
+
+    Returns:
+        tuple: The layman explanation and the summary.
+    """
+    # Only the clauses the lexicon cannot classify are summarised by the model, see lexicon_extractor.py
+    extraction = get_extractor().extract(report_text) if LEXICON_CONFIG["enabled"] else None
+    summary_input = report_text if extraction is None else extraction.unclassified_text
+
+    async def generate_summary_text():
+        if not summary_input:
+            return ""
+        return await generate_text_async(pre_processing.build_summary_prompt(summary_input), "summary", limiter, semaphore)
+
+    layman_text, summary_text = await asyncio.gather(
+        generate_text_async(pre_processing.build_layman_prompt(report_text), "layman explanation", limiter, semaphore),
+        generate_summary_text(),
+    )
+
+    if layman_text is None:
+        layman_explanation = "Error generating layman explanation."
+    else:
+        layman_explanation = layman_text or "Layman explanation could not be generated."
+
+    if extraction is not None and not summary_input:
+        summary = extraction.summary
+    elif summary_text is None:
+        summary = dict(EMPTY_SUMMARY)
+    else:
+        summary = pre_processing.parse_summary(summary_text or "Summary could not be generated.")
+
+    if extraction is not None and summary_input:
+        summary = merge_summaries(extraction.summary, summary)
+
+    return layman_explanation, summary
+
+
+async def row_worker(row_queue, write_queue, report_fields, limiter, semaphore):
+    """
+    Take (row position, report text) items from the row queue and put their report documents on the write queue.
+
+    The static fields of the documents are built column-wise beforehand, see `pre_processing.build_report_fields`.
+    """
+    while True:
+        item = await row_queue.get()
+        if item is None:
+            row_queue.task_done()
+            return
+        position, report_text = item
+        patient_id = report_fields[position]["PatientID"]
+        try:
+            with span("report", patient_id=patient_id):
+                layman_explanation, summary = await process_row_async(report_text, limiter, semaphore)
+            await write_queue.put(
+                pre_processing.build_report_document(report_fields[position], layman_explanation, summary)
+            )
+        except Exception as e:
+            print(f"Error processing report of {patient_id}: {e}")
+        finally:
+            row_queue.task_done()
+
+
+async def run_async_pre_processing(csv_path, config=ASYNC_CONFIG):
+    """
+    Pre-process every report of a CSV file asynchronously and insert the results into MongoDB.
+
+    Args:
+        csv_path (str): Path of the raw CSV file.
+        config (dict): Asynchronous pipeline configuration, see `ASYNC_CONFIG`.
+
+    Returns:
+        int: Number of inserted report documents.
+    """
+    # Imported here so the pipeline can be imported without loading pandas, see startup_benchmark.py
+    import pandas as pd
+
+    df = pd.read_csv(csv_path)
+    print("read csv")
+    report_fields = pre_processing.build_report_fields(df)
+
+    collection = async_mongo_client(pre_processing.uri)[pre_processing.DATABASE_NAME][pre_processing.COLLECTION_NAME]
+
+    limiter = AsyncRateLimiter(config["requests_per_minute"])
+    semaphore = asyncio.Semaphore(config["max_in_flight"])
+    row_queue = asyncio.Queue(maxsize=config["row_queue_size"])
+    write_queue = asyncio.Queue(maxsize=config["write_queue_size"])
+
+    # Large text fields are stored compressed when enabled; the dictionary is read with the synchronous client
+    storage = TextStorage.for_database(pre_processing.get_collection().database)
+
+    async def write_documents(documents):
+        try:
+            # Compression may read the dictionary with the synchronous client, so it runs off the event loop
+            documents = await asyncio.to_thread(lambda: [storage.compress_report(document) for document in documents])
+            result = await collection.insert_many(documents, ordered=False)
+            print(f"Inserted {len(result.inserted_ids)} reports into MongoDB.")
+            return len(result.inserted_ids)
+        except BulkWriteError as e:
+            print(f"Inserted {e.details['nInserted']} reports into MongoDB. Error uploading the others: {e}")
+            return e.details["nInserted"]
+        except Exception as e:
+            print(f"Error uploading data to MongoDB: {e}")
+            return 0
+
+    try:
+        writer = asyncio.create_task(batch_writer(write_queue, write_documents, config["write_batch_size"]))
+        workers = [
+            asyncio.create_task(row_worker(row_queue, write_queue, report_fields, limiter, semaphore))
+            for _ in range(config["workers"])
+        ]
+
+        for item in enumerate(df['Text'].tolist()):
+            await row_queue.put(item)
+        for _ in workers:
+            await row_queue.put(None)
+
+        await asyncio.gather(*workers)
+        await write_queue.put(None)
+        written = await writer
+    finally:
+        await close_async_mongo_client(pre_processing.uri)
+
+    return written
+
+
+def main(csv_path='Chest Scans_deidentified_test.csv'):
+    """
+    Run the asynchronous pre-processing pipeline.
+    """
+    """
+    IMPORTANT: Replace 'Chest Scans_deidentified_test.csv' with the correct file path to your dataset,
+    or pass it as `csv_path`.
+    """
+    asyncio.run(run_async_pre_processing(csv_path))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,439 @@
+# Import libraries
+import json
+import os
+import re
+
+"""
+Local, CPU-only extraction of organs, diseases and symptoms from radiology report text.
+
+The terms of a radiology lexicon are compiled into one Aho-Corasick automaton, so each report
+is scanned once whatever the size of the lexicon. Every match is mapped to the canonical key of
+its summary section. Sentences are split into clauses at "but" and "however", and findings of a
+clause preceded or followed by a negation ("No consolidation", "effusion is not seen") or an
+uncertainty marker ("?pneumonia", "possible nodule") are recorded under "Negated Findings" and
+"Uncertain Findings" instead of as findings. "No interval change in the effusion" is not a
+negation.
+
+The result has the same sections as `pre_processing.parse_summary`, plus the negated and
+uncertain findings, so it can replace or pre-fill the model's summary:
+    - reports whose clauses all mention an organ or a finding of the lexicon need no model call;
+    - otherwise only the clauses the lexicon could not classify are sent to the model, including
+      clauses matching only normal or administrative terms ("Compared to the previous study,
+      the endotracheal tube tip is now 2 cm above the carina").
+"""
+
+# Lexicon configuration
+"""
+IMPORTANT: The lexicon extractor is off unless enabled with the environment variable
+LEXICON_EXTRACTOR=1; until then every report is sent to the model. Check its results on a sample
+of your reports before enabling it, since findings missing from the lexicon are only recovered
+when the model is sent their clause.
+"""
+LEXICON_CONFIG = {
+    "enabled": os.environ.get("LEXICON_EXTRACTOR", "0") == "1",
+}
+
+"""
+IMPORTANT: Extend `RADIOLOGY_LEXICON` to your reports, or point the LEXICON_PATH environment
+variable to a JSON file with the same structure, which replaces the default lexicon.
+    - Section names are the summary sections; each maps canonical keys to their synonyms.
+    - "Normal Findings" marks sentences stating that a study or organ is normal.
+    - "Ignored" marks administrative sentences (views, comparisons, signatures).
+Terms are matched case-insensitively on whole words.
+"""
+RADIOLOGY_LEXICON = {
+    "Organs Mentioned": {
+        "Heart": ["heart", "cardiac", "cardiac silhouette", "cardiac shadow", "cardiomediastinal silhouette"],
+        "Lungs": ["lung", "lungs", "lung fields", "lung zones", "pulmonary", "lung parenchyma"],
+        "Pleura": ["pleura", "pleural space", "pleural spaces", "costophrenic angle", "costophrenic angles"],
+        "Mediastinum": ["mediastinum", "mediastinal", "mediastinal contour", "mediastinal contours"],
+        "Hila": ["hilum", "hila", "hilar"],
+        "Aorta": ["aorta", "aortic", "aortic knuckle", "aortic arch"],
+        "Diaphragm": ["diaphragm", "hemidiaphragm", "hemidiaphragms", "diaphragms"],
+        "Trachea": ["trachea", "tracheal"],
+        "Bones": ["bones", "bony", "osseous", "ribs", "rib", "spine", "clavicle", "thoracic spine"],
+        "Soft Tissues": ["soft tissue", "soft tissues"],
+    },
+    "Symptoms/Phenomena of Concern": {
+        "Pleural Effusion": ["effusion", "effusions", "pleural effusion", "pleural effusions", "blunting"],
+        "Consolidation": ["consolidation", "consolidations", "airspace opacity", "airspace opacities"],
+        "Atelectasis": ["atelectasis", "atelectatic", "collapse", "plate atelectasis", "subsegmental atelectasis"],
+        "Pneumothorax": ["pneumothorax", "pneumothoraces"],
+        "Cardiomegaly": ["cardiomegaly", "enlarged heart", "cardiac enlargement"],
+        "Pulmonary Oedema": ["oedema", "edema", "pulmonary oedema", "pulmonary edema", "vascular congestion"],
+        "Opacity": ["opacity", "opacities", "shadowing", "haziness", "infiltrate", "infiltrates"],
+        "Nodule": ["nodule", "nodules", "nodular opacity", "mass", "lesion"],
+        "Fibrosis": ["fibrosis", "fibrotic", "scarring", "reticular opacities"],
+        "Emphysema": ["emphysema", "hyperinflation", "hyperinflated"],
+        "Fracture": ["fracture", "fractures"],
+        "Calcification": ["calcification", "calcifications", "calcified"],
+        "Bronchiectasis": ["bronchiectasis"],
+        "Lymphadenopathy": ["lymphadenopathy", "enlarged lymph nodes"],
+        "Cavitation": ["cavity", "cavities", "cavitation", "cavitating", "cavitary"],
+    },
+    "Diseases Mentioned": {
+        "Tuberculosis": ["tuberculosis", "tb", "pulmonary tuberculosis"],
+        "Pneumonia": ["pneumonia", "bronchopneumonia"],
+        "Chronic Obstructive Pulmonary Disease": ["copd", "chronic obstructive pulmonary disease"],
+        "Heart Failure": ["heart failure", "cardiac failure", "congestive heart failure"],
+        "Lung Cancer": ["lung cancer", "carcinoma", "malignancy", "metastases", "metastasis"],
+        "Sarcoidosis": ["sarcoidosis"],
+    },
+    "Normal Findings": {
+        "Normal": [
+            "normal", "unremarkable", "clear", "within normal limits", "no acute abnormality",
+            "no active lung lesion", "no significant abnormality", "not enlarged", "intact",
+        ],
+    },
+    "Ignored": {
+        "Ignored": [
+            "comparison", "compared", "previous", "prior", "view", "views", "pa", "ap", "lateral",
+            "erect", "supine", "frontal", "radiograph", "x-ray", "xray", "film", "reported by",
+            "dictated", "verified", "clinical", "history", "indication", "technique", "dr",
+        ],
+    },
+}
+
+SUMMARY_SECTIONS = ["Diseases Mentioned", "Organs Mentioned", "Symptoms/Phenomena of Concern"]
+FINDING_SECTIONS = ["Diseases Mentioned", "Symptoms/Phenomena of Concern"]
+NEGATED_SECTION = "Negated Findings"
+UNCERTAIN_SECTION = "Uncertain Findings"
+
+# Negation triggers before a finding ("no effusion") and after it ("effusion is not seen")
+PRE_NEGATIONS = [
+    "no", "not", "without", "negative for", "free of", "absence of", "no evidence of",
+    "no sign of", "no signs of", "rather than", "neither", "nor",
+]
+POST_NEGATIONS = [
+    "is not seen", "are not seen", "not seen", "not identified", "not detected", "is absent",
+    "are absent", "absent", "has resolved", "have resolved", "ruled out", "excluded",
+]
+# Phrases containing a negation trigger that do not negate the finding ("no interval change in
+# the effusion"); they also end the scope of an earlier negation
+PSEUDO_NEGATIONS = [
+    "no change", "no interval change", "no significant change", "no significant interval change",
+    "not only",
+]
+# Uncertainty markers before a finding ("possible consolidation") and after it ("pneumonia
+# cannot be excluded"). A "?" right before or after a finding ("?pneumonia") is also one.
+PRE_UNCERTAINTIES = [
+    "possible", "possibly", "probable", "probably", "likely", "query", "questionable",
+    "suspected", "suspicious for", "suggestive of", "may represent", "could represent", "equivocal",
+]
+POST_UNCERTAINTIES = [
+    "cannot be excluded", "can not be excluded", "not excluded", "cannot be ruled out",
+    "not ruled out", "is suspected", "are suspected", "is likely", "are likely",
+]
+# Words ending the scope of a negation inside a clause
+NEGATION_TERMINATORS = ["although", "except", "apart from", "which", "with"]
+
+# Sentences end at full stops (not decimal points), semicolons and line breaks
+SENTENCE_SPLIT = re.compile(r"\.(?!\d)|[;\n]")
+
+# Clauses of a sentence are classified separately ("... are not seen, but there is a cavity")
+CLAUSE_SPLIT = re.compile(r"\b(?:but|however)\b", re.IGNORECASE)
+QUESTION_MARK = re.compile(r"\?")
+
+
+class AhoCorasick:
+    """
+    Aho-Corasick automaton matching many lower-case terms in one pass over a text.
+
+    Matches are reported on whole words only.
+    """
+
+    def __init__(self):
+        self.goto = [{}]
+        self.fail = [0]
+        self.outputs = [[]]
+
+    def add(self, term, payload):
+        """
+        Add a term and the payload returned when it matches.
+        """
+        node = 0
+        for char in term.lower():
+            next_node = self.goto[node].get(char)
+            if next_node is None:
+                next_node = len(self.goto)
+                self.goto[node][char] = next_node
+                self.goto.append({})
+                self.fail.append(0)
+                self.outputs.append([])
+            node = next_node
+        self.outputs[node].append((len(term), payload))
+
+    def build(self):
+        """
+        Compute the failure links, breadth first. Call once after adding every term.
+        """
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for char, next_node in self.goto[node].items():
+                queue.append(next_node)
+                fallback = self.fail[node]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_node] = self.goto[fallback].get(char, 0)
+                self.outputs[next_node] = self.outputs[next_node] + self.outputs[self.fail[next_node]]
+        return self
+
+    def find(self, text):
+        """
+        Find every whole-word match in a lower-case text.
+
+        Returns:
+            list: (start, end, payload) tuples, in order of their end position.
+        """
+        matches = []
+        goto, fail, outputs = self.goto, self.fail, self.outputs
+        node = 0
+        length = len(text)
+        for index, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if outputs[node]:
+                end = index + 1
+                if end < length and text[end].isalnum():
+                    continue
+                for term_length, payload in outputs[node]:
+                    start = end - term_length
+                    if start == 0 or not text[start - 1].isalnum():
+                        matches.append((start, end, payload))
+        return matches
+
+
+class ExtractionResult:
+    """
+    Findings extracted from one report.
+
+    Attributes:
+        summary (dict): Summary sections mapping canonical keys to the clauses mentioning them,
+                        including the "Negated Findings" and "Uncertain Findings" sections.
+        negated (dict): Negated findings, mapping canonical keys to their clauses.
+        uncertain (dict): Uncertain findings, mapping canonical keys to their clauses.
+        unclassified_spans (list): Clauses mentioning no organ and no finding of the lexicon.
+    """
+
+    def __init__(self):
+        self.summary = {section: {} for section in SUMMARY_SECTIONS + [NEGATED_SECTION, UNCERTAIN_SECTION]}
+        self.negated = self.summary[NEGATED_SECTION]
+        self.uncertain = self.summary[UNCERTAIN_SECTION]
+        self.unclassified_spans = []
+
+    @property
+    def has_findings(self):
+        return any(self.summary[section] for section in FINDING_SECTIONS)
+
+    @property
+    def unclassified_text(self):
+        """
+        The unclassified clauses, joined back into text for the model.
+        """
+        return "".join(f"{span}. " for span in self.unclassified_spans).strip()
+
+    @property
+    def is_normal(self):
+        """
+        True when no disease or symptom is reported or suspected and every clause was understood.
+        """
+        return not self.has_findings and not self.uncertain and not self.unclassified_spans
+
+
+def load_lexicon():
+    """
+    Load the lexicon from LEXICON_PATH, or return the default `RADIOLOGY_LEXICON`.
+    """
+    path = os.environ.get("LEXICON_PATH")
+    if not path:
+        return RADIOLOGY_LEXICON
+    with open(path, encoding="utf-8") as lexicon_file:
+        return json.load(lexicon_file)
+
+
+class LexiconExtractor:
+    """
+    Extracts canonical findings from report text with one Aho-Corasick automaton.
+
+    Args:
+        lexicon (dict, optional): Lexicon of the structure of `RADIOLOGY_LEXICON`.
+    """
+
+    def __init__(self, lexicon=None):
+        lexicon = lexicon or load_lexicon()
+        self.automaton = AhoCorasick()
+        for section, entries in lexicon.items():
+            for canonical_key, terms in entries.items():
+                for term in terms:
+                    self.automaton.add(term.lower(), ("term", section, canonical_key))
+        for term in PRE_NEGATIONS:
+            self.automaton.add(term, ("pre_negation", None, None))
+        for term in POST_NEGATIONS:
+            self.automaton.add(term, ("post_negation", None, None))
+        for term in PSEUDO_NEGATIONS:
+            self.automaton.add(term, ("pseudo_negation", None, None))
+        for term in PRE_UNCERTAINTIES:
+            self.automaton.add(term, ("pre_uncertainty", None, None))
+        for term in POST_UNCERTAINTIES:
+            self.automaton.add(term, ("post_uncertainty", None, None))
+        for term in NEGATION_TERMINATORS:
+            self.automaton.add(term, ("terminator", None, None))
+        self.automaton.build()
+
+    def _resolve_overlaps(self, matches):
+        """
+        Keep the longest term where terms overlap ("pleural effusion" over "effusion").
+        """
+        matches = sorted(matches, key=lambda match: (match[0], -(match[1] - match[0])))
+        kept = []
+        covered_until = -1
+        for start, end, payload in matches:
+            if start >= covered_until:
+                kept.append((start, end, payload))
+                covered_until = end
+        return kept
+
+    def _finding_status(self, clause, matches, position):
+        """
+        Classify the term at `position` of a clause's matches.
+
+        Returns:
+            str | None: "negated", "uncertain", or None for a positive finding.
+        """
+        term_start, term_end, _ = matches[position]
+
+        # A question mark attached to the term: "?pneumonia", "pneumonia?"
+        if position > 0 and matches[position - 1][2][0] == "question":
+            if not clause[matches[position - 1][1]:term_start].strip():
+                return "uncertain"
+        if position + 1 < len(matches) and matches[position + 1][2][0] == "question":
+            if not clause[term_end:matches[position + 1][0]].strip():
+                return "uncertain"
+
+        # Pre-negation or uncertainty: a trigger earlier in the clause with no terminator in between
+        for start, end, payload in reversed(matches[:position]):
+            if payload[0] in ("terminator", "pseudo_negation"):
+                break
+            if payload[0] == "pre_negation":
+                return "negated"
+            if payload[0] == "pre_uncertainty":
+                return "uncertain"
+
+        # Post-negation or uncertainty: a trigger right after the term and the terms it is listed with
+        for start, end, payload in matches[position + 1:]:
+            if payload[0] == "post_negation":
+                return "negated"
+            if payload[0] == "post_uncertainty":
+                return "uncertain"
+            if payload[0] != "term":
+                break
+        return None
+
+    def extract(self, text):
+        """
+        Extract the findings of one report.
+
+        Args:
+            text (str): Report text.
+
+        Returns:
+            ExtractionResult: Summary, negated and uncertain findings, and unclassified clauses.
+        """
+        result = ExtractionResult()
+        for sentence in SENTENCE_SPLIT.split(text or ""):
+            for clause in CLAUSE_SPLIT.split(sentence):
+                clause = clause.strip(" ,:")
+                if clause:
+                    self._extract_clause(clause, result)
+        return result
+
+    def _extract_clause(self, clause, result):
+        """
+        Add the findings of one clause to `result`, or mark the clause as unclassified.
+        """
+        matches = self.automaton.find(clause.lower())
+        matches += [(match.start(), match.end(), ("question", None, None)) for match in QUESTION_MARK.finditer(clause)]
+        matches = self._resolve_overlaps(matches)
+
+        # Normal and administrative terms alone do not say what the clause reports
+        terms = [
+            (index, payload) for index, (_, _, payload) in enumerate(matches)
+            if payload[0] == "term" and payload[1] in SUMMARY_SECTIONS
+        ]
+        if not terms:
+            result.unclassified_spans.append(clause)
+            return
+
+        organs = [payload[2] for _, payload in terms if payload[1] == "Organs Mentioned"]
+        for index, (_, section, canonical_key) in terms:
+            if section in FINDING_SECTIONS:
+                status = self._finding_status(clause, matches, index)
+                if status == "negated":
+                    _append(result.negated, canonical_key, clause)
+                elif status == "uncertain":
+                    _append(result.uncertain, canonical_key, clause)
+                else:
+                    _append(result.summary[section], canonical_key, clause)
+
+        # Organs carry every clause describing them, normal or not
+        for organ in organs:
+            _append(result.summary["Organs Mentioned"], organ, clause)
+
+    def extract_many(self, texts):
+        """
+        Extract the findings of many reports.
+
+        Returns:
+            list: ExtractionResult objects, in the order of `texts`.
+        """
+        return [self.extract(text) for text in texts]
+
+
+def _append(section, key, sentence):
+    """
+    Add a sentence to a summary entry, without repeating it.
+    """
+    existing = section.get(key)
+    if not existing:
+        section[key] = sentence
+    elif sentence not in existing:
+        section[key] = f"{existing} {sentence}"
+
+
+def merge_summaries(extracted, generated):
+    """
+    Merge the model's summary of the unclassified sentences into the extracted summary.
+
+    Entries found by the lexicon, including its negated and uncertain findings, are kept; the
+    model adds the entries it found elsewhere.
+
+    Args:
+        extracted (dict): Summary from `LexiconExtractor.extract`.
+        generated (dict): Summary from `pre_processing.parse_summary`.
+
+    Returns:
+        dict: The merged summary.
+    """
+    merged = {section: dict(entries) for section, entries in extracted.items()}
+    for section in SUMMARY_SECTIONS:
+        merged.setdefault(section, {})
+    for section in SUMMARY_SECTIONS:
+        existing_keys = {key.lower() for key in merged[section]}
+        for key, value in generated.get(section, {}).items():
+            if key.lower() not in existing_keys:
+                merged[section][key] = value
+    return merged
+
+
+_default_extractor = None
+
+
+def get_extractor():
+    """
+    Get the shared extractor, building its automaton on first use.
+    """
+    global _default_extractor
+    if _default_extractor is None:
+        _default_extractor = LexiconExtractor()
+    return _default_extractor
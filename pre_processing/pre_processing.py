@@ -1,19 +1,34 @@
 # Import libraries
-import time
-import pandas as pd
-import google.generativeai as genai
+import os
 import re
-from pymongo import MongoClient
-from pymongo.server_api import ServerApi
+import sys
+import time
+
+# Shard hashing, retries and the shared clients live next to the comparison scripts. cli.py
+# already puts that folder on the path; this keeps `python pre_processing.py` working too.
+COMPARING_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'comparing'))
+if COMPARING_DIR not in map(os.path.abspath, sys.path):
+    sys.path.append(COMPARING_DIR)
+
+from clients import gemini_model, mongo_collection
+from lexicon_extractor import LEXICON_CONFIG, get_extractor, merge_summaries
+from model_router import call_with_quota_retries
+from profiling import span, traced
+from sharding import patient_shard_bucket
+from text_storage import TextStorage
 
 # Connect to Gemini API
 """
 IMPORTANT: Replace `GEMINI_API_KEY` with your valid Gemini API key.
 This is required to authenticate requests to the generative AI model.
+The model is only created when the first report is processed, see comparing/clients.py.
 """
 GEMINI_API_KEY = ''
-genai.configure(api_key=GEMINI_API_KEY)
-model = genai.GenerativeModel('gemini-1.5-flash')
+MODEL_NAME = 'gemini-1.5-flash'
+
+
+def get_model():
+    return gemini_model(GEMINI_API_KEY, MODEL_NAME)
 
 # MongoDB setup
 """
@@ -21,34 +36,34 @@ IMPORTANT: Replace the MongoDB URI, database name (`ClinicalNotesReviewer`), and
 with your actual setup. Ensure the collection name matches where you want the data to be stored.
 """
 uri = ""
-client = MongoClient(uri, server_api=ServerApi('1'))
-db = client['ClinicalNotesReviewer']
-collection = db['processed_reports']
+DATABASE_NAME = 'ClinicalNotesReviewer'
+COLLECTION_NAME = 'processed_reports'
 
-# Function to generate summary
-def generate_summary(extracted_text):
+
+def get_collection():
+    return mongo_collection(uri, DATABASE_NAME, COLLECTION_NAME)
+
+# Function to build the summary prompt
+def build_summary_prompt(extracted_text):
     """
-    Generates a structured summary of a radiology report based on extracted text.
+    Builds the prompt asking the model for a structured summary of a radiology report.
 
     The summary includes three sections: 
     1. **Diseases Mentioned** - Identifies explicitly stated diseases and their elaborations.
     2. **Organs Mentioned** - Lists organs mentioned along with their conditions.
     3. **Symptoms/Phenomena of Concern** - Highlights key symptoms or phenomena of concern.
 
-    The function uses a prompt to instruct the generative AI model on how to extract, classify, 
-    and structure the content. It also ensures there is no duplication or inference in the output.
+    The prompt instructs the generative AI model on how to extract, classify, and structure
+    the content. It also ensures there is no duplication or inference in the output.
 
     Parameters:
         extracted_text (str): The raw extracted text from a radiology report.
 
     Returns:
-        dict: A dictionary with structured sections containing the summarized information.
-              Keys include "Diseases Mentioned", "Organs Mentioned", and 
-              "Symptoms/Phenomena of Concern".
-              If an error occurs, returns a dictionary with empty sections.
+        str: The summary prompt.
     """
 
-    prompt = (
+    return (
         "You are a world-class medical system knowledgeable in ICD-10-AM medical coding and specialized in analyzing and summarizing medical documents. \n"
         "The following text is extracted from a radiology report. \n"
         f"Text: {extracted_text}"
@@ -89,83 +104,151 @@ def generate_summary(extracted_text):
         "    - Remove any entries or elaborations containing the word forms suggest and implied.\n"
     )
 
-    try:
-        response = model.generate_content(prompt)
 
-        summary_text = response.text.strip() if hasattr(response, 'text') and response.text else "Summary could not be generated."
-        print(f"summary_text {summary_text}")
+# Function to parse the summary returned by the model
+@traced("parse_summary", "parse")
+def parse_summary(summary_text):
+    """
+    Parses the model's summary text into structured sections.
+
+    Parameters:
+        summary_text (str): The summary returned by the model.
+
+    Returns:
+        dict: A dictionary with keys "Diseases Mentioned", "Organs Mentioned" and
+              "Symptoms/Phenomena of Concern", each mapping entry names to their descriptions.
+    """
+    print(f"summary_text {summary_text}")
+
+    headers = [
+        "**Diseases Mentioned:**",
+        "**Organs Mentioned:**",
+        "**Symptoms/Phenomena of Concern:**"
+    ]
+
+    # Parse the summary into structured dictionaries
+    summary_sections = {
+        "Diseases Mentioned": {},
+        "Organs Mentioned": {},
+        "Symptoms/Phenomena of Concern": {}
+    }
 
-        headers = [
-            "**Diseases Mentioned:**",
-            "**Organs Mentioned:**",
-            "**Symptoms/Phenomena of Concern:**"
-        ]
+    def parse_section_to_dict(content):
+        # Check if the content explicitly starts with "NIL" or is empty
+        if "NIL" in content or not content.strip():
+            return {}
 
-        # Parse the summary into structured dictionaries
-        summary_sections = {
-            "Diseases Mentioned": {},
-            "Organs Mentioned": {},
-            "Symptoms/Phenomena of Concern": {}
-        }
+        # Find all entries that follow the format * **Key:** Value
+        matches = re.findall(r"\* \*\*(.+?):\s*\*?\*?\s*(.+?)(?=\n\* \*\*|\Z)", content, re.DOTALL)
+
+        # Debug: print the matches found by the regex
+        print("Debug: Matches found by regex:")
+        for match in matches:
+            print(f"Key: {match[0].strip()}, Value: {match[1].strip()}")
+
+        # Return the dictionary with valid matches
+        return {match[0].strip(): match[1].strip() for match in matches}
+
+
+    # Extract and parse each section
+    for i, header in enumerate(headers):
+        start_idx = summary_text.find(header)
+        if start_idx != -1:
+            next_header_idx = (
+                summary_text.find(headers[i + 1], start_idx) if i + 1 < len(headers) else len(summary_text)
+            )
+            content = summary_text[start_idx + len(header):next_header_idx].strip()
+            print(f"Content: {content}")
+            section_name = header.strip("*").strip(":")
+            print(f"section_name {section_name}")
+            summary_sections[section_name] = parse_section_to_dict(content)
+
+    return summary_sections
+
+
+# Function to send a prompt to the model
+def generate_text(prompt, description):
+    """
+    Sends a prompt to the Gemini model, retrying when the API quota is exceeded.
+
+    Parameters:
+        prompt (str): The prompt.
+        description (str): Description of the call used in log messages.
+
+    Returns:
+        str | None: The stripped response text ("" if there is none), or None if the call failed.
+    """
+    def make_call():
+        with span("model.generate", "model", call=description):
+            response = get_model().generate_content(prompt)
+        return response.text.strip() if hasattr(response, 'text') and response.text else ""
+
+    return call_with_quota_retries(make_call, description)
+
+
+# Function to generate summary
+def generate_summary(extracted_text):
+    """
+    Generates a structured summary of a radiology report based on extracted text.
+
+    Parameters:
+        extracted_text (str): The raw extracted text from a radiology report.
 
-    
-        def parse_section_to_dict(content):
-            # Check if the content explicitly starts with "NIL" or is empty
-            if "NIL" in content or not content.strip():
-                return {}
-
-            # Find all entries that follow the format * **Key:** Value
-            matches = re.findall(r"\* \*\*(.+?):\s*\*?\*?\s*(.+?)(?=\n\* \*\*|\Z)", content, re.DOTALL)
-
-            # Debug: print the matches found by the regex
-            print("Debug: Matches found by regex:")
-            for match in matches:
-                print(f"Key: {match[0].strip()}, Value: {match[1].strip()}")
-
-            # Return the dictionary with valid matches
-            return {match[0].strip(): match[1].strip() for match in matches}
-
-
-        # Extract and parse each section
-        for i, header in enumerate(headers):
-            start_idx = summary_text.find(header)
-            if start_idx != -1:
-                next_header_idx = (
-                    summary_text.find(headers[i + 1], start_idx) if i + 1 < len(headers) else len(summary_text)
-                )
-                content = summary_text[start_idx + len(header):next_header_idx].strip()
-                print(f"Content: {content}")
-                section_name = header.strip("*").strip(":")
-                print(f"section_name {section_name}")
-                summary_sections[section_name] = parse_section_to_dict(content)
-
-        return summary_sections
-
-    except Exception as e:
-        print(f"Error generating summary: {e}")
+    Returns:
+        dict: A dictionary with structured sections containing the summarized information.
+              Keys include "Diseases Mentioned", "Organs Mentioned", and 
+              "Symptoms/Phenomena of Concern".
+              If the call fails, returns a dictionary with empty sections.
+    """
+    summary_text = generate_text(build_summary_prompt(extracted_text), "summary")
+    if summary_text is None:
         return {
             "Diseases Mentioned": {},
             "Organs Mentioned": {},
             "Symptoms/Phenomena of Concern": {}
         }
+    return parse_summary(summary_text or "Summary could not be generated.")
 
 
-# Function to generate layman explanation of the report
-def generate_layman_explanation(extracted_text):
+# Function to summarize a report, using the model only where the lexicon falls short
+def summarize_report(extracted_text):
     """
-    Generates a layman explanation of the content of a radiology report.
+    Generates the structured summary of a radiology report, pre-filled by the local lexicon extractor.
 
-    The function translates the medical report content into simpler terms for non-medical audiences, 
-    avoiding jargon and unnecessary technical details.
+    The model is only sent the clauses the lexicon could not classify, and is not called at all
+    when every clause was classified. See lexicon_extractor.py, enabled with LEXICON_EXTRACTOR=1.
 
     Parameters:
         extracted_text (str): The raw extracted text from a radiology report.
 
     Returns:
-        str: A concise layman explanation of the report. 
-             If an error occurs, returns an error message or a default string indicating failure.
+        dict: A dictionary with the same sections as `generate_summary`; with the lexicon, also
+              the "Negated Findings" and "Uncertain Findings" it extracted.
     """
-    prompt = (
+    if not LEXICON_CONFIG["enabled"]:
+        return generate_summary(extracted_text)
+
+    with span("lexicon_extract", "parse"):
+        extraction = get_extractor().extract(extracted_text)
+    if not extraction.unclassified_spans:
+        print(f"Summary extracted without the model ({'normal study' if extraction.is_normal else 'all clauses classified'}).")
+        return extraction.summary
+
+    return merge_summaries(extraction.summary, generate_summary(extraction.unclassified_text))
+
+
+# Function to build the layman explanation prompt
+def build_layman_prompt(extracted_text):
+    """
+    Builds the prompt asking the model to explain a radiology report in layman terms.
+
+    Parameters:
+        extracted_text (str): The raw extracted text from a radiology report.
+
+    Returns:
+        str: The layman explanation prompt.
+    """
+    return (
         "The following text is extracted from a radiology report."
         "You are an interpreter tasked to translate the radiology report 'Text' section into layman terms.\n"
         "Remember that your audience does not have any prior medical knowledge.\n"
@@ -174,64 +257,222 @@ def generate_layman_explanation(extracted_text):
         f"Text: {extracted_text}"
     )
 
-    try:
-        response = model.generate_content(prompt)
-        
-        # Safely access response content
-        return response.text.strip() if hasattr(response, 'text') and response.text else "Layman explanation could not be generated."
-    except Exception as e:
-        print(f"Error generating layman explanation: {e}")
+
+# Function to generate layman explanation of the report
+def generate_layman_explanation(extracted_text):
+    """
+    Generates a layman explanation of the content of a radiology report.
+
+    The function translates the medical report content into simpler terms for non-medical audiences, 
+    avoiding jargon and unnecessary technical details.
+
+    Parameters:
+        extracted_text (str): The raw extracted text from a radiology report.
+
+    Returns:
+        str: A concise layman explanation of the report. 
+             If an error occurs, returns an error message or a default string indicating failure.
+    """
+    layman_explanation = generate_text(build_layman_prompt(extracted_text), "layman explanation")
+    if layman_explanation is None:
         return "Error generating layman explanation."
+    return layman_explanation or "Layman explanation could not be generated."
+
+# Format of `Performed Date Time`, as parsed by the comparison pipelines
+DATE_FORMAT = "%d/%m/%Y %H:%M"
+PADDED_DATE_PATTERN = r"\d{2}/\d{2}/\d{4} \d{2}:\d{2}"
 
-# Load the raw CSV file containing rows of radiology reports
+# Field of the zero-padded `Performed Date Time`, read by comparing/report_store.py; the original value is kept as is
+NORMALIZED_DATE_FIELD = "Performed Date Time Normalized"
+
+# Number of report documents per insert
+INSERT_BATCH_SIZE = 100
+
+# Pause between reports
 """
-IMPORTANT: Replace 'Chest Scans_deidentified_test.csv' with the correct file path to your dataset.
-Ensure the CSV file contains columns such as 'Masked_PatientID', 'Performed Date Time', and 'Text',
-as these are used in the script for processing.
+IMPORTANT: The synchronous mode waits `REPORT_PACING_SECONDS` between reports to stay within
+the Gemini quota, 30 seconds unless set with the REPORT_PACING_SECONDS environment variable.
+Set it to 0 to rely on the quota retries of model_router.call_with_quota_retries only.
+The asynchronous mode spaces its requests with a rate limiter instead.
 """
-df = pd.read_csv('Chest Scans_deidentified_test.csv')  # Replace with your test file name
-print("read csv")
+REPORT_PACING_SECONDS = float(os.environ.get("REPORT_PACING_SECONDS", "30"))
 
-# Initialize a list to store the JSON output
-json_output = []
 
-# Iterate over each row in the DataFrame
-for index, row in df.iterrows():
-    # Extract PatientID and Updated Date
-    patient_id = f"Patient{int(row['Masked_PatientID'])}"
-    updated_date = row['Performed Date Time']
+# Function to normalize the performed date-times
+def normalize_dates(values):
+    """
+    Rewrites performed date-times in the zero-padded `DATE_FORMAT`, e.g. "1/2/2023 9:05" as "01/02/2023 09:05".
+
+    Parameters:
+        values (Series): Raw `Performed Date Time` column.
 
-    # Store the raw report content
+    Returns:
+        list: The normalized values. Values that cannot be parsed are kept as they are.
     """
-    IMPORTANT: Ensure the column name for the text content in your CSV matches 'Text'.
-    Modify `row['Text']` if your column name is different (e.g., 'Report Content').
+    # Imported here so the prompts and parsing can be used without loading pandas
+    import pandas as pd
+
+    # Only the values not already zero-padded are parsed and rewritten
+    pending = ~values.astype(str).str.fullmatch(PADDED_DATE_PATTERN).fillna(False).astype(bool)
+    if not pending.any():
+        return values.tolist()
+
+    normalized = values.astype(object)
+    parsed = pd.to_datetime(values[pending], format=DATE_FORMAT, errors="coerce")
+    normalized[pending] = parsed.dt.strftime(DATE_FORMAT).where(parsed.notna(), values[pending])
+    return normalized.tolist()
+
+
+# Function to build the fields of the stored documents that do not depend on the model
+def build_report_fields(df):
+    """
+    Builds the static fields of every report document, column by column rather than row by row.
+
+    Parameters:
+        df (DataFrame): The raw CSV file.
+
+    Returns:
+        list: One dictionary per row, with the "PatientID", "PatientShard", "Performed Date Time",
+              `NORMALIZED_DATE_FIELD` and "Raw Report" fields of the report document.
+    """
+    patient_ids = ("Patient" + df['Masked_PatientID'].astype('int64').astype(str)).tolist()
+    shards = {patient_id: patient_shard_bucket(patient_id) for patient_id in set(patient_ids)}
+    dates = df['Performed Date Time'].tolist()
+    normalized_dates = normalize_dates(df['Performed Date Time'])
+
+    # Each column is converted to strings at once, then the rows are zipped back together
+    columns = [str(col) for col in df.columns]
+    raw_values = zip(*(map(str, df[col].tolist()) for col in df.columns))
+    raw_reports = (dict(zip(columns, values)) for values in raw_values)
+
+    return [
+        {
+            "PatientID": patient_id,
+            "PatientShard": shards[patient_id],
+            "Performed Date Time": date,
+            NORMALIZED_DATE_FIELD: normalized_date,
+            "Raw Report": raw_report,
+        }
+        for patient_id, date, normalized_date, raw_report in zip(patient_ids, dates, normalized_dates, raw_reports)
+    ]
+
+
+# Function to build the document stored for one report
+def build_report_document(fields, layman_explanation, summary):
     """
-    report_text = row['Text']
+    Builds the JSON structure stored in MongoDB for one radiology report.
 
-    # Generate the layman explanation and summary
-    layman_explanation = generate_layman_explanation(report_text)
-    summary = generate_summary(report_text)
+    Parameters:
+        fields (dict): Static fields of the report, from `build_report_fields`.
+        layman_explanation (str): Layman explanation generated for the report.
+        summary (dict): Structured summary generated for the report.
 
-    # Build the JSON structure for the report
-    report_data = {
-        "PatientID": patient_id,
-        "Performed Date Time": updated_date,
-        "Raw Report": {col: str(row[col]) for col in df.columns},
+    Returns:
+        dict: The report document.
+    """
+    return {
+        **fields,
         "Processed Data": {
             "Layman Explanation": layman_explanation,
             "Summary": summary
         }
     }
 
-    # Append the report data to the JSON output list
-    json_output.append(report_data)
 
-    # Add 30-second wait between API calls
-    print("Waiting for 30 seconds before next API call...")
-    time.sleep(30)
+# Function to merge the model results into insert-ready batches
+def assemble_report_documents(report_fields, results, batch_size=INSERT_BATCH_SIZE):
+    """
+    Merges the results of the model stage with the static fields of the reports.
 
-try:
-    result = collection.insert_many(json_output)
-    print(f"Data successfully uploaded to MongoDB! Inserted IDs: {result.inserted_ids}")
-except Exception as e:
-    print(f"Error uploading data to MongoDB: {e}")
+    Parameters:
+        report_fields (list): Static fields of every report, from `build_report_fields`.
+        results (iterable): (row position, layman explanation, summary) tuples, in any order.
+        batch_size (int): Number of documents per batch.
+
+    Returns:
+        generator: Lists of at most `batch_size` report documents.
+    """
+    batch = []
+    for position, layman_explanation, summary in results:
+        batch.append(build_report_document(report_fields[position], layman_explanation, summary))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def main(csv_path='Chest Scans_deidentified_test.csv'):
+    """
+    Pre-processes every report of the raw CSV file and uploads the results to MongoDB.
+
+    Parameters:
+        csv_path (str): Path of the raw CSV file.
+
+    Workflow:
+        - Read the raw CSV file and build the static fields of every report.
+        - Generate the layman explanation and summary of each report.
+        - Insert the report documents into MongoDB in batches of `INSERT_BATCH_SIZE`.
+
+    Returns:
+        int: Number of inserted reports.
+
+    Raises:
+        RuntimeError: If some batches could not be inserted. The other batches are inserted first.
+    """
+    # Load the raw CSV file containing rows of radiology reports
+    """
+    IMPORTANT: Replace 'Chest Scans_deidentified_test.csv' with the correct file path to your dataset,
+    or pass it as `csv_path`.
+    Ensure the CSV file contains columns such as 'Masked_PatientID', 'Performed Date Time', and 'Text',
+    as these are used in the script for processing.
+    """
+    # Imported here so the prompts and parsing can be used without loading pandas
+    import pandas as pd
+
+    df = pd.read_csv(csv_path)
+    print("read csv")
+
+    with span("build_report_fields", reports=len(df)):
+        report_fields = build_report_fields(df)
+
+    # Large text fields are stored compressed when enabled, see comparing/text_storage.py
+    storage = TextStorage.for_database(get_collection().database)
+
+    def generate_results():
+        # Store the raw report content
+        """
+        IMPORTANT: Ensure the column name for the text content in your CSV matches 'Text'.
+        Modify `df['Text']` if your column name is different (e.g., 'Report Content').
+        """
+        for position, report_text in enumerate(df['Text'].tolist()):
+            with span("report", patient_id=report_fields[position]["PatientID"]):
+                # Generate the layman explanation and summary
+                layman_explanation = generate_layman_explanation(report_text)
+                summary = summarize_report(report_text)
+            yield position, layman_explanation, summary
+
+            # Wait between API calls, see REPORT_PACING_SECONDS
+            if REPORT_PACING_SECONDS > 0:
+                print(f"Waiting for {REPORT_PACING_SECONDS:g} seconds before next API call...")
+                with span("rate_limit_wait", "retry"):
+                    time.sleep(REPORT_PACING_SECONDS)
+
+    inserted = 0
+    failed_batches = 0
+    for batch in assemble_report_documents(report_fields, generate_results()):
+        try:
+            with span("insert_reports", reports=len(batch)):
+                result = get_collection().insert_many([storage.compress_report(document) for document in batch])
+            inserted += len(result.inserted_ids)
+            print(f"Data successfully uploaded to MongoDB! Inserted IDs: {result.inserted_ids}")
+        except Exception as e:
+            failed_batches += 1
+            print(f"Error uploading data to MongoDB: {e}")
+
+    if failed_batches:
+        raise RuntimeError(f"{failed_batches} batches of reports could not be uploaded to MongoDB; {inserted} reports were inserted.")
+    return inserted
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+# Import libraries
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+"""
+Startup benchmark of the pipeline entry points.
+
+Each entry point is imported in a fresh interpreter, several times, and the median import time
+is checked against `STARTUP_BUDGET`. Importing an entry point must also leave the heavy client
+libraries unloaded (`DEFERRED_MODULES`): they are only imported when a pipeline runs.
+
+    python startup_benchmark.py [--repeat 5] [--verbose]
+
+Exits with status 1 when an entry point is over budget or loads a deferred module, listing
+the slowest imports reported by `python -X importtime`.
+"""
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Startup budget
+"""
+IMPORTANT: Budgets are median seconds spent importing the module, excluding interpreter startup.
+"""
+STARTUP_BUDGET = {
+    "cli": 0.15,
+    "pre_processing": 0.15,
+    "comparison_gemini_table": 0.15,
+    "comparison_gemini_sectioned": 0.15,
+    "comparison_gpt_table": 0.15,
+}
+
+DEFERRED_MODULES = [
+    "google.generativeai",
+    "pymongo",
+    "pandas",
+    "langchain",
+    "dotenv",
+    "tiktoken",
+    "pyarrow",
+    "numpy",
+]
+
+# Measured in the child interpreter: import time, and which deferred modules got loaded
+MEASURE_CODE = """
+import sys, time
+sys.path[:0] = {paths!r}
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+loaded = [name for name in {deferred!r} if name in sys.modules]
+print(elapsed)
+print(",".join(loaded))
+"""
+
+
+def measure_import(module, repeat):
+    """
+    Import a module in `repeat` fresh interpreters.
+
+    Args:
+        module (str): Name of the module.
+        repeat (int): Number of interpreters.
+
+    Returns:
+        tuple: Median import time in seconds, and the deferred modules it loaded.
+    """
+    paths = [ROOT_DIR, os.path.join(ROOT_DIR, 'pre_processing'), os.path.join(ROOT_DIR, 'comparing')]
+    code = MEASURE_CODE.format(paths=paths, module=module, deferred=DEFERRED_MODULES)
+    timings = []
+    loaded = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True, check=True, cwd=ROOT_DIR
+        ).stdout.splitlines()
+        timings.append(float(output[0]))
+        loaded = [name for name in output[1].split(",") if name] if len(output) > 1 else []
+    return statistics.median(timings), loaded
+
+
+def slowest_imports(module, count=10):
+    """
+    List the slowest imports of a module, by cumulative time, using `python -X importtime`.
+
+    Returns:
+        list: (cumulative microseconds, module name) tuples, slowest first.
+    """
+    paths = [ROOT_DIR, os.path.join(ROOT_DIR, 'pre_processing'), os.path.join(ROOT_DIR, 'comparing')]
+    code = f"import sys; sys.path[:0] = {paths!r}; import {module}"
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True, cwd=ROOT_DIR
+    ).stderr
+
+    imports = []
+    for line in stderr.splitlines():
+        # Lines look like "import time:   self [us] |  cumulative | imported package"
+        parts = line.split("|")
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            imports.append((int(parts[1]), parts[2].strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the import time of the pipeline entry points.")
+    parser.add_argument("--repeat", type=int, default=5, help="Fresh interpreters per entry point.")
+    parser.add_argument("--verbose", action="store_true", help="Show the slowest imports of every entry point.")
+    args = parser.parse_args()
+
+    failed = False
+    for module, budget in STARTUP_BUDGET.items():
+        elapsed, loaded = measure_import(module, args.repeat)
+        over_budget = elapsed > budget
+        status = "OK" if not over_budget and not loaded else "FAIL"
+        print(f"{status:4} {module:30} {elapsed * 1000:7.1f} ms (budget {budget * 1000:.0f} ms)")
+        if loaded:
+            print(f"     loads deferred modules: {', '.join(loaded)}")
+        if over_budget or loaded or args.verbose:
+            for cumulative, name in slowest_imports(module):
+                print(f"     {cumulative / 1000:7.1f} ms  {name}")
+        failed = failed or status == "FAIL"
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,7 @@
+# Import libraries
+import os
+import sys
+
+# The pipeline scripts import their siblings, so both folders go first on the path, like cli.py
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT_DIR, 'pre_processing'), os.path.join(ROOT_DIR, 'comparing')]
@@ -0,0 +1,85 @@
+# Import libraries
+import asyncio
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+pytest.importorskip("numpy")
+
+import async_comparison
+import comparison_gemini_table as pipeline
+from async_support import AsyncRateLimiter
+from comparison_service import FakeModelBackend
+from model_router import ModelRouter
+
+"""
+Tests of the asynchronous comparison mode, with an in-memory MongoDB and the fake model backend.
+"""
+
+
+class AsyncCollection:
+    """
+    Awaitable view of a mongomock collection, for the calls the asynchronous mode makes.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def find_one(self, *args):
+        return self.collection.find_one(*args)
+
+
+def make_report(patient_id, performed_date_time, order_name="CHEST XR", priority=False):
+    return {
+        "PatientID": patient_id,
+        "Performed Date Time": performed_date_time,
+        "Priority": priority,
+        "Raw Report": {"Masked_PatientID": patient_id, "Text": "Chest X-ray.", "Order Name": order_name},
+        "Processed Data": {"Summary": {
+            "Diseases Mentioned": {"Pneumonia": "Consolidation."},
+            "Organs Mentioned": {"Lungs": "Clear."},
+        }},
+    }
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = mongomock.MongoClient()["ClinicalNotesReviewer"]
+    monkeypatch.setattr(pipeline.PIPELINE, "get_db", lambda: db)
+    monkeypatch.setattr(pipeline.PIPELINE, "_router", ModelRouter(
+        FakeModelBackend("fake-cheap", 0).as_backend(), FakeModelBackend("fake-strong", 0).as_backend()
+    ))
+    return db
+
+
+def test_patients_are_queued_in_priority_order(db):
+    db["processed_reports"].insert_many([
+        make_report("P1", "01/01/2024 09:00"),
+        make_report("P2", "01/01/2024 09:00", priority=True),
+        make_report("P3", "01/01/2024 09:00", order_name="CT CHEST"),
+    ])
+
+    async def read():
+        patient_queue = asyncio.Queue()
+        await async_comparison.read_patients(pipeline, patient_queue)
+        return [patient_queue.get_nowait()[0] for _ in range(patient_queue.qsize())]
+
+    assert asyncio.run(read()) == ["P2", "P3", "P1"]
+
+
+def test_sections_of_a_patient_are_packed_into_one_request(db):
+    db["processed_reports"].insert_many([
+        make_report("P1", "01/01/2024 09:00"),
+        make_report("P1", "01/02/2024 09:00"),
+    ])
+    reports = dict(pipeline.get_reports_by_patient().items())["P1"]
+
+    async def compare():
+        return await async_comparison.compare_patient_async(
+            pipeline, "P1", reports, AsyncCollection(db[pipeline.COMPARISON_COLLECTION_NAME]),
+            AsyncRateLimiter(6000), asyncio.Semaphore(10)
+        )
+
+    document = asyncio.run(compare())
+
+    assert [entry["Section"] for entry in document["Comparisons"]] == ["Diseases Mentioned", "Organs Mentioned"]
+    assert sum(pipeline.get_router().stats["calls"].values()) == 1
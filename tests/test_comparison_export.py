@@ -0,0 +1,51 @@
+# Import libraries
+from datetime import datetime
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+pytest.importorskip("pyarrow")
+
+from comparison_export import count_comparisons, export_comparisons, query_comparisons
+from comparison_records import PIPELINE_COLLECTIONS, ComparisonRecord, build_comparison_document
+
+"""
+Tests of the Parquet export of the stored comparisons.
+"""
+
+
+def make_document(patient_id, new_date, old_date):
+    record = ComparisonRecord(
+        section="Diseases Mentioned", category="New Development", new_content="Pneumonia", old_content="NIL",
+        explanation="New finding.", new_report_date=new_date, old_report_date=old_date,
+    )
+    return build_comparison_document(patient_id, [old_date, new_date], [record])
+
+
+@pytest.fixture
+def db():
+    return mongomock.MongoClient()["ClinicalNotesReviewer"]
+
+
+def test_reexport_replaces_rows_of_moved_months(db, tmp_path):
+    collection = db[PIPELINE_COLLECTIONS["gemini_table"]]
+    collection.insert_one(make_document("P1", datetime(2024, 1, 5), datetime(2023, 12, 1)))
+    export_comparisons(db, str(tmp_path), pipelines=["gemini_table"])
+
+    # The comparison is re-upserted with a newer report in another month
+    collection.replace_one({"PatientID": "P1"}, make_document("P1", datetime(2024, 2, 5), datetime(2024, 1, 5)))
+    export_comparisons(db, str(tmp_path), pipelines=["gemini_table"])
+
+    table = query_comparisons(str(tmp_path), columns=["patient_id", "month"])
+    assert table.to_pylist() == [{"patient_id": "P1", "month": "2024-02"}]
+
+
+def test_exporting_one_pipeline_keeps_the_others(db, tmp_path):
+    db[PIPELINE_COLLECTIONS["gemini_table"]].insert_one(make_document("P1", datetime(2024, 1, 5), datetime(2023, 12, 1)))
+    db[PIPELINE_COLLECTIONS["gpt_table"]].insert_one(make_document("P2", datetime(2024, 1, 5), datetime(2023, 12, 1)))
+    export_comparisons(db, str(tmp_path))
+
+    export_comparisons(db, str(tmp_path), pipelines=["gemini_table"])
+
+    counts = count_comparisons(str(tmp_path), group_by=["pipeline"]).to_pylist()
+    assert sorted(row["pipeline"] for row in counts) == ["gemini_table", "gpt_table"]
+    assert query_comparisons(str(tmp_path), pipeline="gpt_table", columns=["patient_id"]).to_pylist() == [{"patient_id": "P2"}]
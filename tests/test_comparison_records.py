@@ -0,0 +1,40 @@
+# Import libraries
+from datetime import datetime
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+from comparison_records import ComparisonRecord, ensure_indexes
+
+"""
+Tests of the canonical comparison records and of the comparison collection indexes.
+"""
+
+
+def test_missing_dates_are_read_as_none():
+    record = ComparisonRecord.from_document({"Section": "Lungs", "Category": "**difference**", "NewContent": "Effusion"})
+
+    assert record.new_report_date is None and record.old_report_date is None
+    assert record.category == "Difference"
+    assert record.old_content == "" and record.new_order_id == ""
+
+
+def test_stored_dates_are_kept():
+    record = ComparisonRecord.from_document({"New Report Date": datetime(2024, 1, 5), "Old Report Date": datetime(2023, 12, 1)})
+
+    assert (record.new_report_date, record.old_report_date) == (datetime(2024, 1, 5), datetime(2023, 12, 1))
+
+
+def test_dashboard_index_leads_with_section_and_category():
+    collection = mongomock.MongoClient()["ClinicalNotesReviewer"]["comparisons"]
+    collection.create_index(
+        [("PatientID", 1), ("Comparisons.Section", 1), ("Comparisons.Category", 1)], name="patient_section_category"
+    )
+
+    ensure_indexes(collection)
+
+    indexes = collection.index_information()
+    assert "patient_section_category" not in indexes
+    assert indexes["section_category_patient"]["key"] == [
+        ("Comparisons.Section", 1), ("Comparisons.Category", 1), ("PatientID", 1)
+    ]
@@ -0,0 +1,102 @@
+# Import libraries
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import json
+import os
+import threading
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+import comparison_report
+from comparison_records import PIPELINE_COLLECTIONS, ComparisonRecord, build_comparison_document, with_comparison_hash
+
+"""
+Tests of the incremental rendering of the comparison reports.
+"""
+
+
+class FakeWeasyprint:
+    """
+    Stand-in for the optional `weasyprint` package, writing a fixed PDF payload.
+    """
+
+    class HTML:
+        def __init__(self, string):
+            self.string = string
+
+        def write_pdf(self):
+            return b"%PDF-fake"
+
+
+def make_document(patient_id):
+    record = ComparisonRecord(
+        section="Diseases Mentioned", category="New Development", new_content="Pneumonia", old_content="NIL",
+        explanation="New finding.", new_report_date=datetime(2024, 1, 5), old_report_date=datetime(2023, 12, 1),
+    )
+    return with_comparison_hash(build_comparison_document(patient_id, [datetime(2023, 12, 1), datetime(2024, 1, 5)], [record]))
+
+
+@pytest.fixture
+def db(monkeypatch):
+    # Render in threads, so the fake weasyprint is seen by the workers
+    monkeypatch.setattr(comparison_report, "ProcessPoolExecutor", ThreadPoolExecutor)
+    monkeypatch.setattr(comparison_report, "_weasyprint", lambda: FakeWeasyprint)
+    db = mongomock.MongoClient()["ClinicalNotesReviewer"]
+    db[PIPELINE_COLLECTIONS["gemini_table"]].insert_many([make_document("P1"), make_document("P2")])
+    return db
+
+
+def render(db, tmp_path, pdf):
+    config = dict(comparison_report.RENDER_CONFIG, output_dir=str(tmp_path), workers=1, pdf=pdf, batch_size=1)
+    return comparison_report.render_reports(db, pipelines=["gemini_table"], config=config)
+
+
+def test_unchanged_reports_are_not_rendered_again(db, tmp_path):
+    assert render(db, tmp_path, pdf=False)["rendered"] == 2
+
+    assert render(db, tmp_path, pdf=False) == {"rendered": 0, "up_to_date": 2, "removed": 0}
+
+
+def test_requesting_pdfs_renders_reports_rendered_without_them(db, tmp_path):
+    render(db, tmp_path, pdf=False)
+
+    assert render(db, tmp_path, pdf=True)["rendered"] == 2
+    assert os.path.exists(comparison_report.report_path(str(tmp_path), "gemini_table", "P1", "pdf"))
+    assert render(db, tmp_path, pdf=True)["up_to_date"] == 2
+
+
+def test_manifest_is_saved_after_every_batch(db, tmp_path, monkeypatch):
+    render_batch = comparison_report._render_batch
+    save_manifest = comparison_report.save_manifest
+    rendered_batches = []
+    first_batch_saved = threading.Event()
+
+    def fail_after_first_batch(batch, *args):
+        if rendered_batches:
+            # Crash only once the first batch was recorded
+            first_batch_saved.wait(timeout=5)
+            raise RuntimeError("Renderer crashed.")
+        rendered_batches.append(batch)
+        return render_batch(batch, *args)
+
+    def record_save(output_dir, pipeline, manifest):
+        save_manifest(output_dir, pipeline, manifest)
+        if manifest:
+            first_batch_saved.set()
+
+    monkeypatch.setattr(comparison_report, "_render_batch", fail_after_first_batch)
+    monkeypatch.setattr(comparison_report, "save_manifest", record_save)
+    with pytest.raises(RuntimeError):
+        render(db, tmp_path, pdf=False)
+
+    with open(os.path.join(tmp_path, "gemini_table", comparison_report.MANIFEST_NAME), encoding="utf-8") as manifest_file:
+        assert len(json.load(manifest_file)) == 1
+
+
+def test_manifests_of_earlier_versions_are_read(db, tmp_path):
+    render(db, tmp_path, pdf=False)
+    manifest = comparison_report.load_manifest(str(tmp_path), "gemini_table")
+    comparison_report.save_manifest(str(tmp_path), "gemini_table", {key: entry["hash"] for key, entry in manifest.items()})
+
+    assert render(db, tmp_path, pdf=False)["up_to_date"] == 2
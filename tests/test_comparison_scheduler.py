@@ -0,0 +1,50 @@
+# Import libraries
+from datetime import datetime, timedelta
+
+from comparison_scheduler import PRIORITY_CONFIG, priority_score, schedule_patients
+
+"""
+Tests of the priority order of the comparisons and of the live traffic and backfill quotas.
+"""
+
+NOW = datetime(2024, 6, 1, 12)
+
+
+def reports(hours_ago, order_name="CHEST XR", priority=False):
+    report = {"Raw Report": {"Order Name": order_name}, "Priority": priority}
+    return [(NOW - timedelta(hours=hours_ago), report)]
+
+
+def test_order_types_match_whole_words_only():
+    ct = priority_score(NOW, "CT CHEST", False, NOW)
+    injection = priority_score(NOW, "INJECTION", False, NOW)
+
+    assert ct - injection == PRIORITY_CONFIG["order_type_weights"]["CT"]
+
+
+def test_flagged_and_recent_patients_are_compared_first():
+    scheduler = schedule_patients(
+        {"old": reports(100), "recent": reports(1), "flagged": reports(200)},
+        priority_patients={"flagged"}, now=NOW,
+    )
+
+    assert [patient_id for patient_id, _ in scheduler] == ["flagged", "recent", "old"]
+
+
+def test_live_traffic_gets_its_share_without_starving_backfill():
+    patients = {f"live{index}": reports(1) for index in range(8)}
+    patients.update({f"backfill{index}": reports(100) for index in range(8)})
+
+    order = [patient_id for patient_id, _ in schedule_patients(patients, priority_patients=set(), now=NOW)]
+
+    # With a 75% live share, one comparison in four goes to backfill while both queues have work
+    assert [patient_id.startswith("live") for patient_id in order[:8]].count(True) == 6
+    assert sorted(order) == sorted(patients)
+
+
+def test_remaining_backfill_is_served_once_live_traffic_is_done():
+    patients = {"live": reports(1), "backfill0": reports(100), "backfill1": reports(101)}
+
+    order = [patient_id for patient_id, _ in schedule_patients(patients, priority_patients=set(), now=NOW)]
+
+    assert order == ["live", "backfill0", "backfill1"]
@@ -0,0 +1,93 @@
+# Import libraries
+import threading
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+import comparison_gemini_table as pipeline
+from comparison_service import ComparisonService, FakeModelBackend
+from model_router import ModelRouter
+
+"""
+Tests of the on-demand comparison service, with an in-memory MongoDB and the fake model backend.
+"""
+
+
+def make_report(patient_id, performed_date_time, diseases):
+    return {
+        "PatientID": patient_id,
+        "Performed Date Time": performed_date_time,
+        "Raw Report": {"Masked_PatientID": patient_id, "Text": "Chest X-ray.", "Order Name": "CHEST XR"},
+        "Processed Data": {"Summary": {"Diseases Mentioned": diseases}},
+    }
+
+
+@pytest.fixture
+def service():
+    db = mongomock.MongoClient()["ClinicalNotesReviewer"]
+    db["processed_reports"].insert_many([
+        make_report("P1", "01/01/2024 09:00", {"Pneumonia": "Right lower lobe consolidation."}),
+        make_report("P1", "01/02/2024 09:00", {"Pneumonia": "Resolving consolidation."}),
+    ])
+    router = ModelRouter(FakeModelBackend("fake-cheap", 0.2).as_backend(), FakeModelBackend("fake-strong", 0).as_backend())
+    service = ComparisonService(db["processed_reports"], db["comparisons"], pipeline, router, max_workers=4)
+    yield service
+    service.executor.shutdown(wait=True)
+
+
+def model_calls(service):
+    return sum(service.router.stats["calls"].values())
+
+
+def test_concurrent_requests_share_one_computation(service):
+    results = [None, None]
+
+    def request(index):
+        results[index] = list(service.stream("P1"))
+
+    threads = [threading.Thread(target=request, args=(index,)) for index in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+
+    assert results[0] == results[1]
+    assert [event["type"] for event in results[0]] == ["section", "done"]
+    assert results[0][0]["Section"] == "Diseases Mentioned"
+    assert model_calls(service) == 1
+    assert service.comparison_collection.count_documents({"PatientID": "P1"}) == 1
+
+
+def test_up_to_date_comparison_is_served_from_the_cache(service):
+    list(service.stream("P1"))
+    calls = model_calls(service)
+
+    events = list(service.stream("P1"))
+
+    assert [event["type"] for event in events] == ["cached"]
+    assert events[0]["document"]["PatientID"] == "P1"
+    assert len(events[0]["document"]["Comparisons"]) == 1
+    assert model_calls(service) == calls
+
+
+def test_new_report_invalidates_the_cache(service):
+    list(service.stream("P1"))
+    service.collection.insert_one(make_report("P1", "01/03/2024 09:00", {}))
+
+    events = list(service.stream("P1"))
+
+    assert events[-1]["type"] == "done"
+    assert len(events[-1]["ReportDates"]) == 3
+
+
+def test_comparison_with_a_failed_section_is_not_saved(service):
+    def fail(prompt):
+        raise RuntimeError("Model unavailable")
+    service.router.cheap_backend.generate = fail
+    service.router.strong_backend.generate = fail
+
+    events = list(service.stream("P1"))
+
+    assert [event["type"] for event in events] == ["section", "error"]
+    assert events[-1]["Failed Sections"] == ["Diseases Mentioned"]
+    assert service.comparison_collection.count_documents({"PatientID": "P1"}) == 0
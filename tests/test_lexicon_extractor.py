@@ -0,0 +1,76 @@
+# Import libraries
+import pytest
+
+from lexicon_extractor import LexiconExtractor, RADIOLOGY_LEXICON, merge_summaries
+
+"""
+Tests of the lexicon extraction of findings, and of its negation and uncertainty handling.
+"""
+
+
+@pytest.fixture(scope="module")
+def extractor():
+    return LexiconExtractor(RADIOLOGY_LEXICON)
+
+
+@pytest.mark.parametrize("text", [
+    "No pleural effusion.",
+    "Pleural effusion is not seen.",
+    "No evidence of consolidation or pneumothorax.",
+    "Pneumonia has resolved.",
+])
+def test_negated_findings_are_not_reported_as_findings(extractor, text):
+    result = extractor.extract(text)
+
+    assert result.negated
+    assert not result.has_findings
+
+
+@pytest.mark.parametrize("text", [
+    "?pneumonia.",
+    "Possible consolidation in the right lower zone.",
+    "Tuberculosis cannot be excluded.",
+])
+def test_uncertain_findings_are_kept_apart(extractor, text):
+    result = extractor.extract(text)
+
+    assert result.uncertain
+    assert not result.has_findings and not result.is_normal
+
+
+def test_pseudo_negation_does_not_negate(extractor):
+    result = extractor.extract("No interval change in the left pleural effusion.")
+
+    assert "Pleural Effusion" in result.summary["Symptoms/Phenomena of Concern"]
+    assert not result.negated
+
+
+def test_negation_ends_at_the_clause_boundary(extractor):
+    result = extractor.extract("Effusions are not seen, but there is a cavity in the right upper lobe.")
+
+    assert "Pleural Effusion" in result.negated
+    assert "Cavitation" in result.summary["Symptoms/Phenomena of Concern"]
+
+
+def test_normal_report_needs_no_model_call(extractor):
+    result = extractor.extract("The heart is not enlarged. The lungs are clear. No pneumothorax.")
+
+    assert result.is_normal
+    assert set(result.summary["Organs Mentioned"]) == {"Heart", "Lungs"}
+
+
+def test_clauses_without_lexicon_terms_are_left_for_the_model(extractor):
+    result = extractor.extract("Compared to the previous study, the endotracheal tube tip is now 2 cm above the carina.")
+
+    assert result.unclassified_spans and not result.is_normal
+
+
+def test_model_summary_only_adds_new_keys(extractor):
+    extracted = extractor.extract("Right lower zone consolidation.").summary
+    generated = {"Symptoms/Phenomena of Concern": {"consolidation": "Model wording.", "Line Position": "Tube in place."}}
+
+    merged = merge_summaries(extracted, generated)
+
+    assert merged["Symptoms/Phenomena of Concern"]["Consolidation"] == "Right lower zone consolidation"
+    assert merged["Symptoms/Phenomena of Concern"]["Line Position"] == "Tube in place."
+    assert "consolidation" not in merged["Symptoms/Phenomena of Concern"]
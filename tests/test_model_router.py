@@ -0,0 +1,63 @@
+# Import libraries
+import asyncio
+
+from model_router import ModelBackend, ModelRouter
+
+"""
+Tests of routing comparisons between the cheap and the strong model.
+"""
+
+VALID_TABLE = "| Category | New | Old | Explanation |\n|---|---|---|---|\n| New Development | Effusion | NIL | New. |"
+SMALL_PROMPT = "Compare the sections."
+INVALID_TABLE = "| Category | New | Old | Explanation |\n|---|---|---|---|\n| Unknown | Effusion | NIL | New. |"
+
+
+def make_backend(name, output=VALID_TABLE, error=None):
+    def generate(prompt):
+        if error is not None:
+            raise error
+        return output
+
+    async def agenerate(prompt):
+        return generate(prompt)
+    return ModelBackend(name, generate, agenerate)
+
+
+def test_small_comparison_stays_on_the_cheap_model():
+    router = ModelRouter(make_backend("cheap"), make_backend("strong", error=RuntimeError("Not expected")))
+
+    assert router.generate(SMALL_PROMPT, entry_count=2) == VALID_TABLE
+    assert router.stats["calls"] == {"cheap": 1, "strong": 0}
+
+
+def test_large_comparison_goes_to_the_strong_model():
+    router = ModelRouter(make_backend("cheap"), make_backend("strong"))
+
+    router.generate(SMALL_PROMPT, entry_count=router.config["max_cheap_entries"] + 1)
+
+    assert router.stats["routed_strong"] == 1 and router.stats["calls"] == {"cheap": 0, "strong": 1}
+
+
+def test_invalid_cheap_output_is_escalated():
+    router = ModelRouter(make_backend("cheap", output=INVALID_TABLE), make_backend("strong"))
+
+    assert router.generate(SMALL_PROMPT) == VALID_TABLE
+    assert router.stats["escalations"] == 1
+
+
+def test_cheap_model_error_is_escalated():
+    router = ModelRouter(make_backend("cheap", error=RuntimeError("Model unavailable")), make_backend("strong"))
+
+    assert router.generate(SMALL_PROMPT) == VALID_TABLE
+    assert asyncio.run(router.agenerate(SMALL_PROMPT)) == VALID_TABLE
+    assert router.stats["escalations"] == 2
+    assert router.stats["calls"] == {"cheap": 2, "strong": 2}
+
+
+def test_stats_are_kept_per_role_when_both_roles_use_the_same_model():
+    router = ModelRouter(make_backend("genai-GPT4o", output=""), make_backend("genai-GPT4o"))
+
+    router.generate(SMALL_PROMPT)
+
+    assert router.stats["calls"] == {"cheap": 1, "strong": 1}
+    assert len(router.stats["latency_seconds"]["strong"]) == 1
@@ -0,0 +1,61 @@
+# Import libraries
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+pd = pytest.importorskip("pandas")
+
+import pre_processing
+from pre_processing import NORMALIZED_DATE_FIELD, build_report_fields, normalize_dates
+
+"""
+Tests of the column-wise preparation of the report documents and of their upload.
+"""
+
+
+def make_frame(dates):
+    return pd.DataFrame({
+        "Masked_PatientID": list(range(1, len(dates) + 1)),
+        "Performed Date Time": dates,
+        "Text": ["Chest X-ray."] * len(dates),
+    })
+
+
+def test_dates_are_zero_padded_and_unparsable_ones_kept():
+    values = pd.Series(["1/2/2023 9:05", "01/02/2023 09:05", "31/12/2023 23:59", "not a date"])
+
+    assert normalize_dates(values) == ["01/02/2023 09:05", "01/02/2023 09:05", "31/12/2023 23:59", "not a date"]
+
+
+def test_normalized_date_is_stored_next_to_the_original():
+    fields = build_report_fields(make_frame(["1/2/2023 9:05", "01/03/2023 10:00"]))
+
+    assert [field["Performed Date Time"] for field in fields] == ["1/2/2023 9:05", "01/03/2023 10:00"]
+    assert [field[NORMALIZED_DATE_FIELD] for field in fields] == ["01/02/2023 09:05", "01/03/2023 10:00"]
+    assert fields[0]["PatientID"] == "Patient1"
+    assert fields[0]["Raw Report"]["Performed Date Time"] == "1/2/2023 9:05"
+
+
+def test_failed_insert_batches_are_reported(monkeypatch, tmp_path):
+    csv_path = tmp_path / "reports.csv"
+    make_frame(["01/02/2023 09:05"] * (pre_processing.INSERT_BATCH_SIZE + 50)).to_csv(csv_path, index=False)
+    collection = mongomock.MongoClient()["ClinicalNotesReviewer"]["processed_reports"]
+    insert_many = collection.insert_many
+    calls = []
+
+    def fail_first_batch(documents):
+        calls.append(len(documents))
+        if len(calls) == 1:
+            raise RuntimeError("Connection lost")
+        return insert_many(documents)
+
+    monkeypatch.setattr(collection, "insert_many", fail_first_batch)
+    monkeypatch.setattr(pre_processing, "get_collection", lambda: collection)
+    monkeypatch.setattr(pre_processing, "generate_layman_explanation", lambda text: "Explanation.")
+    monkeypatch.setattr(pre_processing, "summarize_report", lambda text: {})
+    monkeypatch.setattr(pre_processing, "REPORT_PACING_SECONDS", 0)
+
+    with pytest.raises(RuntimeError, match="1 batches"):
+        pre_processing.main(str(csv_path))
+
+    # The batches after the failed one are still inserted
+    assert collection.count_documents({}) == 50
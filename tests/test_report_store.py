@@ -0,0 +1,108 @@
+# Import libraries
+from datetime import datetime
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+np = pytest.importorskip("numpy")
+
+import comparison_gemini_table as pipeline
+from comparison_records import SINGLE_REPORT_MESSAGE
+from comparison_service import FakeModelBackend
+from model_router import ModelRouter
+from report_store import ReportStore, parse_report_dates
+from text_storage import TextStorage
+
+"""
+Tests of the columnar report index and of comparing patients whose reports were deleted.
+"""
+
+
+def make_report(patient_id, performed_date_time):
+    return {
+        "PatientID": patient_id,
+        "Performed Date Time": performed_date_time,
+        "Raw Report": {"Masked_PatientID": patient_id, "Text": "Chest X-ray.", "Order Name": "CHEST XR"},
+        "Processed Data": {"Summary": {"Diseases Mentioned": {"Pneumonia": "Consolidation."}}},
+    }
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = mongomock.MongoClient()["ClinicalNotesReviewer"]
+    monkeypatch.setattr(pipeline.PIPELINE, "get_db", lambda: db)
+    monkeypatch.setattr(pipeline.PIPELINE, "_router", ModelRouter(
+        FakeModelBackend("fake-cheap", 0).as_backend(), FakeModelBackend("fake-strong", 0).as_backend()
+    ))
+    return db
+
+
+def test_dates_are_parsed_in_bulk_with_a_fallback_for_other_layouts():
+    values = ["01/02/2024 09:05", "1/2/2024 9:05", "29/02/2024 23:59", "31/12/1999 00:00"]
+
+    dates, errors = parse_report_dates(values)
+
+    assert errors == {}
+    assert dates.astype(datetime).tolist() == [
+        datetime(2024, 2, 1, 9, 5), datetime(2024, 2, 1, 9, 5), datetime(2024, 2, 29, 23, 59), datetime(1999, 12, 31),
+    ]
+
+
+def test_invalid_dates_are_reported_and_not_a_time():
+    values = ["31/02/2024 09:00", "01/13/2024 09:00", "2024-02-01 09:00", "01/02/2024 24:00", "", None, "01/02/2024 09:00"]
+
+    dates, errors = parse_report_dates(values)
+
+    assert sorted(errors) == [0, 1, 2, 3, 4, 5]
+    assert np.isnat(dates[:6]).all()
+    assert dates[6].astype(datetime) == datetime(2024, 2, 1, 9, 0)
+
+
+def test_reports_are_grouped_by_patient_and_sorted_by_date(db):
+    db["processed_reports"].insert_many([
+        make_report("P2", "05/01/2024 09:00"),
+        make_report("P1", "03/01/2024 09:00"),
+        make_report("P1", "01/01/2024 09:00"),
+        make_report("P1", "not a date"),
+    ])
+
+    store = ReportStore.load(db["processed_reports"], TextStorage(db))
+    patients = dict(store.items())
+
+    assert sorted(patients) == ["P1", "P2"]
+    assert patients["P1"].report_dates() == [datetime(2024, 1, 1, 9), datetime(2024, 1, 3, 9)]
+    assert len(patients["P1"].latest(1).load()) == 1
+
+
+def compare_after_deleting(db, deleted_count):
+    db["processed_reports"].insert_many([
+        make_report("P1", "01/01/2024 09:00"),
+        make_report("P1", "01/02/2024 09:00"),
+    ])
+    reports = dict(pipeline.get_reports_by_patient().items())["P1"]
+    for report in list(db["processed_reports"].find().sort("_id", 1))[:deleted_count]:
+        db["processed_reports"].delete_one({"_id": report["_id"]})
+
+    comparison_collection = db[pipeline.COMPARISON_COLLECTION_NAME]
+    pipeline.compare_patient("P1", reports, comparison_collection)
+    return comparison_collection.find_one({"PatientID": "P1"})
+
+
+def test_patient_with_every_report_deleted_is_skipped(db):
+    assert compare_after_deleting(db, 2) is None
+
+
+def test_patient_with_one_report_left_gets_a_single_report_document(db):
+    document = compare_after_deleting(db, 1)
+
+    assert document["Message"] == SINGLE_REPORT_MESSAGE
+    assert document["Comparisons"] == []
+
+
+def test_normalized_dates_are_read_when_stored(db):
+    report = make_report("P1", "1/2/2024 9:05 AM")
+    report["Performed Date Time Normalized"] = "01/02/2024 09:05"
+    db["processed_reports"].insert_one(report)
+
+    store = ReportStore.load(db["processed_reports"], TextStorage(db))
+
+    assert dict(store.items())["P1"].report_dates() == [datetime(2024, 2, 1, 9, 5)]
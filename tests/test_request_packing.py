@@ -0,0 +1,87 @@
+# Import libraries
+from datetime import datetime
+import pytest
+
+import comparison_gemini_table as pipeline
+from model_router import ModelBackend, ModelRouter
+from request_packing import (
+    PACKING_CONFIG,
+    ComparisonUnit,
+    compare_units_packed,
+    generate_packed_comparison_prompt,
+    pack_units,
+    split_packed_response,
+)
+
+"""
+Tests of packing several section comparisons into one model request.
+"""
+
+NEW_REPORT = (datetime(2024, 2, 1, 9), {})
+OLD_REPORT = (datetime(2024, 1, 1, 9), {})
+INSTRUCTIONS_LINE = "### Comparison Instructions:"
+
+
+def make_unit(section_name, entries=1, value="Consolidation."):
+    content = {f"Finding {index}": value for index in range(entries)}
+    return ComparisonUnit(section_name, NEW_REPORT, OLD_REPORT, content, dict(content))
+
+
+def table(finding):
+    return f"| Category | New | Old | Explanation |\n|---|---|---|---|\n| New Development | {finding} | NIL | New. |"
+
+
+def test_instructions_are_sent_once_per_packed_request():
+    units = [make_unit("Diseases Mentioned"), make_unit("Organs Mentioned"), make_unit("Symptoms/Phenomena of Concern")]
+
+    prompt = generate_packed_comparison_prompt(units, pipeline.generate_comparison_prompt)
+
+    assert prompt.count(INSTRUCTIONS_LINE) == 1
+    assert prompt.count("</task>\n") == 3
+    assert "Section: Organs Mentioned" in prompt
+    assert "Newer Report (01/02/2024 09:00:00): {'Finding 0': 'Consolidation.'}" in prompt
+
+
+def test_small_units_share_a_request():
+    units = [make_unit(f"Section {index}") for index in range(4)]
+
+    assert [len(batch) for batch in pack_units(units, pipeline.generate_comparison_prompt)] == [4]
+
+
+def test_oversized_unit_is_sent_alone_and_whole():
+    oversized = make_unit("Organs Mentioned", entries=300, value="Small bilateral pleural effusions. " * 5)
+    units = [make_unit("Diseases Mentioned"), oversized, make_unit("Symptoms/Phenomena of Concern")]
+
+    batches = pack_units(units, pipeline.generate_comparison_prompt)
+
+    assert [[unit.section_name for unit in batch] for batch in batches] == [
+        ["Diseases Mentioned"], ["Organs Mentioned"], ["Symptoms/Phenomena of Concern"]
+    ]
+    assert batches[1][0] is oversized
+
+
+def test_packed_response_is_split_by_task_heading():
+    response = f"### Task 2\n{table('B')}\n\n**Task 1:**\n{table('A')}"
+
+    outputs = split_packed_response(response, 3)
+
+    assert "| A |" in outputs[0] and "| B |" in outputs[1] and outputs[2] == ""
+
+
+def test_tasks_missing_from_a_packed_response_are_compared_alone():
+    units = [make_unit("Diseases Mentioned"), make_unit("Organs Mentioned")]
+    backend = ModelBackend("fake", lambda prompt: f"### Task 1\n{table('Packed')}")
+    compared_alone = []
+
+    def compare_single(section_name, content1, content2, date1, date2):
+        compared_alone.append(section_name)
+        return [("New Development", "Alone", "NIL", "New.")]
+
+    results = compare_units_packed(
+        units, ModelRouter(backend, backend), compare_single, pipeline.generate_comparison_prompt, retries=1
+    )
+
+    assert [(unit.section_name, rows[0][1]) for unit, rows in results] == [
+        ("Diseases Mentioned", "Packed"), ("Organs Mentioned", "Alone")
+    ]
+    assert compared_alone == ["Organs Mentioned"]
@@ -0,0 +1,94 @@
+# Import libraries
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+from sharding import (
+    SHARD_BUCKETS,
+    ShardAssignment,
+    ShardLeaseManager,
+    patient_shard_bucket,
+    reset_shard_leases,
+    shard_bucket_range,
+)
+
+"""
+Tests of shard hashing and of the shard leases claimed by the comparison workers.
+"""
+
+
+@pytest.fixture
+def leases():
+    return mongomock.MongoClient()["ClinicalNotesReviewer"]["comparison_shard_leases"]
+
+
+def process_all(worker):
+    """
+    Run the claim loop of a worker, returning the shards it processed.
+    """
+    processed = []
+    try:
+        while worker.claim():
+            processed.extend(worker.shard_indices)
+            worker.mark_done()
+    finally:
+        worker.release()
+    return processed
+
+
+def test_patient_buckets_are_stable_and_in_range():
+    assert patient_shard_bucket("P1") == patient_shard_bucket("P1")
+    assert all(0 <= patient_shard_bucket(f"P{index}") < SHARD_BUCKETS for index in range(1000))
+
+
+def test_shard_ranges_cover_every_bucket_once():
+    shard_count = 7
+    ranges = [shard_bucket_range(index, shard_count) for index in range(shard_count)]
+
+    assert ranges[0][0] == 0 and ranges[-1][1] == SHARD_BUCKETS
+    assert all(ranges[index][1] == ranges[index + 1][0] for index in range(shard_count - 1))
+
+
+def test_every_patient_is_owned_by_exactly_one_shard():
+    shard_count = 4
+    owners = [ShardAssignment([index], shard_count) for index in range(shard_count)]
+    for owner in owners:
+        owner.claim()
+
+    for index in range(200):
+        assert sum(owner.owns_patient(f"P{index}") for owner in owners) == 1
+
+
+def test_static_assignment_is_processed_once():
+    assert process_all(ShardAssignment([2], 4)) == [2]
+
+
+def test_workers_keep_claiming_until_every_shard_is_done(leases):
+    first = ShardLeaseManager(leases, "worker-1", shard_count=5, max_shards=1)
+    second = ShardLeaseManager(leases, "worker-2", shard_count=5, max_shards=1)
+
+    processed = process_all(first) + process_all(second)
+
+    assert sorted(processed) == [0, 1, 2, 3, 4]
+    assert leases.count_documents({"done": True}) == 5
+
+
+def test_finished_shards_are_not_claimed_again_until_reset(leases):
+    process_all(ShardLeaseManager(leases, "worker-1", shard_count=3, max_shards=2))
+    late_worker = ShardLeaseManager(leases, "worker-2", shard_count=3, max_shards=2)
+
+    assert late_worker.claim() == []
+
+    reset_shard_leases(leases)
+    assert sorted(process_all(late_worker)) == [0, 1, 2]
+
+
+def test_live_lease_of_another_worker_is_not_claimed(leases):
+    holder = ShardLeaseManager(leases, "worker-1", shard_count=2, max_shards=1)
+    other = ShardLeaseManager(leases, "worker-2", shard_count=2, max_shards=2)
+    try:
+        assert holder.claim() == [0]
+        assert other.claim() == [1]
+    finally:
+        holder.release()
+        other.release()
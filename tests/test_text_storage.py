@@ -0,0 +1,82 @@
+# Import libraries
+from datetime import datetime, timedelta
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+import text_storage
+from text_storage import CONTENTS_COLLECTION, TextStorage
+
+"""
+Tests of the shared comparison contents: references, their resolution and the orphan cleanup.
+"""
+
+LONG_CONTENT = "Minor atelectasis in the right lower zone and left paracardiac region. " * 2
+
+
+@pytest.fixture
+def db():
+    return mongomock.MongoClient()["ClinicalNotesReviewer"]
+
+
+def make_storage(db):
+    return TextStorage(db, dict(text_storage.STORAGE_CONFIG, content_refs=True))
+
+
+def make_document(patient_id, new_content):
+    return {
+        "PatientID": patient_id,
+        "Comparisons": [{"Section": "Lungs", "Category": "Difference", "NewContent": new_content, "OldContent": "NIL"}],
+    }
+
+
+def age_contents(db, days=2):
+    past = datetime.utcnow() - timedelta(days=days)
+    db[CONTENTS_COLLECTION].update_many({}, {"$set": {"created": past, "last_used": past}})
+
+
+def test_contents_round_trip_through_references(db):
+    stored = make_storage(db).externalize_contents(make_document("P1", LONG_CONTENT))
+
+    assert set(stored["Comparisons"][0]["NewContent"]) == {"_ref"}
+    assert stored["Comparisons"][0]["OldContent"] == "NIL"
+
+    # A new process has an empty cache and reads the content from MongoDB
+    resolved = make_storage(db).resolve_contents(stored)
+    assert resolved["Comparisons"][0]["NewContent"] == LONG_CONTENT
+
+
+def test_cleanup_removes_only_old_unreferenced_contents(db):
+    storage = make_storage(db)
+    db["comparisons"].insert_one(storage.externalize_contents(make_document("P1", LONG_CONTENT)))
+    storage.externalize_contents(make_document("P2", LONG_CONTENT + "Replaced."))
+
+    # Unreferenced contents are kept during the grace period
+    assert storage.remove_orphan_contents([db["comparisons"]]) == 0
+
+    age_contents(db)
+    assert storage.remove_orphan_contents([db["comparisons"]]) == 1
+    assert db[CONTENTS_COLLECTION].count_documents({}) == 1
+
+
+def test_reused_content_is_stored_again_after_cleanup(db):
+    storage = make_storage(db)
+    storage.externalize_contents(make_document("P1", LONG_CONTENT))
+    age_contents(db)
+    make_storage(db).remove_orphan_contents([db["comparisons"]])
+
+    # The content is still cached by the long-running process that wrote it
+    stored = storage.externalize_contents(make_document("P1", LONG_CONTENT))
+    db["comparisons"].insert_one(stored)
+
+    assert make_storage(db).resolve_contents(stored)["Comparisons"][0]["NewContent"] == LONG_CONTENT
+
+
+def test_reuse_refreshes_last_used(db):
+    storage = make_storage(db)
+    storage.externalize_contents(make_document("P1", LONG_CONTENT))
+    age_contents(db)
+
+    storage.externalize_contents(make_document("P2", LONG_CONTENT))
+
+    assert storage.remove_orphan_contents([db["comparisons"]]) == 0